@@ -5,16 +5,20 @@ Baraag DL v0.023 -  A simple Baraag media downloader
 """
 
 import argparse
-from mastodon import Mastodon
-from mastodon.Mastodon import MastodonError, MastodonMalformedEventError,\
-    MastodonNetworkError, MastodonReadTimeout, MastodonAPIError,\
-    MastodonUnauthorizedError, MastodonIllegalArgumentError
+import collections
+import contextlib
+import json
 
 import sys
 import os
-import requests
 import logging
-import subprocess
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+from urllib.parse import urlsplit
 
 from datetime import datetime
 
@@ -31,11 +35,96 @@ if os.name != "posix":
 
 baraag_dl_version = "v0.023"
 client_name = "baraag_dl"+baraag_dl_version
+api_base_url = "https://baraag.net"
+
+# Exit codes of the command line mode: success, some downloads, conversions
+# or accounts failed, or the run could not happen at all
+
+exit_ok = 0
+exit_partial = 1
+exit_fatal = 2
+
+# Mastodon.py and requests make up most of the startup time, so they are
+# only imported once a command needs the network (see load_network_modules())
+
+requests = None
+Mastodon = None
+MastodonError = MastodonMalformedEventError = MastodonNetworkError = None
+MastodonReadTimeout = MastodonAPIError = MastodonUnauthorizedError = None
+MastodonIllegalArgumentError = None
+TimeoutSession = None
 
 # Initial empty client
 
 client = None
 
+# Shared HTTP session, created by init_session()
+
+http_session = None
+
+# Sync state database (newest post seen per account)
+
+state_db_file = "baraag_dl.db"
+
+# Rate-limit budget shared by the shards of a sharded sync running on the
+# same host (see SharedRateLimiter)
+
+rate_budget_file = "baraag_dl_ratelimit.db"
+state_db = None
+state_db_lock = threading.RLock()
+
+# Default settings, written to config.ini when it does not exist
+
+default_settings = {"use_ffmpeg": False,
+                    "ffmpeg_path": "System",
+                    "convert_gif": True,
+                    "convert_apng": True,
+                    "file_size_limit": 50.0,
+                    "max_downloads": 8,
+                    "max_downloads_per_host": 4,
+                    "max_crawlers": 4,
+                    "pool_size": 16,
+                    "connect_timeout": 10.0,
+                    "read_timeout": 60.0,
+                    "deduplicate": True,
+                    "max_conversions": 0,
+                    "single_pass": True,
+                    "follow_cache_ttl": 60,
+                    "home_timeline_sync": True,
+                    "max_retries": 4}
+
+# Known file signatures and content types, used to infer the extension of
+# attachments whose URL does not have one (see probe_extension())
+
+file_signatures = [(b"\x89PNG\r\n\x1a\n", ".png"),
+                   (b"\xff\xd8\xff", ".jpg"),
+                   (b"GIF87a", ".gif"),
+                   (b"GIF89a", ".gif"),
+                   (b"\x1aE\xdf\xa3", ".webm"),
+                   (b"OggS", ".ogg"),
+                   (b"ID3", ".mp3")]
+
+content_types = {"image/png": ".png",
+                 "image/apng": ".png",
+                 "image/jpeg": ".jpg",
+                 "image/gif": ".gif",
+                 "image/webp": ".webp",
+                 "image/avif": ".avif",
+                 "video/mp4": ".mp4",
+                 "video/quicktime": ".mov",
+                 "video/webm": ".webm",
+                 "audio/mpeg": ".mp3",
+                 "audio/ogg": ".ogg"}
+
+# ffmpeg filter used to create GIFs with an optimized palette
+
+gif_filter = 'palettegen=stats_mode=diff[p];[b][p]paletteuse=dither=bayer:'\
+             'bayer_scale=5:diff_mode=rectangle'
+
+# ffmpeg version strings, by path of the executable
+
+ffmpeg_versions = {}
+
 # Initializing logger
 
 timestamp = datetime.now().strftime("%Y%m%d%H%M")
@@ -44,6 +133,723 @@ logfile = "baraag_dl_error_"+timestamp+".log"
 logging.basicConfig(level = logging.INFO,
                     handlers=[logging.FileHandler(logfile, delay=True)])
 
+# Rate limiting
+
+class RateLimiter:
+    '''
+    Token-bucket rate limiter shared by every HTTP request of the script
+    (see TimeoutSession), whether it comes from Mastodon.py, the raw API
+    requests or the media downloads.
+    
+    Buckets are kept per host and first path component (e.g. /api on
+    baraag.net), and are filled from the X-RateLimit-Limit, -Remaining and
+    -Reset headers of the responses. Requests go out at full speed while the
+    bucket has tokens left; once it is empty, callers wait until the limit
+    resets instead of running into a 429. Paths that never send rate-limit
+    headers (e.g. media files) are not limited at all.
+    
+    All buckets are protected by a lock, so one instance is shared by all
+    threads.
+    '''
+    def __init__(self, max_wait = 5 * 60):
+        self.max_wait = max_wait
+        self.buckets = {}
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def bucket_key(url):
+        '''
+        Returns the bucket a URL belongs to: a tuple (host, first path
+        component).
+        '''
+        parts = urlsplit(url)
+        
+        return (parts.netloc, parts.path.lstrip("/").split("/")[0])
+    
+    def acquire(self, url):
+        '''
+        Takes a token from the bucket of a URL, blocking until the rate limit
+        resets if none are left.
+        
+        Takes 1 argument:
+            
+        url = URL about to be requested (str)
+              REQUIRED
+        
+        Returns nothing.
+        '''
+        key = self.bucket_key(url)
+        
+        while True:
+            delay = self.take(key)
+            if delay is None:
+                return
+            
+            time.sleep(max(delay, 0.05))
+    
+    def exhausted(self, url):
+        '''
+        Returns True if the bucket of a URL has no token left until its limit
+        resets, so acquire() will wait for the reset by itself.
+        '''
+        bucket = self.peek(self.bucket_key(url))
+        
+        return bucket is not None and bucket["remaining"] <= 0 and \
+               bucket["reset"] > time.time()
+    
+    def peek(self, key):
+        '''
+        Returns a copy of a bucket dictionary, or None if the bucket is not
+        limited.
+        '''
+        with self.lock:
+            bucket = self.buckets.get(key)
+            return None if bucket is None else dict(bucket)
+    
+    def take(self, key):
+        '''
+        Takes a token from a bucket, see spend().
+        
+        Returns: None if a token was taken or the bucket is not limited,
+                 otherwise the number of seconds to wait before trying again
+                 (float).
+        '''
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return None
+            
+            return self.spend(bucket)
+    
+    def spend(self, bucket):
+        '''
+        Takes a token from a bucket dictionary (modified in place), refilling
+        it first if its limit has reset.
+        
+        Returns: None if a token was taken, otherwise the number of seconds
+                 until the limit resets (float).
+        '''
+        now = time.time()
+        
+        # The limit has reset: refill until the next response says otherwise
+        
+        if now >= bucket["reset"]:
+            bucket["remaining"] = bucket["limit"]
+            bucket["reset"] = now + self.max_wait
+        
+        if bucket["remaining"] > 0:
+            bucket["remaining"] -= 1
+            return None
+        
+        # As a precaution, never wait longer than 5 minutes
+        
+        return min(bucket["reset"] - now, self.max_wait)
+    
+    def update(self, response):
+        '''
+        Updates the bucket of a response from its X-RateLimit-* headers.
+        Responses without these headers are ignored. A 429 response empties
+        the bucket.
+        
+        Takes 1 argument:
+            
+        response = a requests.Response object
+                   REQUIRED
+        
+        Returns nothing.
+        '''
+        import email.utils
+        
+        headers = response.headers
+        
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        
+        try:
+            limit = int(headers.get("X-RateLimit-Limit", 0))
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = datetime.fromisoformat(headers["X-RateLimit-Reset"].replace("Z", "+00:00"))
+            
+            # Measure the reset time against the server clock, not ours
+            
+            if "Date" in headers:
+                server_now = email.utils.parsedate_to_datetime(headers["Date"])
+                reset = time.time() + (reset - server_now).total_seconds()
+            else:
+                reset = reset.timestamp()
+        
+        except (KeyError, ValueError, TypeError) as exc:
+            logging.warning("Unreadable rate-limit headers: "+str(exc))
+            return
+        
+        if response.status_code == 429:
+            remaining = 0
+        
+        self.record(self.bucket_key(response.request.url), limit, remaining,
+                    reset)
+    
+    def record(self, key, limit, remaining, reset):
+        '''
+        Updates a bucket with the values of a response, see merge().
+        '''
+        with self.lock:
+            self.buckets[key] = self.merge(self.buckets.get(key), limit,
+                                           remaining, reset)
+    
+    @staticmethod
+    def merge(bucket, limit, remaining, reset):
+        '''
+        Returns a bucket dictionary (None if there is none yet) updated with
+        the limit, remaining count and reset time (timestamp) of a response.
+        '''
+        # Responses from the same window may arrive out of order, so the
+        # lowest remaining count wins; a new window replaces the old one
+        
+        if bucket is not None and abs(bucket["reset"] - reset) < 2:
+            bucket["remaining"] = min(bucket["remaining"], remaining)
+            return bucket
+        
+        return {"limit": max(limit, remaining),
+                "remaining": remaining,
+                "reset": reset}
+
+class SharedRateLimiter(RateLimiter):
+    '''
+    RateLimiter whose buckets are kept in an SQLite database file instead of
+    in memory, so several processes using the same file (e.g. the shards of
+    a sharded sync, see shard_accounts()) share a single rate-limit budget:
+    a token taken by one of them is gone for all the others, and together
+    they stay under the limit of the access token.
+    
+    Every bucket is read and written back in an IMMEDIATE transaction, which
+    locks the file against the other processes in the meantime; the threads
+    of a process also go through the lock of the instance, as they share its
+    connection.
+    '''
+    def __init__(self, path, max_wait = 5 * 60):
+        super().__init__(max_wait)
+        self.path = path
+        # Transactions are started and ended explicitly, see transaction()
+        self.db = sqlite3.connect(path, timeout = 30, isolation_level = None,
+                                  check_same_thread = False)
+        # Readers do not wait for the writers of other processes
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rate_budget ("
+                        "bucket TEXT PRIMARY KEY, "
+                        "bucket_limit INTEGER, "
+                        "remaining INTEGER, "
+                        "reset REAL)")
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Context manager holding the database file locked for writing, rolled
+        back if an exception is raised.
+        '''
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+    
+    @staticmethod
+    def load(db, key):
+        '''
+        Returns the bucket dictionary saved for a bucket key, or None.
+        '''
+        row = db.execute("SELECT bucket_limit, remaining, reset FROM "
+                         "rate_budget WHERE bucket = ?",
+                         ("/".join(key),)).fetchone()
+        if row is None:
+            return None
+        
+        return {"limit": row[0], "remaining": row[1], "reset": row[2]}
+    
+    @staticmethod
+    def save(db, key, bucket):
+        '''
+        Saves a bucket dictionary under a bucket key.
+        '''
+        db.execute("INSERT OR REPLACE INTO rate_budget (bucket, bucket_limit, "
+                   "remaining, reset) VALUES (?, ?, ?, ?)",
+                   ("/".join(key), bucket["limit"], bucket["remaining"],
+                    bucket["reset"]))
+    
+    def peek(self, key):
+        with self.lock:
+            return self.load(self.db, key)
+    
+    def take(self, key):
+        # Most requests (e.g. media files) have no bucket: a plain read tells
+        # without locking the file for the other processes
+        
+        if self.peek(key) is None:
+            return None
+        
+        with self.transaction() as db:
+            bucket = self.load(db, key)
+            if bucket is None:
+                return None
+            
+            delay = self.spend(bucket)
+            self.save(db, key, bucket)
+        
+        return delay
+    
+    def record(self, key, limit, remaining, reset):
+        with self.transaction() as db:
+            self.save(db, key, self.merge(self.load(db, key), limit, remaining,
+                                          reset))
+
+api_rate_limiter = RateLimiter()
+
+# Retries and failure isolation
+
+class APIError(Exception):
+    '''
+    Raised by mastodon_error_handler(), mastodon_network_error_handler() and
+    get_following() once a request failed for good (see TimeoutSession), so
+    the caller decides whether to skip the item (e.g. one account of a sync,
+    retried at the end of the run) or to stop (main() exits with exit_fatal).
+    '''
+
+class HostUnavailableError(ConnectionError):
+    '''
+    Raised by CircuitBreaker.check() for requests to a host whose circuit is
+    open.
+    '''
+
+def retry_after(response, cap = 5 * 60):
+    '''
+    Returns the number of seconds a response asks to wait before retrying,
+    from its Retry-After header (in seconds or as an HTTP date), at most cap;
+    None if there is no readable Retry-After header.
+    '''
+    import email.utils
+    
+    value = response.headers.get("Retry-After")
+    
+    if value is None:
+        return None
+    
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    
+    return min(max(delay, 0), cap)
+
+def retry_delay(attempt, base = 1.0, cap = 60.0):
+    '''
+    Returns how long to wait (in seconds) before retrying a request that
+    failed attempt + 1 times: exponential backoff with "full jitter", a
+    random delay between 0 and base * 2 ** attempt (at most cap), so threads
+    that failed together do not retry together.
+    '''
+    import random
+    
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class CircuitBreaker:
+    '''
+    Per-host circuit breaker shared by every HTTP request of the script (see
+    TimeoutSession).
+    
+    After threshold transient failures in a row (connection errors, timeouts
+    and 5xx responses) from a host, its circuit "opens": requests to it fail
+    right away with HostUnavailableError for cooldown seconds, instead of
+    each one waiting for its timeouts and retries while the host is down. The
+    first request after the cooldown goes through as a trial; a success
+    closes the circuit again, a failure keeps it open for another cooldown.
+    '''
+    def __init__(self, threshold = 5, cooldown = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+    
+    def check(self, url):
+        '''
+        Raises HostUnavailableError if the circuit of the host of a URL is
+        open. Returns nothing otherwise.
+        '''
+        host = urlsplit(url).netloc
+        
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or state["failures"] < self.threshold:
+                return
+            
+            now = time.time()
+            
+            if now < state["opened_at"] + self.cooldown:
+                raise HostUnavailableError("Requests to "+host+" are paused "\
+                                           "for "+
+                                           str(round(state["opened_at"] +
+                                                     self.cooldown - now))+
+                                           " seconds after repeated failures")
+            
+            # Let this request through as the trial, the others wait for it
+            
+            state["opened_at"] = now
+    
+    def success(self, url):
+        '''
+        Closes the circuit of the host of a URL.
+        '''
+        with self.lock:
+            self.hosts.pop(urlsplit(url).netloc, None)
+    
+    def failure(self, url):
+        '''
+        Counts a transient failure of the host of a URL, opening its circuit
+        once there are threshold of them in a row.
+        '''
+        host = urlsplit(url).netloc
+        
+        with self.lock:
+            state = self.hosts.setdefault(host, {"failures": 0, "opened_at": 0})
+            state["failures"] += 1
+            if state["failures"] == self.threshold:
+                state["opened_at"] = time.time()
+                logging.error("Too many failures from "+host+", pausing "\
+                              "requests to it for "+str(self.cooldown)+" seconds")
+                metrics.inc("circuit_breaker_trips_total", host = host)
+    
+    def wait_time(self):
+        '''
+        Returns the number of seconds until every open circuit can be tried
+        again (0 if none is open).
+        '''
+        now = time.time()
+        
+        with self.lock:
+            return max([state["opened_at"] + self.cooldown - now\
+                        for state in self.hosts.values()\
+                        if state["failures"] >= self.threshold] + [0])
+
+host_breaker = CircuitBreaker()
+
+# Responses worth retrying: the server (or a proxy in front of it) had a
+# transient problem
+
+retry_statuses = (500, 502, 503, 504)
+
+class Metrics:
+    '''
+    Counters and histograms describing a run, shared by all threads: API
+    latency per endpoint, pages fetched, attachments per outcome, bytes
+    downloaded, probes and ffmpeg time.
+    
+    Each metric is identified by a name and optional labels (keyword
+    arguments). At the end of a run, they can be written as a JSON summary
+    (write_json()) or as a Prometheus textfile for the node_exporter
+    textfile collector (write_prometheus()).
+    '''
+    # Histogram bucket upper bounds, in seconds
+    
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 120, 300)
+    
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, name, value = 1, **labels):
+        '''
+        Adds value (defaults to 1) to a counter.
+        '''
+        key = (name, tuple(sorted((label, str(label_value))
+                                  for label, label_value in labels.items())))
+        
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        '''
+        Records a value (usually a duration in seconds) in a histogram.
+        '''
+        key = (name, tuple(sorted((label, str(label_value))
+                                  for label, label_value in labels.items())))
+        
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {"buckets": [0] * len(self.buckets),
+                                        "sum": 0.0, "count": 0}
+            histogram = self.histograms[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+    
+    def total(self, name):
+        '''
+        Returns the sum of a counter over all its labels.
+        '''
+        with self.lock:
+            return sum(value for (counter, labels), value in self.counters.items()
+                       if counter == name)
+    
+    def summary(self):
+        '''
+        Returns all metrics as a dictionary, ready to be dumped as JSON.
+        '''
+        duration = time.time() - self.started
+        
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append({"labels": dict(labels),
+                                                      "value": value})
+            
+            histograms = {}
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, []).append(
+                    {"labels": dict(labels),
+                     "count": histogram["count"],
+                     "sum": histogram["sum"],
+                     "mean": histogram["sum"] / histogram["count"],
+                     "buckets": dict(zip([str(bound) for bound in self.buckets],
+                                         histogram["buckets"]))})
+        
+        return {"started": datetime.fromtimestamp(self.started).isoformat(timespec = "seconds"),
+                "duration_seconds": duration,
+                "download_throughput_bytes_per_second":
+                    self.total("download_bytes_total") / duration,
+                "counters": counters,
+                "histograms": histograms}
+    
+    def write_json(self, path):
+        '''
+        Writes summary() to a JSON file.
+        '''
+        with open(path, "w") as output_file:
+            json.dump(self.summary(), output_file, indent = 2)
+    
+    def write_prometheus(self, path):
+        '''
+        Writes all metrics in the Prometheus text format, prefixed with
+        "baraag_dl_". The file is written under a temporary name and renamed,
+        so node_exporter never reads a half-written file.
+        '''
+        def format_labels(labels, extra = ()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [key+'="'+str(value).replace("\\", "\\\\")\
+                       .replace('"', '\\"').replace("\n", "\\n")+'"'
+                       for key, value in pairs]
+            return "{"+",".join(escaped)+"}"
+        
+        lines = ["# TYPE baraag_dl_last_run_timestamp_seconds gauge",
+                 "baraag_dl_last_run_timestamp_seconds "+str(time.time()),
+                 "# TYPE baraag_dl_run_duration_seconds gauge",
+                 "baraag_dl_run_duration_seconds "+str(time.time() - self.started)]
+        
+        with self.lock:
+            for name in sorted({name for name, labels in self.counters}):
+                lines.append("# TYPE baraag_dl_"+name+" counter")
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append("baraag_dl_"+name+format_labels(labels)+
+                                     " "+str(value))
+            
+            for name in sorted({name for name, labels in self.histograms}):
+                lines.append("# TYPE baraag_dl_"+name+" histogram")
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, count in zip(self.buckets, histogram["buckets"]):
+                        lines.append("baraag_dl_"+name+"_bucket"+
+                                     format_labels(labels, [("le", bound)])+
+                                     " "+str(count))
+                    lines.append("baraag_dl_"+name+"_bucket"+
+                                 format_labels(labels, [("le", "+Inf")])+
+                                 " "+str(histogram["count"]))
+                    lines.append("baraag_dl_"+name+"_sum"+format_labels(labels)+
+                                 " "+str(histogram["sum"]))
+                    lines.append("baraag_dl_"+name+"_count"+format_labels(labels)+
+                                 " "+str(histogram["count"]))
+        
+        with open(path+".tmp", "w") as output_file:
+            output_file.write("\n".join(lines)+"\n")
+        os.replace(path+".tmp", path)
+
+metrics = Metrics()
+
+# HTTP session
+
+def load_network_modules():
+    '''
+    Imports Mastodon.py and requests into the global namespace, and defines
+    TimeoutSession on top of requests.Session. Importing them takes most of
+    the startup time of the script, so this is only done by init_session(),
+    once a command actually needs the network; --help, --version, --stats and
+    status return without it.
+    
+    Takes no arguments and returns nothing. Does nothing if the modules were
+    already loaded.
+    '''
+    global requests, Mastodon, MastodonError, MastodonMalformedEventError,\
+        MastodonNetworkError, MastodonReadTimeout, MastodonAPIError,\
+        MastodonUnauthorizedError, MastodonIllegalArgumentError, TimeoutSession
+    
+    if requests is not None:
+        return
+    
+    import requests
+    import requests.adapters
+    from mastodon import Mastodon
+    from mastodon.Mastodon import MastodonError, MastodonMalformedEventError,\
+        MastodonNetworkError, MastodonReadTimeout, MastodonAPIError,\
+        MastodonUnauthorizedError, MastodonIllegalArgumentError
+    
+    class TimeoutSession(requests.Session):
+        '''
+        A requests.Session that applies a default timeout to every request, since
+        requests itself waits forever unless told otherwise, and makes every
+        request go through api_rate_limiter and host_breaker.
+    
+        GET and HEAD requests that fail with a transient error (connection
+        error, timeout, 5xx response) are retried up to max_retries times,
+        waiting retry_delay() in between, or as long as the Retry-After
+        header of the response asks. Those rejected with a 429 are retried
+        the same way, or once the limit resets if api_rate_limiter knows the
+        limit is exhausted (e.g. because another program uses the same
+        account).
+        '''
+        def __init__(self, timeout, max_retries = 4):
+            super().__init__()
+            self.timeout = timeout
+            self.max_attempts = max_retries + 1
+    
+        def request(self, method, url, **kwargs):
+            kwargs.setdefault("timeout", self.timeout)
+        
+            # API latency is recorded per endpoint, with IDs left out
+        
+            path = urlsplit(url).path
+            if path.startswith("/api/"):
+                endpoint = re.sub(r"/\d+(?=/|$)", "/:id", path)
+            else:
+                endpoint = None
+            
+            retry = method.upper() in ("GET", "HEAD")
+        
+            for attempt in range(self.max_attempts):
+                last_attempt = not retry or attempt == self.max_attempts - 1
+                
+                host_breaker.check(url)
+                api_rate_limiter.acquire(url)
+                start = time.perf_counter()
+                
+                try:
+                    response = super().request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as exc:
+                    host_breaker.failure(url)
+                    if last_attempt:
+                        raise
+                    logging.warning("Retrying "+url+" after "+repr(exc))
+                    metrics.inc("retries_total", reason = "network")
+                    time.sleep(retry_delay(attempt))
+                    continue
+                
+                if endpoint is not None:
+                    metrics.observe("api_request_seconds",
+                                    time.perf_counter() - start, endpoint = endpoint)
+                    metrics.inc("api_requests_total", endpoint = endpoint,
+                                status = response.status_code)
+                api_rate_limiter.update(response)
+                
+                if response.status_code in retry_statuses:
+                    host_breaker.failure(url)
+                else:
+                    host_breaker.success(url)
+            
+                if response.status_code not in retry_statuses + (429,) or last_attempt:
+                    return response
+            
+                response.close()
+                metrics.inc("retries_total", reason = str(response.status_code))
+                
+                delay = retry_after(response)
+                
+                if delay is not None:
+                    time.sleep(delay)
+                
+                # After a 429 from a rate-limited API, api_rate_limiter waits
+                # for the reset by itself
+                
+                elif response.status_code != 429 or \
+                     not api_rate_limiter.exhausted(url):
+                    time.sleep(retry_delay(attempt))
+
+def init_session(settings = None):
+    '''
+    Creates the HTTP session shared by every network request of the script:
+    the Mastodon.py client, the raw API requests and all media downloads.
+    Reusing a single session keeps connections to Baraag (and remote media
+    hosts) alive across requests instead of opening a new TCP/TLS connection
+    every time.
+    
+    Takes 1 argument:
+        
+    settings = dictionary of settings, created by ffmpeg_validate(); uses
+               "pool_size", "connect_timeout", "read_timeout" and
+               "max_retries", and the runtime-only "rate_budget" (a file
+               whose rate-limit budget is shared with other processes, see
+               SharedRateLimiter) if present.
+               Defaults to None (uses default_settings)
+               OPTIONAL
+    
+    Mastodon.py and requests are imported by the first call (see
+    load_network_modules()).
+    
+    Returns: the session, which is also kept in the global http_session.
+    '''
+    global http_session, api_rate_limiter
+    
+    load_network_modules()
+    
+    if settings is None:
+        settings = default_settings
+    
+    if settings.get("rate_budget"):
+        api_rate_limiter = SharedRateLimiter(settings["rate_budget"])
+    
+    session = TimeoutSession((settings["connect_timeout"],
+                              settings["read_timeout"]),
+                             settings["max_retries"])
+    session.headers["User-Agent"] = client_name
+    
+    adapter = requests.adapters.HTTPAdapter(pool_connections = settings["pool_size"],
+                                            pool_maxsize = settings["pool_size"])
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    
+    http_session = session
+    
+    return session
+
+def get_session():
+    '''
+    Returns the shared HTTP session, creating it with the default settings if
+    init_session() was not called yet.
+    '''
+    if http_session is None:
+        return init_session()
+    else:
+        return http_session
+
 # Core functions
 
 def create_client():
@@ -57,15 +863,19 @@ def create_client():
     of the script.
     '''
     Mastodon.create_app(client_name,
-                        api_base_url = 'https://baraag.net',
-                        to_file = 'client_credentials')
+                        api_base_url = api_base_url,
+                        to_file = 'client_credentials',
+                        session = get_session(),
+                        user_agent = client_name)
 
 def init_client(client_credentials = "client_credentials", user_credentials = None):
     '''
     Initializes a local Mastodon client using Mastodon.py, and utilizes the 
     credentials created by create_client() to interface with the Mastodon API. 
-    Utilizes the 'pace' rate limiter to prevent the API from rejecting
-    requests.
+    Requests go through the shared HTTP session from get_session(), and are
+    rate limited by api_rate_limiter, which is shared by all threads; the
+    client itself only waits for the rate limit to reset if a request is
+    rejected anyway ('wait' rate limiter).
 
     It takes 2 arguments:
         
@@ -87,16 +897,24 @@ def init_client(client_credentials = "client_credentials", user_credentials = No
     Returns: a Mastodon object client
 
     ''' 
+    session = get_session()
+    
     if user_credentials == None:
         client = Mastodon(client_id = client_credentials,
-                        api_base_url = 'https://baraag.net',
-                        ratelimit_method='pace'
+                        api_base_url = api_base_url,
+                        ratelimit_method='wait',
+                        session = session,
+                        request_timeout = session.timeout,
+                        user_agent = client_name
                         )
     else:
         client = Mastodon(client_id = client_credentials,
-                        api_base_url = 'https://baraag.net',
-                        ratelimit_method='pace',
-                        access_token = user_credentials
+                        api_base_url = api_base_url,
+                        ratelimit_method='wait',
+                        access_token = user_credentials,
+                        session = session,
+                        request_timeout = session.timeout,
+                        user_agent = client_name
                         )
 
     return client
@@ -196,34 +1014,36 @@ def login_loop(client, user, password):
 def mastodon_error_handler(exc):
     """
     Handles generic MastodonError type errors.
-    Saves exception traceback to log, exits program.
+    Saves exception traceback to log, raises APIError.
 
     Takes 1 argument:
         
     exc = Exception caught during runtime.
           REQUIRED
           
-    Returns nothing. Exits program.
+    Returns nothing. Raises APIError, so only the item being processed
+    fails (see process_following_user()); main() exits if it reaches it.
 
     """
     logging.exception(str(exc))
     print()
     print(Fore.RED+"Baraag DL was unable to connect to the API. Please check error logs."+Fore.RESET)
     print()
-    print("Exiting...")
-    sys.exit()
+    raise APIError(str(exc)) from exc
     
 def mastodon_network_error_handler(exc):
     """
-    Handles network-related MastodonError type errors.
-    Saves exception traceback to log, exits program.
+    Handles network-related MastodonError type errors, once the request was
+    retried (see TimeoutSession).
+    Saves exception traceback to log, raises APIError.
 
     Takes 1 argument:
         
     exc = Exception caught during runtime.
           REQUIRED
           
-    Returns nothing. Exits program.
+    Returns nothing. Raises APIError, so only the item being processed
+    fails (see process_following_user()); main() exits if it reaches it.
 
     """
     logging.exception(str(exc))
@@ -231,8 +1051,7 @@ def mastodon_network_error_handler(exc):
     print(Fore.RED+"Baraag network error! Please check internet connection and/or try"\
           " again later."+Fore.RESET)
     print()
-    print("Exiting...")
-    sys.exit()
+    raise APIError(str(exc)) from exc
 
 def cold_init():
     """
@@ -355,7 +1174,13 @@ def get_following(user_id):
     provided ID follows.
     
     Unlike most functions, this queries the API directly instead of going
-    through the client generated and managed by Mastodon.py.
+    through the client generated and managed by Mastodon.py, using the shared
+    HTTP session from get_session().
+    
+    Every page of the list is kept in baraag_dl.db with its ETag, and
+    requested again with If-None-Match, so pages that did not change since
+    the last run come back as an empty 304 response and are read from the
+    database instead.
 
     It takes 1 argument: 
         
@@ -363,40 +1188,83 @@ def get_following(user_id):
               but may be obtained from search_user().
               REQUIRED
 
-    Returns: a list of dictionaries.
+    Returns: a list of dictionaries. Raises APIError if a page cannot be
+             fetched.
 
     """
-    url = "https://baraag.net/api/v1/accounts/"+str(user_id)+"/following"
+    url = api_base_url+"/api/v1/accounts/"+str(user_id)+"/following"
+    
+    session = get_session()
+    
+    cached_pages = {page_url: (etag, body, next_url) for page_url, etag, body, next_url\
+                    in get_follow_pages(user_id)}
     
     follow_list = []
+    pages = []
     
-    try:
-        req_response = requests.get(url)
-    except Exception as exc:
-        logging.exception(str(exc))
-        print()
-        print(Fore.RED+"HTTP request failed. Please check error logs."+Fore.RESET)
-        sys.exit()
+    while url is not None:
+        headers = {}
+        if url in cached_pages and cached_pages[url][0]:
+            headers["If-None-Match"] = cached_pages[url][0]
+        
+        try:
+            req_response = session.get(url, headers = headers)
+        except Exception as exc:
+            logging.exception(str(exc))
+            print()
+            print(Fore.RED+"HTTP request failed. Please check error logs."+Fore.RESET)
+            raise APIError(str(exc)) from exc
+        
+        if req_response.status_code == 304:
+            etag, body, next_url = cached_pages[url]
+            metrics.inc("follow_pages_total", result = "not_modified")
+        
+        elif not req_response:
+            print()
+            print(Fore.RED+"HTTP request returned an empty list."+Fore.RESET)
+            print()
+            print(Fore.YELLOW+"Please check if user exists and Baraag is up, and try again later."+Fore.RESET)
+            print()
+            raise APIError("HTTP "+str(req_response.status_code)+" for "+url)
         
-    if not req_response:
-        print()
-        print(Fore.RED+"HTTP request returned an empty list."+Fore.RESET)
-        print()
-        print(Fore.YELLOW+"Please check if user exists and Baraag is up, and try again later."+Fore.RESET)
-        print()
-        print("Exiting...")
-        sys.exit()
-    
-    else:       
-        while 'next' in req_response.links.keys():
-            follow_list.extend(req_response.json())
-            url = req_response.links["next"]["url"]
-            req_response = requests.get(url)
-            
         else:
-            follow_list.extend(req_response.json())         
+            etag = req_response.headers.get("ETag")
+            body = req_response.text
+            next_url = req_response.links.get("next", {}).get("url")
+            metrics.inc("follow_pages_total", result = "fetched")
         
-        return follow_list
+        follow_list.extend(json.loads(body))
+        pages.append((url, etag, body, next_url))
+        url = next_url
+    
+    set_follow_pages(user_id, pages)
+    
+    return follow_list
+
+def get_follow_pages(user_id):
+    """
+    Returns the pages of the follow list of a user saved by get_following(),
+    in order, as a list of (url, etag, body, next_url) tuples.
+    """
+    with state_db_lock:
+        return get_state_db().execute("SELECT url, etag, body, next_url "
+                                      "FROM follow_pages WHERE owner_id = ? "
+                                      "ORDER BY position",
+                                      (str(user_id),)).fetchall()
+
+def set_follow_pages(user_id, pages):
+    """
+    Replaces the saved pages of the follow list of a user, see
+    get_follow_pages().
+    """
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("DELETE FROM follow_pages WHERE owner_id = ?", (str(user_id),))
+        db.executemany("INSERT INTO follow_pages (owner_id, position, url, "
+                       "etag, body, next_url) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(str(user_id), position) + page\
+                        for position, page in enumerate(pages)])
+        db.commit()
 
 def parse_following(follow_list):
     """
@@ -409,11 +1277,30 @@ def parse_following(follow_list):
                   information, generated by get_following().
                   REQUIRED
     
-    Returns: a dictionary containing followed account name and ID.
+    Returns: a dictionary containing followed account name and ID, see
+             account_entry().
+
+    """
+    return {account['acct']: account_entry(account) for account in follow_list}
 
+def account_entry(account):
+    """
+    Returns the fields of an account object from the API that Baraag DL keeps:
+    name and ID, plus the number of posts and the date of the latest one,
+    which account_unchanged() compares with the previous sync.
+    
+    Takes 1 argument:
+    
+    account = an account dictionary returned by the API
+              REQUIRED
+    
+    Returns: a dictionary {'account':(str), 'id':(int),
+                           'statuses_count':(int), 'last_status_at':(str)}
     """
-    return {account['acct']: {'account': account['acct'], 'id': account['id']}\
-            for account in follow_list}
+    return {'account': account['acct'],
+            'id': account['id'],
+            'statuses_count': account.get('statuses_count'),
+            'last_status_at': account.get('last_status_at')}
 
 def get_owner_info(client):
     """
@@ -443,355 +1330,3022 @@ def get_owner_info(client):
     following_info = get_following(owner_id)
     following_info = parse_following(following_info)
     
-    return {'id': owner_id, 'following': following_info}
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("INSERT OR REPLACE INTO follow_state (token_hash, owner_id, "
+                   "refreshed_at) VALUES (?, ?, ?)",
+                   (token_hash(client), str(owner_id), time.time()))
+        db.commit()
     
-def get_page(client = client, user_id = None, newest_post = None):
+    return {'id': owner_id, 'following': following_info}
+
+def token_hash(client):
     """
-    Collects a user's posts containing attached media up to a specified
-    post ID. Limited to 40 posts due to Mastodon API, so a "page" contains
-    40 posts.
+    Returns a hash of the access token of a client, identifying the logged-in
+    user in the follow list cache without storing the token itself.
+    """
+    import hashlib
     
-    Use within get_timeline() to iterate over all posts.
+    return hashlib.sha256(str(client.access_token).encode()).hexdigest()
+
+def get_cached_owner_info(client):
+    """
+    Returns the owner information saved by the last get_owner_info() call
+    for the same logged-in user, without any request.
     
-    Takes 3 arguments:
+    Takes 1 argument:
         
     client = Mastodon client object, generated/initialized by initialize()
-             Defaults to client.
              REQUIRED
     
-    user_id = user ID on Baraag (int); mainly derived from ['following']['id']
-              in the dictionary generated by get_owner_info().
-              Defaults to None
-              REQUIRED
-              
-    newest_post = ID of the newest post in the page to fetch. Usually defined
-                  by the pagination in get_timeline().
-                  Defaults to None
-                  OPTIONAL, but then it will only fetch the newest 40 posts.
-                  
-    Returns: an AttribAccessList Mastodon object with 40 AttribAccessDic Mastodon
-             objects (i.e a page with 40 posts)
+    Returns: a dictionary like get_owner_info(), with the additional key
+             'age' (seconds since the follow list was refreshed), or None if
+             nothing was saved.
     """
-    try:    
-        page = client.account_statuses(id=user_id, 
-                                    only_media = True,
-                                    exclude_replies = True,
-                                    limit =  40,
-                                    max_id = newest_post)
+    with state_db_lock:
+        row = get_state_db().execute("SELECT owner_id, refreshed_at FROM "
+                                     "follow_state WHERE token_hash = ?",
+                                     (token_hash(client),)).fetchone()
     
-    except MastodonNetworkError as exc:
-        mastodon_network_error_handler(exc)
-          
-    except MastodonError as exc:
-        mastodon_error_handler(exc) 
+    if row is None:
+        return None
     
-    return page
+    owner_id, refreshed_at = row
+    
+    follow_list = []
+    for url, etag, body, next_url in get_follow_pages(owner_id):
+        follow_list.extend(json.loads(body))
+    
+    return {'id': owner_id,
+            'following': parse_following(follow_list),
+            'age': time.time() - refreshed_at}
+
+def shard_ring(count, replicas = 64):
+    """
+    Returns the consistent hashing ring of count shards used by
+    account_shard(): a sorted list of (point, shard) tuples, with replicas
+    points per shard so the accounts are spread evenly. Only depends on its
+    arguments, so every node builds the same ring.
+    """
+    import hashlib
+    
+    return sorted((int.from_bytes(hashlib.sha256(("shard:"+str(shard)+":"+
+                                                  str(replica)).encode())\
+                                  .digest()[:8], "big"), shard)\
+                  for shard in range(count) for replica in range(replicas))
 
+shard_rings = {}
 
-def get_timeline(client = client, user_id = None):
+def account_shard(account_id, count):
     """
-    Constructs a timeline of a user with a given ID using the posts fetched
-    by get_page(), iterating over the pages based on the last post ID of
-    every page, and stopping once there are no more posts to fetch.
+    Returns the shard (from 0 to count - 1) an account belongs to, by
+    consistent hashing of its ID: the account goes to the shard owning the
+    first point of shard_ring() at or after the hash of the ID. Going from
+    N to N + 1 shards only moves about 1/(N + 1) of the accounts, all of
+    them to the new shard, so the other nodes keep their folders and sync
+    state.
+    """
+    import bisect
+    import hashlib
     
-    Takes 3 arguments:
+    ring = shard_rings.get(count)
+    if ring is None:
+        ring = shard_rings[count] = shard_ring(count)
+    
+    point = int.from_bytes(hashlib.sha256(("account:"+str(account_id)).encode())\
+                           .digest()[:8], "big")
+    
+    return ring[bisect.bisect_left(ring, (point,)) % len(ring)][1]
+
+def shard_accounts(follow_dic, shard):
+    """
+    Returns the accounts of follow_dic handled by one node of a sharded sync,
+    see account_shard().
+    
+    Takes 2 arguments:
+        
+    follow_dic = accounts in the format of get_owner_info()['following']
+                 REQUIRED
+    
+    shard = a tuple (index, count) of the node, with index from 1 to count
+            (see shard_spec()), or None to keep every account
+            REQUIRED
+    
+    Returns: a dictionary in the same format.
+    """
+    if shard is None:
+        return follow_dic
+    
+    index, count = shard
+    
+    return {key: account for key, account in follow_dic.items()\
+            if account_shard(account['id'], count) == index - 1}
+
+def load_follow_list(client, settings):
+    """
+    Returns the accounts followed by the logged-in user, reusing the follow
+    list saved by a previous run when possible:
+        - if it is younger than settings["follow_cache_ttl"] minutes, it is
+          used as is, without any request;
+        - if it is older, it is used right away while get_owner_info()
+          revalidates it in a background thread;
+        - if there is none, get_owner_info() is called directly.
+    
+    Only the accounts of the shard in settings["shard"] (if present, see
+    shard_accounts()) are returned, by the refresh too.
     
+    Takes 2 arguments:
+        
     client = Mastodon client object, generated/initialized by initialize()
-             Defaults to client.
              REQUIRED
-             
-    user_id = user ID on Baraag (int); mainly derived from ['following']['id']
-              in the dictionary generated by get_owner_info().
-              Defaults to None
-              REQUIRED
-
-    Returns: a list containing all AttribAccessList Mastodon objects fetched
-             by get_page().
+    
+    settings = dictionary of settings, created by ffmpeg_init()
+               REQUIRED
+    
+    Returns: a tuple (follow_dic, refresh): the followed accounts in the format
+             of get_owner_info()['following'], and a Future returning the
+             refreshed get_owner_info() result, or None if the list was not
+             stale. See process_new_follows().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    shard = settings.get("shard")
+    
+    def refresh_owner_info():
+        owner_info = get_owner_info(client)
+        return dict(owner_info, following = shard_accounts(owner_info['following'],
+                                                           shard))
+    
+    cached = get_cached_owner_info(client)
+    
+    if cached is None:
+        return refresh_owner_info()['following'], None
+    
+    if cached['age'] < settings["follow_cache_ttl"] * 60:
+        print("Using the follow list saved "+str(int(cached['age'] // 60))+
+              " minute(s) ago.")
+        return shard_accounts(cached['following'], shard), None
+    
+    print("Refreshing the follow list in the background...")
+    
+    refresh_pool = ThreadPoolExecutor(max_workers = 1)
+    refresh = refresh_pool.submit(refresh_owner_info)
+    refresh_pool.shutdown(wait = False)
+    
+    return shard_accounts(cached['following'], shard), refresh
 
+def process_new_follows(client, settings, follow_dic, refresh):
     """
-    timeline = []
+    Waits for the background refresh started by load_follow_list() and
+    processes the accounts followed since the saved follow list was made,
+    which process_following_user() did not get, and the ones that posted
+    since (which account_unchanged() may have skipped).
     
-    newest_post = None
+    Takes 4 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             REQUIRED
+    
+    settings = dictionary of settings, created by ffmpeg_init()
+               REQUIRED
     
-    page = get_page(client, user_id, newest_post)
+    follow_dic = the accounts already processed, as returned by
+                 load_follow_list()
+                 REQUIRED
     
-    counter = 0
+    refresh = the Future returned by load_follow_list(), or None
+              REQUIRED
     
-    while len(page) != 0:
-        timeline.append(page)
-        newest_post = page[-1]['id']
-        page = get_page(client, user_id, newest_post)
-        counter +=1
-        print("Fetching page "+str(counter)+"; Last post of page: "+str(newest_post))
+    Returns: a tuple (failed attachments, failed accounts), see
+             process_following_user().
+    """
+    if refresh is None:
+        return 0, 0
+    
+    following = refresh.result()['following']
+    new_follows = {key: value for key, value in following.items()\
+                   if key not in follow_dic or value != follow_dic[key]}
+    
+    if not new_follows:
+        return 0, 0
+    
+    print(Fore.YELLOW+"Processing "+str(len(new_follows))+" newly followed or "\
+          "updated account(s)"+Fore.RESET)
     print()
     
-    return timeline
+    return process_following_user(client, settings, new_follows)
+    
+def get_state_db():
+    """
+    Opens the sync state database (baraag_dl.db in the root folder of the
+    script), creating it and its tables on first use. The connection is kept
+    in the global state_db so it is only opened once per run, and shared by
+    all threads under state_db_lock.
+    
+    Takes no arguments.
+    
+    Returns: an sqlite3 connection object.
+    """
+    global state_db
+    
+    with state_db_lock:
+        if state_db is None:
+            # Shared by all threads, every access goes through state_db_lock
+            # Several processes (e.g. the shards of a sharded sync) may
+            # share the database, so wait for their writes to finish
+            state_db = sqlite3.connect(state_db_file, timeout = 30,
+                                       check_same_thread = False)
+            state_db.execute("PRAGMA journal_mode = WAL")
+            state_db.execute("PRAGMA synchronous = NORMAL")
+            state_db.execute("CREATE TABLE IF NOT EXISTS sync_state ("
+                             "account_id TEXT PRIMARY KEY, "
+                             "account TEXT, "
+                             "newest_post INTEGER, "
+                             "last_sync TEXT, "
+                             "statuses_count INTEGER, "
+                             "last_status_at TEXT)")
+            # Columns added after the table was first released
+            columns = {row[1] for row in state_db.execute("PRAGMA "
+                                                          "table_info(sync_state)")}
+            for column, column_type in (("statuses_count", "INTEGER"),
+                                        ("last_status_at", "TEXT")):
+                if column not in columns:
+                    state_db.execute("ALTER TABLE sync_state ADD COLUMN "+
+                                     column+" "+column_type)
+            state_db.execute("CREATE TABLE IF NOT EXISTS probe_cache ("
+                             "url TEXT PRIMARY KEY, "
+                             "extension TEXT, "
+                             "probed_at TEXT)")
+            state_db.execute("CREATE TABLE IF NOT EXISTS manifest ("
+                             "account_id TEXT, "
+                             "post_id TEXT, "
+                             "attachment_id TEXT, "
+                             "url TEXT, "
+                             "filename TEXT, "
+                             "size INTEGER, "
+                             "sha256 TEXT, "
+                             "posted_at TEXT, "
+                             "downloaded_at TEXT, "
+                             "PRIMARY KEY (account_id, post_id, attachment_id))")
+            state_db.execute("CREATE INDEX IF NOT EXISTS manifest_url "
+                             "ON manifest (url)")
+            state_db.execute("CREATE TABLE IF NOT EXISTS content ("
+                             "sha256 TEXT PRIMARY KEY, "
+                             "path TEXT, "
+                             "size INTEGER)")
+            state_db.execute("CREATE TABLE IF NOT EXISTS conversions ("
+                             "input_sha256 TEXT, "
+                             "output_format TEXT, "
+                             "settings_key TEXT, "
+                             "output_path TEXT, "
+                             "output_size INTEGER, "
+                             "converted_at TEXT, "
+                             "PRIMARY KEY (input_sha256, output_format, "
+                             "settings_key, output_path))")
+            state_db.execute("CREATE TABLE IF NOT EXISTS follow_state ("
+                             "token_hash TEXT PRIMARY KEY, "
+                             "owner_id TEXT, "
+                             "refreshed_at REAL)")
+            state_db.execute("CREATE TABLE IF NOT EXISTS follow_pages ("
+                             "owner_id TEXT, "
+                             "position INTEGER, "
+                             "url TEXT, "
+                             "etag TEXT, "
+                             "body TEXT, "
+                             "next_url TEXT, "
+                             "PRIMARY KEY (owner_id, position))")
+            state_db.execute("CREATE TABLE IF NOT EXISTS home_state ("
+                             "token_hash TEXT PRIMARY KEY, "
+                             "newest_post INTEGER, "
+                             "last_sync TEXT)")
+            state_db.commit()
+    
+    return state_db
 
-def get_attachment_data(timeline):
+def get_sync_state(account_id):
     """
-    Generates a dictionary of all post IDs, media attachment IDs and file URLs
-    in a timeline generated by get_timeline(), and assigns each attachment a
-    local filename for saving to disk.
+    Returns the ID of the newest post already processed for a given account,
+    as recorded by set_sync_state() at the end of the previous run.
     
-    It takes 1 argument:
+    Takes 1 argument:
         
-    timeline = a list containing all AttribAccessList Mastodon objects fetched
-               by get_page(), generated by get_timeline().
-               REQUIRED
-               
-    Returns: a dictionary containing all media attachments, segregated by post
-             ID: { post_id: { 'media': 
-                             { attachment_id : { 'id': (int), 
-                                               'url': (str), 
-                                               'filename':(str) }
-                              }}}
+    account_id = user ID on Baraag (int)
+                 REQUIRED
+    
+    Returns: the newest post ID (int), or None if the account was never synced.
     """
-    attachment_dic = {}
+    with state_db_lock:
+        row = get_state_db().execute("SELECT newest_post FROM sync_state "
+                                     "WHERE account_id = ?",
+                                     (str(account_id),)).fetchone()
+    if row is None:
+        return None
+    else:
+        return row[0]
+
+def set_sync_state(account_id, account_name, newest_post):
+    """
+    Records the newest post ID processed for a given account (its "high-water
+    mark"), so the next run only needs to fetch posts newer than it.
     
-    for page in timeline:
-        for subpage in page:
-            date = str(subpage['created_at']).split()[0]
-            post_id = str(subpage['id'])
-            attachment_account = subpage["account"]["acct"]
-            attachment_dic[post_id] = {}
-            attachment_dic[post_id]['id'] = post_id
-            attachment_dic[post_id]['media'] = {}
-            
-            attachments = subpage['media_attachments']
-            
-            for attachment in attachments:
-                attachment_id = str(attachment['id'])
-                if "media_proxy" in attachment['url']:
-                    attachment_url = attachment['remote_url'].split('?')[0]
-                else:
-                    attachment_url = attachment['url']
-                
-                extension = "." + attachment_url.split(".")[-1]
-                
-                if "com" in extension or "/" in extension:
-                    print("Extension could not be inferred for attachment "+ \
-                          attachment_id+" from post "+post_id+".")
-                    print("Possible redirect url...")
-                    print()
-                    print("Temporarily fetching file to infer filetype...")
-                    
-                    try:
-                        problem_file = requests.get(attachment_url)
-                        file_header = problem_file.headers
-                        if "Content-Disposition" not in file_header.keys():
-                            print()
-                            print(Fore.RED+"File not found!"+Fore.RESET)
-                            print()
-                            logging.error("Post "+attachment_id+" from account "
-                                         +attachment_account+" with URL "+
-                                         attachment_url+
-                                         " returned invalid content: "+
-                                         str(file_header))
-                            print("Skipping...")
-                            continue
-                        else:                                         
-                            extension = "."+file_header['Content-Disposition']\
-                                .split(".")[-1].strip('\"')
-                            print()
-                            print("Extension inferred from HTTP response: "+extension[1:])
-                            print()
-                    
-                    except Exception as exc:
-                        logging.exception(str(exc))
-                        print()
-                        print(Fore.RED+"Failed to infer file type!"+Fore.RESET)
-                        print()
-                        print("Skipping...")
-                        continue
-                
-                else:
-                    pass
-                
-                filename = "_".join([date, post_id, attachment_id])+extension
-                
-                attachment_dic[post_id]['media'][attachment_id] = {}
-                
-                attachment_dic[post_id]['media'][attachment_id]['id'] = attachment_id
-                
-                attachment_dic[post_id]['media'][attachment_id]['url'] = attachment_url
-                
-                attachment_dic[post_id]['media'][attachment_id]['filename'] = filename
+    Only call this once every attachment of the account has been processed,
+    otherwise posts that failed to download would never be fetched again.
     
-    return attachment_dic
+    Takes 3 arguments:
+        
+    account_id = user ID on Baraag (int)
+                 REQUIRED
+    
+    account_name = account name (str), stored for reference only.
+                   REQUIRED
+    
+    newest_post = ID of the newest post processed (int)
+                  REQUIRED
+    
+    Returns nothing.
+    """
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("INSERT OR IGNORE INTO sync_state (account_id) VALUES (?)",
+                   (str(account_id),))
+        db.execute("UPDATE sync_state SET account = ?, newest_post = ?, "
+                   "last_sync = ? WHERE account_id = ?",
+                   (account_name, int(newest_post),
+                    datetime.now().isoformat(timespec = "seconds"),
+                    str(account_id)))
+        db.commit()
 
-def download_file(file, folder):
+def set_account_activity(account):
     """
-    Downloads the specified file to the specified folder.
+    Records the post count and latest post date of an account, as listed in
+    the follow list when it was synced, for account_unchanged().
     
-    Takes 2 arguments:
+    Like set_sync_state(), only call this once every attachment of the account
+    has been processed.
+    
+    Takes 1 argument:
         
-    file = an attachment in dictionary form {attachment_id: { 'id': (int), 
-                                                              'url': (str), 
-                                                              'filename':(str)
-                                                              }} ,
-            existing in the larger dictionary generated by 
-            get_attachment_data().
-            REQUIRED
+    account = a followed account dictionary, see account_entry()
+              REQUIRED
     
-    folder = the folder name where the attachment will be downloaded, usually 
-             defined by process_following_user() at runtime.
-             REQUIRED.
-             
-    Returns nothing, saves specified attachment to a file with the specified
-    filename in the specified folder.
+    Returns nothing.
     """
-    url = file['url']
-    filename = file['filename']
-    rel_path = folder+file['filename']
-    file_id = file['id']
+    if account.get('statuses_count') is None:
+        return
     
-    if os.path.isfile(rel_path):
-        print("File "+filename+" already exists in folder "+folder[:-1]+". Skipping...")
-    else:
-        with requests.get(url, stream = True) as request:
-            try:
-                with open(rel_path, 'wb') as output_file:
-                    for chunk in request.iter_content(chunk_size=None):
-                        output_file.write(chunk)
-                print("Downloaded "+file_id+" to "+filename)
-                
-            except Exception as exc:
-                logging.exception(str(exc))
-                print()
-                print(Fore.RED+"HTTP request failed. Please check error logs."+Fore.RESET)
-                sys.exit()
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("INSERT OR IGNORE INTO sync_state (account_id) VALUES (?)",
+                   (str(account['id']),))
+        db.execute("UPDATE sync_state SET account = ?, statuses_count = ?, "
+                   "last_status_at = ?, "
+                   "last_sync = ? WHERE account_id = ?",
+                   (account['account'], account['statuses_count'],
+                    account['last_status_at'],
+                    datetime.now().isoformat(timespec = "seconds"),
+                    str(account['id'])))
+        db.commit()
 
-def sanitize(string):
+def account_unchanged(account):
     """
-    Sanitizes a given string to remove potentially problematic characters.
-    Used mainly to sanitize account names so they can be used as part of folder
-    names. 
+    Checks whether an account posted nothing since its last complete sync,
+    by comparing the post count and latest post date from the follow list
+    with the ones recorded by set_account_activity(), so it can be skipped
+    without fetching its timeline.
     
-    This is admittedly a horrible implementation and might be rewritten in 
-    later releases.
+    The values are only as recent as the follow list (see load_follow_list()),
+    and accounts without them (e.g. chosen with search_user()) are never
+    skipped.
     
     Takes 1 argument:
         
-    string = a string to be sanitized, usually the account name of a followed
-             account to process when saving files to disk.
-             REQUIRED
-             
-    Returns: the input string with the offending characters replaced by an
-             underscore.
+    account = a followed account dictionary, see account_entry()
+              REQUIRED
+    
+    Returns: True if the account can be skipped, False otherwise.
+    """
+    if account.get('statuses_count') is None:
+        return False
+    
+    with state_db_lock:
+        row = get_state_db().execute("SELECT statuses_count, last_status_at "
+                                     "FROM sync_state WHERE account_id = ?",
+                                     (str(account['id']),)).fetchone()
+    
+    return row is not None and row[0] is not None and\
+        row == (account['statuses_count'], account['last_status_at'])
 
+def is_synced(account_id):
     """
-    bad_chars = ['^', '@', '%','$', '?', ':', '<', '>', '\\', '*', '|', '"'," "]
-    sanitized_chars = []
+    Checks whether an account was ever synced completely, i.e. whether
+    set_sync_state() or set_account_activity() recorded it, even if it has
+    no post with attachments.
+    """
+    with state_db_lock:
+        row = get_state_db().execute("SELECT 1 FROM sync_state WHERE "
+                                     "account_id = ?",
+                                     (str(account_id),)).fetchone()
+    return row is not None
+
+def home_state_key(client, shard = None):
+    """
+    Returns the key of the home timeline checkpoint of the logged-in user in
+    the home_state table: the token hash (see token_hash()), followed by
+    the shard for a sharded sync, as every shard completes its syncs on its
+    own.
+    """
+    if shard is None:
+        return token_hash(client)
     
-    for char in string:
-        if char in bad_chars:
-            sanitized_chars.append("_")
-        else:
-            sanitized_chars.append(char)
-            
-    sanitized_string = "".join(sanitized_chars)
+    return token_hash(client)+":"+str(shard[0])+"/"+str(shard[1])
 
-    return sanitized_string 
+def get_home_checkpoint(client, shard = None):
+    """
+    Returns the ID of the newest post of the home timeline of the logged-in
+    user when the last complete sync of every followed account (of a shard,
+    see shard_accounts()) started, as recorded by set_home_checkpoint(), or
+    None.
+    """
+    with state_db_lock:
+        row = get_state_db().execute("SELECT newest_post FROM home_state "
+                                     "WHERE token_hash = ?",
+                                     (home_state_key(client, shard),)).fetchone()
+    if row is None:
+        return None
+    else:
+        return row[0]
 
-def process_following_user(client, settings, follow_dic):
+def set_home_checkpoint(client, newest_post, shard = None):
     """
-    Goes over every account followed by an user, collects all posts with 
-    media attachments, and downloads them to disk in folders according to
-    account name and user ID. Additionally, converts MP4 attachments if
-    ffmpeg is enabled in the settings (from config.ini, passed as argument)
+    Records the home timeline checkpoint read by get_home_checkpoint(). Only
+    call this once every followed account (of the shard) was synced without
+    failures.
+    """
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("INSERT OR REPLACE INTO home_state (token_hash, newest_post, "
+                   "last_sync) VALUES (?, ?, ?)",
+                   (home_state_key(client, shard), int(newest_post),
+                    datetime.now().isoformat(timespec = "seconds")))
+        db.commit()
+
+def get_manifest_entries(account_id):
+    """
+    Returns the attachments of an account recorded in the download manifest,
+    in a single query, so process_account() can skip them without checking
+    the disk file by file.
     
-    Requires get_timeline(), get_attachment_data() and download_file() to
-    operate.
+    Takes 1 argument:
+        
+    account_id = user ID on Baraag (int)
+                 REQUIRED
+    
+    Returns: a set of (post_id, attachment_id) tuples (str).
+    """
+    with state_db_lock:
+        rows = get_state_db().execute("SELECT post_id, attachment_id "
+                                      "FROM manifest WHERE account_id = ?",
+                                      (str(account_id),)).fetchall()
+    return set(rows)
+
+def record_download(file, size, sha256 = None):
+    """
+    Records a downloaded (or already existing) attachment in the download
+    manifest.
     
     Takes 3 arguments:
         
-    client = Mastodon client object, generated/initialized by initialize()
-             Defaults to client.
+    file = an Attachment object, generated by iter_attachments()
+           REQUIRED
+    
+    size = size of the file on disk, in bytes (int)
+           REQUIRED
+    
+    sha256 = SHA-256 hex digest of the file (str)
+             Defaults to None (unknown, e.g. files found on disk)
+             OPTIONAL
+    
+    Returns nothing.
+    """
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("INSERT OR REPLACE INTO manifest "
+                   "(account_id, post_id, attachment_id, url, filename, size, "
+                   "sha256, posted_at, downloaded_at) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (str(file.account_id), file.post_id, file.id,
+                    file.url, file.filename, size, sha256, file.date,
+                    datetime.now().isoformat(timespec = "seconds")))
+        db.commit()
+
+def link_file(source, destination):
+    """
+    Replaces destination (if it exists) with a hardlink to source, through a
+    temporary name so destination is never missing or half-written.
+    
+    Takes 2 arguments:
+        
+    source = path of the existing file (str)
              REQUIRED
-             
-    settings = dictionary of conversion settings, created by ffmpeg_validate()
     
-    follow_dic = a dictionary of followed account names and IDs in the format
-                 {account_name (str): {'account':(str),'id':(int)}.
-                  
-                  Obtained from the ['following'] key of the dictionary
-                  returned by get_owner_info(), or alternatively from
-                  search_user().
+    destination = path of the link to create (str)
+                  REQUIRED
+    
+    Returns: True if the link was created, False if the filesystem does not
+             support it (e.g. source and destination on different drives).
+    """
+    temp_path = destination+".link"
+    
+    try:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        os.link(source, temp_path)
+        os.replace(temp_path, destination)
+        return True
+    
+    except OSError as exc:
+        logging.warning("Unable to link "+destination+" to "+source+": "+str(exc))
+        return False
 
-    Returns nothing, saves all media attachments to disk and converts them if
-    conversion is enabled.
+def get_content_path(sha256, size):
     """
-    total_number = len(follow_dic.keys())
+    Looks up the file stored for a given content hash in the deduplication
+    index, discarding the entry if that file no longer exists or changed.
     
-    current_number = 1
+    Takes 2 arguments:
+        
+    sha256 = SHA-256 hex digest of the content (str)
+             REQUIRED
     
-    for key in follow_dic.keys():
-        account = follow_dic[key]
-        account_name = account['account']
-        account_id = account['id']
-        account_folder_name = sanitize(account_name)+"_"+str(account_id)
-              
-        print("Processing user "+str(current_number)+"/"+str(total_number)+":")
-        print("Account: "+account_name)
-        print("ID: "+str(account_id)+"\n")
-        print("Processing posts: \n")
+    size = size of the content in bytes (int)
+           REQUIRED
+    
+    Returns: the path of the stored file (str), or None.
+    """
+    with state_db_lock:
+        db = get_state_db()
+        row = db.execute("SELECT path, size FROM content WHERE sha256 = ?",
+                         (sha256,)).fetchone()
         
-        timeline = get_timeline(client, account_id)
+        if row is None:
+            return None
         
-        media = get_attachment_data(timeline)
-             
-        if os.name == "posix":
-            folder_path = account_folder_name+"/"
-        else:
-            folder_path = account_folder_name+"\\"
-              
-        if not os.path.isdir(account_folder_name):
-            os.makedirs(account_folder_name)
-        else:
-            pass
-                
-        for post in media.keys():
-            post = media[post]['media']
-            for file in post.keys():
-                file = post[file]
-                extension = file["filename"].split(".")[-1]
-                download_file(file, folder_path)
-                if extension == "mp4" and settings["use_ffmpeg"]:
-                    video_convert(settings, file, folder_path)
-                else:
-                    pass
+        path, stored_size = row
         
-        current_number +=1
+        if stored_size == size and os.path.isfile(path) and \
+           os.path.getsize(path) == size:
+            return path
         
-        print()
+        db.execute("DELETE FROM content WHERE sha256 = ?", (sha256,))
+        db.commit()
+    
+    return None
 
-def search_user(client):
+def deduplicate_file(path, sha256, size):
     """
-    Searches Baraag for an account, defined by the user.
-
-    Takes 1 arguments:
+    Stores each distinct file content only once: if the same content (by
+    SHA-256) was already downloaded to another folder, the file at path is
+    replaced with a hardlink to it. Otherwise path becomes the stored copy of
+    that content in the deduplication index.
+    
+    Takes 3 arguments:
         
-    client = Mastodon client object, generated/initialized by initialize()
-             Defaults to client.
+    path = path of the file just downloaded (str)
+           REQUIRED
+    
+    sha256 = SHA-256 hex digest of the file (str)
              REQUIRED
-             
-             
-    Returns a dictionary with the info of the user from which media should be
-    downloaded, in the format {account_name (str): {'account':(str),'id':(int)}.         
+    
+    size = size of the file in bytes (int)
+           REQUIRED
+    
+    Returns: True if the file was replaced with a link, False otherwise.
     """
-    results = []
-    while not results:
+    stored_path = get_content_path(sha256, size)
     
-        try:
-            username = input("Please type in username to search (Ctrl+C to exit): ")
-            results = client.account_search(username)
-            if not results:
-                print(Fore.RED+"User not found!"+Fore.RESET+" Please try again!")
-            
-        except MastodonNetworkError as exc:
-            mastodon_network_error_handler(exc)
-              
-        except MastodonError as exc:
+    if stored_path is not None:
+        if os.path.samefile(stored_path, path):
+            return False
+        return link_file(stored_path, path)
+    
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("INSERT OR REPLACE INTO content (sha256, path, size) "
+                   "VALUES (?, ?, ?)", (sha256, path, size))
+        db.commit()
+    
+    return False
+
+def is_known_url(url):
+    """
+    Returns True if a file was already downloaded from a given URL (for any
+    account), i.e. link_known_url() can link it instead of downloading it.
+    """
+    with state_db_lock:
+        row = get_state_db().execute("SELECT 1 FROM manifest WHERE url = ? "
+                                     "AND sha256 IS NOT NULL LIMIT 1",
+                                     (url,)).fetchone()
+    return row is not None
+
+def get_average_sizes():
+    """
+    Returns the average size of the files in the download manifest for each
+    extension, used by plan_account() to estimate the size of files.
+    
+    Takes no arguments.
+    
+    Returns: a dictionary {extension (str): average size in bytes (int)}.
+    """
+    totals = {}
+    
+    with state_db_lock:
+        rows = get_state_db().execute("SELECT filename, size FROM manifest "
+                                      "WHERE size IS NOT NULL").fetchall()
+    
+    for filename, size in rows:
+        extension = os.path.splitext(filename)[1]
+        count, total = totals.get(extension, (0, 0))
+        totals[extension] = (count + 1, total + size)
+    
+    return {extension: total // count\
+            for extension, (count, total) in totals.items()}
+
+def link_known_url(file, folder):
+    """
+    Avoids downloading an attachment again when the same URL was already
+    downloaded for another account (e.g. the same media posted on several
+    accounts): the new file is created as a hardlink to the stored copy.
+    
+    Takes 2 arguments:
+        
+    file = an Attachment object, generated by iter_attachments()
+           REQUIRED
+    
+    folder = the folder name where the attachment should be saved
+             REQUIRED
+    
+    Returns: True if the file was linked (file.size and file.sha256 are
+             set), False if it still needs to be downloaded.
+    """
+    rel_path = folder+file.filename
+    
+    if os.path.isfile(rel_path):
+        return False
+    
+    with state_db_lock:
+        row = get_state_db().execute("SELECT sha256, size FROM manifest "
+                                     "WHERE url = ? AND sha256 IS NOT NULL "
+                                     "LIMIT 1", (file.url,)).fetchone()
+    if row is None:
+        return False
+    
+    sha256, size = row
+    stored_path = get_content_path(sha256, size)
+    
+    if stored_path is None or not link_file(stored_path, rel_path):
+        return False
+    
+    file.size = size
+    file.sha256 = sha256
+    print("Linked "+file.id+" to "+file.filename+" (already downloaded"\
+          " as "+stored_path+")")
+    
+    return True
+
+def manifest_stats():
+    """
+    Summarizes the download manifest.
+    
+    Takes no arguments.
+    
+    Returns: a dictionary {'accounts': [(account_name, files, bytes)],
+                           'days': [(date, files, bytes)],
+                           'duplicates': bytes of duplicated content (int)}
+             with accounts sorted by size and days by date (date of download).
+    """
+    with state_db_lock:
+        db = get_state_db()
+        accounts = db.execute("SELECT COALESCE(s.account, m.account_id), "
+                              "COUNT(*), COALESCE(SUM(m.size), 0) "
+                              "FROM manifest m LEFT JOIN sync_state s "
+                              "ON s.account_id = m.account_id "
+                              "GROUP BY m.account_id "
+                              "ORDER BY SUM(m.size) DESC").fetchall()
+        days = db.execute("SELECT substr(downloaded_at, 1, 10), COUNT(*), "
+                          "COALESCE(SUM(size), 0) FROM manifest "
+                          "GROUP BY substr(downloaded_at, 1, 10) "
+                          "ORDER BY 1").fetchall()
+    
+        duplicates = db.execute("SELECT COALESCE(SUM(size), 0) - "
+                                "(SELECT COALESCE(SUM(size), 0) FROM "
+                                "(SELECT MAX(size) AS size FROM manifest "
+                                "WHERE sha256 IS NOT NULL GROUP BY sha256)) "
+                                "FROM manifest WHERE sha256 IS NOT NULL"
+                                ).fetchone()[0]
+    
+    return {'accounts': accounts, 'days': days, 'duplicates': duplicates}
+
+def print_stats():
+    """
+    Prints the summary from manifest_stats(): files and bytes downloaded per
+    account and per day.
+    
+    Takes no arguments and returns nothing.
+    """
+    stats = manifest_stats()
+    
+    print("Files downloaded per account:\n")
+    for account, files, size in stats['accounts']:
+        print(account.ljust(40)+str(files).rjust(8)+" files "+
+              str(round(size/1048576, 1)).rjust(10)+" MB")
+    
+    print("\nFiles downloaded per day:\n")
+    for day, files, size in stats['days']:
+        print(day.ljust(40)+str(files).rjust(8)+" files "+
+              str(round(size/1048576, 1)).rjust(10)+" MB")
+    
+    print("\nDuplicated content: "+str(round(stats['duplicates']/1048576, 1))+
+          " MB (stored once when deduplicate = True)")
+
+def sync_status():
+    """
+    Summarizes the sync state of every account, for the status command
+    (e.g. to be checked by monitoring scripts). Only reads baraag_dl.db.
+    
+    Takes no arguments.
+    
+    Returns: a dictionary {'version': (str),
+                           'files': total files downloaded (int),
+                           'bytes': total bytes downloaded (int),
+                           'last_download': date and time (str) or None,
+                           'accounts': [{'account_id': (str),
+                                         'account': (str),
+                                         'newest_post': (int),
+                                         'last_sync': (str),
+                                         'files': (int),
+                                         'bytes': (int),
+                                         'last_download': (str)}]}
+    """
+    with state_db_lock:
+        db = get_state_db()
+        rows = db.execute("SELECT s.account_id, s.account, s.newest_post, "
+                          "s.last_sync, COUNT(m.post_id), "
+                          "COALESCE(SUM(m.size), 0), MAX(m.downloaded_at) "
+                          "FROM sync_state s LEFT JOIN manifest m "
+                          "ON m.account_id = s.account_id "
+                          "GROUP BY s.account_id ORDER BY s.account").fetchall()
+        files, size, last_download = db.execute("SELECT COUNT(*), "
+                                                "COALESCE(SUM(size), 0), "
+                                                "MAX(downloaded_at) "
+                                                "FROM manifest").fetchone()
+    
+    keys = ('account_id', 'account', 'newest_post', 'last_sync', 'files',
+            'bytes', 'last_download')
+    
+    return {'version': baraag_dl_version,
+            'files': files,
+            'bytes': size,
+            'last_download': last_download,
+            'accounts': [dict(zip(keys, row)) for row in rows]}
+
+def print_status(as_json = False):
+    """
+    Prints the summary from sync_status(), as a table or as JSON.
+    
+    Takes 1 argument:
+        
+    as_json = whether to print JSON (bool)
+              Defaults to False
+              OPTIONAL
+    
+    Returns nothing.
+    """
+    status = sync_status()
+    
+    if as_json:
+        print(json.dumps(status, indent = 2))
+        return
+    
+    print("Baraag DL "+status['version'])
+    print(str(status['files'])+" files, "+
+          str(round(status['bytes']/1048576, 1))+" MB downloaded; last "\
+          "download: "+str(status['last_download']))
+    print()
+    print("Account".ljust(40)+"Newest post".rjust(20)+"Last sync".rjust(21)+
+          "Files".rjust(8))
+    for account in status['accounts']:
+        print(str(account['account'])[:39].ljust(40)+
+              str(account['newest_post']).rjust(20)+
+              str(account['last_sync']).rjust(21)+
+              str(account['files']).rjust(8))
+
+def get_page(client = client, user_id = None, newest_post = None, last_synced_post = None):
+    """
+    Collects a user's posts containing attached media up to a specified
+    post ID. Limited to 40 posts due to Mastodon API, so a "page" contains
+    40 posts.
+    
+    Use within get_timeline() to iterate over all posts.
+    
+    Takes 4 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             Defaults to client.
+             REQUIRED
+    
+    user_id = user ID on Baraag (int); mainly derived from ['following']['id']
+              in the dictionary generated by get_owner_info().
+              Defaults to None
+              REQUIRED
+              
+    newest_post = ID of the newest post in the page to fetch. Usually defined
+                  by the pagination in get_timeline().
+                  Defaults to None
+                  OPTIONAL, but then it will only fetch the newest 40 posts.
+    
+    last_synced_post = ID of the newest post fetched in a previous run, as
+                       returned by get_sync_state(). Only posts newer than it
+                       are returned.
+                       Defaults to None
+                       OPTIONAL
+                  
+    Returns: an AttribAccessList Mastodon object with 40 AttribAccessDic Mastodon
+             objects (i.e a page with 40 posts)
+    """
+    try:
+        page = client.account_statuses(id=user_id, 
+                                    only_media = True,
+                                    exclude_replies = True,
+                                    limit =  40,
+                                    max_id = newest_post,
+                                    since_id = last_synced_post)
+    
+    except MastodonNetworkError as exc:
+        mastodon_network_error_handler(exc)
+          
+    except MastodonError as exc:
+        mastodon_error_handler(exc) 
+    
+    return page
+
+
+def get_timeline(client = client, user_id = None, last_synced_post = None,
+                 account_name = None):
+    """
+    Constructs a timeline of a user with a given ID using the posts fetched
+    by get_page(), iterating over the pages based on the last post ID of
+    every page, and stopping once there are no more posts to fetch.
+    
+    This is a generator: each page is yielded as soon as it is fetched, so
+    attachments can be extracted and downloaded while later pages are still
+    being fetched, and pages do not stay in memory once processed.
+    
+    If last_synced_post is given, only posts newer than it are fetched, and
+    pagination stops as soon as a page reaches it.
+    
+    Takes 4 arguments:
+    
+    client = Mastodon client object, generated/initialized by initialize()
+             Defaults to client.
+             REQUIRED
+             
+    user_id = user ID on Baraag (int); mainly derived from ['following']['id']
+              in the dictionary generated by get_owner_info().
+              Defaults to None
+              REQUIRED
+    
+    last_synced_post = ID of the newest post fetched in a previous run, as
+                       returned by get_sync_state().
+                       Defaults to None (fetches the whole timeline)
+                       OPTIONAL
+    
+    account_name = account name (str), used to label progress messages when
+                   several timelines are fetched at once.
+                   Defaults to None
+                   OPTIONAL
+
+    Yields: the posts fetched by get_page(), as lists of Post objects (see
+            parse_post()), one page at a time. Use list() to collect the
+            whole timeline.
+
+    """
+    newest_post = None
+    
+    # Posts are parsed right away, so the API payloads are not kept
+    
+    page = [parse_post(status) for status in get_page(client, user_id, newest_post,
+                                                      last_synced_post)]
+    
+    counter = 0
+    
+    if account_name is None:
+        label = ""
+    else:
+        label = "["+account_name+"] "
+    
+    while len(page) != 0:
+        newest_post = page[-1].id
+        counter +=1
+        metrics.inc("pages_fetched_total")
+        metrics.inc("posts_fetched_total", len(page))
+        print(label+"Fetching page "+str(counter)+"; Last post of page: "+str(newest_post))
+        yield page
+        if last_synced_post is not None and \
+           (len(page) < 40 or int(newest_post) <= int(last_synced_post)):
+            # Reached posts already fetched in a previous run
+            break
+        page = [parse_post(status) for status in get_page(client, user_id,
+                                                          newest_post,
+                                                          last_synced_post)]
+    
+    if account_name is None:
+        print()
+    else:
+        print(label+"Done, "+str(counter)+" page(s) fetched.")
+
+def get_home_page(client, newest_post = None):
+    """
+    Returns a page of 40 posts of the home timeline of the logged-in user,
+    older than newest_post if given. Like get_page(), for
+    get_home_attachments().
+    """
+    try:
+        page = client.timeline_home(limit = 40, max_id = newest_post)
+    
+    except MastodonNetworkError as exc:
+        mastodon_network_error_handler(exc)
+          
+    except MastodonError as exc:
+        mastodon_error_handler(exc) 
+    
+    return page
+
+def followed_media_post(status, follows):
+    """
+    Returns the followed account that published a post, if the post has
+    attachments, was posted (not boosted) by a followed account and is not a
+    reply to someone else, i.e. if get_page() would return it for that
+    account. Used to pick posts out of the home timeline.
+    
+    Takes 2 arguments:
+        
+    status = a post dictionary returned by the API
+             REQUIRED
+    
+    follows = the followed accounts, in the format of account_entry(), keyed
+              by account ID (str)
+              REQUIRED
+    
+    Returns: the account dictionary, or None.
+    """
+    account = follows.get(str(status['account']['id']))
+    
+    if account is None or status.get('reblog') or \
+       not status.get('media_attachments'):
+        return None
+    
+    if status.get('in_reply_to_account_id') not in (None, status['account']['id']):
+        return None
+    
+    return account
+
+def get_home_attachments(client, follow_dic, checkpoint):
+    """
+    Walks the home timeline of the logged-in user back to a checkpoint (see
+    get_home_checkpoint()) and collects the attachments of the posts of
+    followed accounts, so accounts synced before do not need a timeline
+    crawl each: a few pages of the home timeline replace one request per
+    account.
+    
+    Mastodon only keeps the latest few hundred posts of a home timeline, and
+    none for users who have not logged in for a while, so the walk may end
+    before reaching the checkpoint. Posts in between could then be missing,
+    and the caller has to crawl the accounts instead.
+    
+    Takes 3 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             REQUIRED
+    
+    follow_dic = the followed accounts, as returned by load_follow_list()
+                 REQUIRED
+    
+    checkpoint = ID of the newest post already covered (int)
+                 REQUIRED
+    
+    Returns: a tuple (attachments, newest_post, covered): the attachments
+             (see iter_attachments()) of every followed account, in lists
+             keyed by account ID (str), the ID of the newest post of the home
+             timeline (int or None) and whether the walk reached the
+             checkpoint (bool).
+    """
+    follows = {str(account['id']): account for account in follow_dic.values()}
+    attachments = {account_id: [] for account_id in follows}
+    newest_post = None
+    page = get_home_page(client)
+    counter = 0
+    
+    while len(page) != 0:
+        counter += 1
+        metrics.inc("pages_fetched_total")
+        metrics.inc("posts_fetched_total", len(page))
+        print("Fetching home timeline page "+str(counter)+"; Last post of page: "+
+              str(page[-1]['id']))
+        
+        if newest_post is None:
+            newest_post = int(page[0]['id'])
+        
+        posts = [parse_post(status) for status in page\
+                 if int(status['id']) > checkpoint\
+                 and followed_media_post(status, follows) is not None]
+        
+        for file in iter_attachments([posts]):
+            attachments[file.account_id].append(file)
+        
+        if int(page[-1]['id']) <= checkpoint:
+            return attachments, newest_post, True
+        
+        page = get_home_page(client, page[-1]['id'])
+    
+    return attachments, newest_post, False
+
+class Post:
+    """
+    A post with attachments, reduced to what Baraag DL needs to name and
+    download its files. Created by parse_post() as soon as a page is fetched,
+    so the API payloads (account objects, HTML content, emojis, cards...) are
+    freed right away instead of being kept until every attachment is
+    downloaded.
+    
+    Attributes: id (str), account (str), account_id (str), date (str,
+    YYYY-MM-DD) and attachments (a tuple of Attachment objects).
+    """
+    __slots__ = ("id", "account", "account_id", "date", "attachments")
+    
+    def __init__(self, post_id, account, account_id, date):
+        self.id = post_id
+        self.account = account
+        self.account_id = account_id
+        self.date = date
+        self.attachments = ()
+
+class Attachment:
+    """
+    A media attachment of a Post, with the local filename assigned by
+    parse_post().
+    
+    Attributes: post (the Post), id (str), url (str), extension (str, with
+    the dot; empty if unknown), needs_probe (bool; the extension is unknown,
+    see resolve_attachment()), size_hint (estimated size in bytes, int or
+    None) and, once downloaded, size (int) and sha256 (str or None). The
+    post_id, account, account_id and date properties are read from the post,
+    and the filename property is built from them when needed.
+    """
+    __slots__ = ("post", "id", "url", "extension", "needs_probe", "size_hint",
+                 "size", "sha256")
+    
+    def __init__(self, post, attachment_id, url, extension, needs_probe, size_hint):
+        self.post = post
+        self.id = attachment_id
+        self.url = url
+        self.extension = extension
+        self.needs_probe = needs_probe
+        self.size_hint = size_hint
+        self.size = None
+        self.sha256 = None
+    
+    @property
+    def post_id(self):
+        return self.post.id
+    
+    @property
+    def account(self):
+        return self.post.account
+    
+    @property
+    def account_id(self):
+        return self.post.account_id
+    
+    @property
+    def date(self):
+        return self.post.date
+    
+    @property
+    def filename(self):
+        return "_".join([self.post.date, self.post.id, self.id])+self.extension
+
+def parse_post(status):
+    """
+    Takes a post returned by the API and returns a Post holding only the
+    fields needed to download its attachments, assigning each attachment a
+    local filename for saving to disk ({date}_{post ID}_{attachment ID}).
+    
+    Account names, IDs and dates repeat across posts, so they are interned
+    and shared by every post of an account instead of stored once per post.
+    
+    It takes 1 argument:
+        
+    status = a post dictionary returned by the API (e.g. by get_page())
+             REQUIRED
+    
+    Attachments whose extension cannot be inferred from their URL and is not
+    in the probe cache get needs_probe set to True and no extension in their
+    filename; see resolve_attachment().
+    
+    Returns: a Post object.
+    """
+    date = sys.intern(str(status['created_at']).split()[0])
+    post_id = str(status['id'])
+    
+    post = Post(post_id, sys.intern(status["account"]["acct"]),
+                sys.intern(str(status["account"]["id"])), date)
+    
+    attachments = []
+    
+    for attachment in status['media_attachments']:
+        attachment_id = str(attachment['id'])
+        if "media_proxy" in attachment['url']:
+            attachment_url = attachment['remote_url'].split('?')[0]
+        else:
+            attachment_url = attachment['url']
+        
+        extension = "." + attachment_url.split(".")[-1]
+        needs_probe = False
+        
+        if "com" in extension or "/" in extension:
+            # Possible redirect url, the extension is looked up in
+            # the probe cache or probed later by the download pool
+            extension = get_cached_probe(attachment_url)
+            if extension is None:
+                extension = ""
+                needs_probe = True
+        
+        else:
+            pass
+        
+        # Videos usually come with their duration and bitrate, which
+        # gives their size without requesting the file
+        
+        original = (attachment.get('meta') or {}).get('original') or {}
+        if original.get('duration') and original.get('bitrate'):
+            size_hint = int(original['duration'] * original['bitrate'] / 8)
+        else:
+            size_hint = None
+        
+        attachments.append(Attachment(post, attachment_id, attachment_url,
+                                      sys.intern(extension), needs_probe,
+                                      size_hint))
+    
+    post.attachments = tuple(attachments)
+    
+    return post
+
+def iter_attachments(timeline):
+    """
+    Goes over all posts in a timeline generated by get_timeline() and yields
+    their media attachments one by one.
+    
+    Pages are consumed lazily, so when given the get_timeline() generator
+    directly only the current page is kept in memory.
+    
+    It takes 1 argument:
+        
+    timeline = an iterable of pages (lists) of Post objects, generated by
+               get_timeline() or parse_post().
+               REQUIRED
+    
+    Yields: Attachment objects, see parse_post().
+    """
+    for page in timeline:
+        for post in page:
+            metrics.inc("attachments_found_total", len(post.attachments))
+            yield from post.attachments
+
+def get_attachment_data(timeline, max_probes = 8):
+    """
+    Collects all posts with media attachments in a timeline generated by
+    get_timeline(), as a dictionary keyed by post ID.
+    
+    Collects everything yielded by iter_attachments() in memory; the download
+    loop uses iter_attachments() directly instead. Attachments whose extension
+    has to be probed are probed concurrently, and left out if the server
+    answers with invalid content. Attachments whose probe failed (e.g. a
+    network error) are kept, with needs_probe still True, as a sync would
+    try to download them.
+    
+    It takes 2 arguments:
+        
+    timeline = an iterable of pages (lists) of Post objects, generated by
+               get_timeline().
+               REQUIRED
+    
+    max_probes = maximum number of concurrent probes (int)
+                 Defaults to 8
+                 OPTIONAL
+               
+    Returns: a dictionary containing all posts with attachments, segregated by
+             post ID: { post_id (str): Post }, the attachments with invalid
+             content being left out of Post.attachments.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def probe(file):
+        try:
+            return resolve_attachment(file)
+        except Exception:
+            return True
+    
+    attachment_dic = {}
+    
+    files = list(iter_attachments(timeline))
+    
+    # Probe attachments with unknown extensions concurrently
+    
+    to_probe = [file for file in files if file.needs_probe]
+    
+    if to_probe:
+        with ThreadPoolExecutor(max_workers = max_probes) as probe_pool:
+            resolved = list(probe_pool.map(probe, to_probe))
+    else:
+        resolved = []
+    
+    unresolved = {file for file, ok in zip(to_probe, resolved) if not ok}
+    
+    for file in files:
+        attachment_dic[file.post_id] = file.post
+    
+    for post in attachment_dic.values():
+        if any(file in unresolved for file in post.attachments):
+            post.attachments = tuple(file for file in post.attachments\
+                                     if file not in unresolved)
+    
+    return attachment_dic
+
+def get_cached_probe(url):
+    """
+    Returns the extension previously inferred by probe_extension() for a
+    given URL, or None if the URL was never probed.
+    """
+    with state_db_lock:
+        row = get_state_db().execute("SELECT extension FROM probe_cache "
+                                     "WHERE url = ?", (url,)).fetchone()
+    if row is None:
+        return None
+    else:
+        return row[0]
+
+def sniff_extension(headers, first_bytes = b""):
+    """
+    Infers a file extension from HTTP response headers (Content-Disposition,
+    then Content-Type) or, failing that, from the first bytes of the file.
+    
+    Takes 2 arguments:
+        
+    headers = HTTP response headers (dictionary-like)
+              REQUIRED
+    
+    first_bytes = the first bytes of the file (bytes)
+                  Defaults to b""
+                  OPTIONAL
+    
+    Returns: the extension with a leading dot (str), or None.
+    """
+    disposition = headers.get("Content-Disposition", "")
+    match = re.search(r'filename="?([^";]+)"?', disposition)
+    if match:
+        extension = os.path.splitext(match.group(1))[1]
+        if extension:
+            return extension.lower()
+    
+    content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type in content_types:
+        return content_types[content_type]
+    
+    for signature, extension in file_signatures:
+        if first_bytes.startswith(signature):
+            return extension
+    
+    if first_bytes[8:12] == b"WEBP":
+        return ".webp"
+    
+    if first_bytes[4:8] == b"ftyp":
+        if first_bytes[8:12] in (b"avif", b"avis"):
+            return ".avif"
+        elif first_bytes[8:10] == b"qt":
+            return ".mov"
+        else:
+            return ".mp4"
+    
+    return None
+
+def probe_extension(url):
+    """
+    Infers the extension of a file from its URL without downloading it.
+    
+    Tries a HEAD request first; if the server does not support it or its
+    headers are inconclusive, requests only the first bytes of the file with
+    a Range GET and sniffs its signature. Results are saved to the probe
+    cache in baraag_dl.db, so a URL is only ever probed once.
+    
+    Takes 1 argument:
+        
+    url = URL of the file (str)
+          REQUIRED
+    
+    Returns: the extension with a leading dot (str), or None if it could not
+             be inferred.
+    """
+    extension = get_cached_probe(url)
+    
+    if extension is not None:
+        metrics.inc("probes_total", method = "cache")
+        return extension
+    
+    session = get_session()
+    
+    metrics.inc("probes_total", method = "head")
+    response = session.head(url, allow_redirects = True)
+    if response.ok:
+        extension = sniff_extension(response.headers)
+    
+    if extension is None:
+        metrics.inc("probes_total", method = "range")
+        with session.get(url, headers = {"Range": "bytes=0-31"},
+                         stream = True) as response:
+            response.raise_for_status()
+            first_bytes = response.raw.read(32)
+            extension = sniff_extension(response.headers, first_bytes)
+    
+    if extension is not None:
+        with state_db_lock:
+            db = get_state_db()
+            db.execute("INSERT OR REPLACE INTO probe_cache "
+                       "(url, extension, probed_at) VALUES (?, ?, ?)",
+                       (url, extension,
+                        datetime.now().isoformat(timespec = "seconds")))
+            db.commit()
+    
+    return extension
+
+def resolve_attachment(file):
+    """
+    Completes the filename of an attachment whose extension could not be
+    inferred from its URL (file.needs_probe is True), using
+    probe_extension(). Does nothing for other attachments.
+    
+    Takes 1 argument:
+        
+    file = an Attachment object, generated by iter_attachments()
+           REQUIRED
+    
+    Returns: True if the attachment has a usable filename, False if the
+             server answered but its file type could not be inferred (the
+             error is logged).
+    
+    Errors while probing (network errors, timeouts, HTTP errors) are raised,
+    so the attachment counts as failed and is tried again, instead of being
+    skipped for good.
+    """
+    if not file.needs_probe:
+        return True
+    
+    print("Extension could not be inferred for attachment "+file.id+
+          " from post "+file.post_id+". Probing...")
+    
+    try:
+        extension = probe_extension(file.url)
+    except Exception as exc:
+        logging.exception(str(exc))
+        print(Fore.RED+"Failed to infer file type for attachment "+
+              file.id+"!"+Fore.RESET)
+        raise
+    
+    if extension is None:
+        logging.error("Post "+file.post_id+" from account "+
+                      file.account+" with URL "+file.url+
+                      " returned invalid content")
+        print(Fore.RED+"File not found for attachment "+file.id+"!"+
+              Fore.RESET+" Skipping...")
+        return False
+    
+    print("Extension inferred from HTTP response: "+extension[1:])
+    
+    file.extension = extension
+    file.needs_probe = False
+    
+    return True
+
+
+def download_file(file, folder):
+    """
+    Downloads the specified file to the specified folder.
+    
+    Takes 2 arguments:
+        
+    file = an Attachment object (with its id, url and filename), generated
+           by parse_post().
+           REQUIRED
+    
+    folder = the folder name where the attachment will be downloaded, usually 
+             defined by process_following_user() at runtime.
+             REQUIRED.
+             
+    The file is first written to "<filename>.part" and only renamed to its
+    final name once its size matches the one announced by the server, so an
+    interrupted download never looks finished. An existing .part file is
+    resumed with an HTTP Range request instead of starting over.
+             
+    The size of the file and its SHA-256 digest (computed while the file
+    streams to disk) are stored in file.size and file.sha256.
+             
+    Returns: a string, "downloaded" or "skipped" if the file already exists.
+             Saves specified attachment to a file with the specified filename
+             in the specified folder.
+             
+    Raises an exception if the download fails, so it can be collected by
+    download_attachments() without stopping the other downloads.
+    """
+    import hashlib
+    
+    url = file.url
+    filename = file.filename
+    rel_path = folder+file.filename
+    part_path = rel_path+".part"
+    file_id = file.id
+    
+    if os.path.isfile(rel_path):
+        print("File "+filename+" already exists in folder "+folder[:-1]+". Skipping...")
+        file.size = os.path.getsize(rel_path)
+        file.sha256 = None
+        return "skipped"
+    
+    # Resume a previous interrupted download if there is one
+    
+    if os.path.isfile(part_path):
+        offset = os.path.getsize(part_path)
+    else:
+        offset = 0
+    
+    # Compressed transfers would make Range offsets and Content-Length
+    # refer to different bytes than the ones written to disk
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = "bytes="+str(offset)+"-"
+    
+    start = time.perf_counter()
+    
+    with get_session().get(url, headers = headers, stream = True) as request:
+        if request.status_code == 416:
+            # The .part file already holds the whole file
+            total_size = request.headers.get("Content-Range", "").split("/")[-1]
+            if total_size.isdigit() and int(total_size) == offset:
+                file.size = offset
+                file.sha256 = hash_file(part_path).hexdigest()
+                os.replace(part_path, rel_path)
+                print("Downloaded "+file_id+" to "+filename)
+                return "downloaded"
+            else:
+                os.remove(part_path)
+                raise IOError("Invalid partial download "+part_path+
+                              " for "+url+", removed")
+        
+        request.raise_for_status()
+        
+        if request.status_code == 206:
+            mode = 'ab'
+            total_size = request.headers.get("Content-Range", "").split("/")[-1]
+            sha256 = hash_file(part_path)
+            print("Resuming "+file_id+" from byte "+str(offset))
+        else:
+            # Range not requested or not supported, start over
+            mode = 'wb'
+            offset = 0
+            total_size = request.headers.get("Content-Length", "")
+            sha256 = hashlib.sha256()
+        
+        # The file is hashed while it streams to disk
+        
+        with open(part_path, mode) as output_file:
+            for chunk in request.iter_content(chunk_size=None):
+                output_file.write(chunk)
+                sha256.update(chunk)
+    
+    size = os.path.getsize(part_path)
+    
+    metrics.inc("download_bytes_total", size - offset)
+    metrics.observe("download_seconds", time.perf_counter() - start)
+    
+    if total_size.isdigit() and size != int(total_size):
+        raise IOError("Incomplete download of "+url+": got "+str(size)+
+                      " of "+total_size+" bytes, kept "+part_path+
+                      " to resume later")
+    
+    file.size = size
+    file.sha256 = sha256.hexdigest()
+    
+    os.replace(part_path, rel_path)
+    print("Downloaded "+file_id+" to "+filename)
+    return "downloaded"
+
+def hash_file(path, sha256 = None):
+    """
+    Computes the SHA-256 digest of a file on disk, reading it in chunks.
+    
+    Takes 2 arguments:
+        
+    path = path of the file (str)
+           REQUIRED
+    
+    sha256 = a hashlib sha256 object to update
+             Defaults to None (a new one is created)
+             OPTIONAL
+    
+    Returns: the hashlib sha256 object, which can be updated further.
+    """
+    import hashlib
+    
+    if sha256 is None:
+        sha256 = hashlib.sha256()
+    
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1048576), b""):
+            sha256.update(chunk)
+    
+    return sha256
+
+class HostScheduler:
+    """
+    Enforces the per-host download limit (settings["max_downloads_per_host"])
+    of the shared download pool without blocking its threads: a job only goes
+    to the pool while fewer than limit jobs for its host are running there.
+    The others wait in a queue per host and are handed over, in order, as the
+    running ones finish. Pool threads are thus never parked waiting for a
+    busy host, and jobs for other hosts go ahead of its queue.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.waiting = {}
+    
+    def submit(self, pool, url, limit, function, *args):
+        """
+        Runs function(*args) on a ThreadPoolExecutor (pool) once the host of
+        url has fewer than limit jobs running.
+        
+        Returns: a concurrent.futures.Future object for the result.
+        """
+        from concurrent.futures import Future
+        
+        future = Future()
+        job = (pool, future, function, args)
+        host = urlsplit(url).netloc
+        
+        with self.lock:
+            if self.running.get(host, 0) >= limit:
+                self.waiting.setdefault(host, collections.deque()).append(job)
+                return future
+            self.running[host] = self.running.get(host, 0) + 1
+        
+        self.start(host, job)
+        return future
+    
+    def start(self, host, job):
+        pool, future, function, args = job
+        
+        try:
+            pool.submit(self.run, host, job)
+        except Exception as exc:
+            # The pool was shut down
+            self.finish(host)
+            future.set_exception(exc)
+    
+    def run(self, host, job):
+        pool, future, function, args = job
+        
+        if not future.set_running_or_notify_cancel():
+            self.finish(host)
+            return
+        
+        try:
+            result = function(*args)
+        except BaseException as exc:
+            self.finish(host)
+            future.set_exception(exc)
+        else:
+            self.finish(host)
+            future.set_result(result)
+    
+    def finish(self, host):
+        """
+        Frees the slot of a finished job, handing it to the next job waiting
+        for the same host, if any.
+        """
+        with self.lock:
+            queue = self.waiting.get(host)
+            if queue:
+                job = queue.popleft()
+                if not queue:
+                    del self.waiting[host]
+            else:
+                job = None
+                self.running[host] -= 1
+                if not self.running[host]:
+                    del self.running[host]
+        
+        if job is not None:
+            self.start(host, job)
+
+host_scheduler = HostScheduler()
+
+def download_task(file, folder, settings):
+    """
+    Runs download_file(), probing the file's extension first if needed (see
+    resolve_attachment()). The file is recorded in the download manifest
+    (see record_download()).
+    
+    If settings["deduplicate"] is True, content already stored in another
+    folder is hardlinked instead of kept twice (see link_known_url() and
+    deduplicate_file()). Submitted to the download pool by
+    download_attachments() within the per-host download limit (see
+    HostScheduler), so probes run concurrently too.
+    
+    Takes 3 arguments:
+        
+    file = an Attachment object, see download_file()
+           REQUIRED
+    
+    folder = the folder name where the attachment will be downloaded
+             REQUIRED
+    
+    settings = dictionary of settings, created by ffmpeg_validate()
+               REQUIRED
+    
+    Returns: the return value of download_file(), "linked", or "skipped"
+             if the attachment has invalid content. Errors, probe errors
+             included, are raised (see DownloadBatch.done()).
+    """
+    if not resolve_attachment(file):
+        status = "skipped"
+    
+    elif settings["deduplicate"] and link_known_url(file, folder):
+        status = "linked"
+        record_download(file, file.size, file.sha256)
+    
+    else:
+        status = download_file(file, folder)
+        if status == "downloaded" and settings["deduplicate"]:
+            if deduplicate_file(folder+file.filename, file.sha256,
+                                file.size):
+                print("Replaced "+file.filename+" with a link to an "\
+                      "identical file")
+        record_download(file, file.size, file.sha256)
+    
+    return status
+
+class DownloadBatch:
+    """
+    Tracks the downloads of one account submitted to the shared download pool.
+    
+    Results are tallied by a callback as each download finishes, so futures
+    are not kept around, and submit() blocks while too many downloads of the
+    account are waiting in the pool. Together this keeps memory flat no matter
+    how many attachments an account has.
+    
+    Finished MP4 downloads are handed to a ConversionQueue, if one is given.
+    """
+    def __init__(self, pool, max_pending, conversions = None):
+        self.pool = pool
+        self.max_pending = max_pending
+        self.conversions = conversions
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.results = {'downloaded': 0, 'linked': 0, 'skipped': 0,
+                        'failed': []}
+    
+    def submit(self, file, folder, settings):
+        with self.condition:
+            while self.pending >= self.max_pending:
+                self.condition.wait()
+            self.pending += 1
+        
+        # Submitted within the per-host download limit
+        future = host_scheduler.submit(self.pool, file.url,
+                                       settings["max_downloads_per_host"],
+                                       download_task, file, folder, settings)
+        future.add_done_callback(lambda future: self.done(future, file, folder))
+    
+    def done(self, future, file, folder):
+        try:
+            status = future.result()
+        except Exception as exc:
+            logging.error("Download of attachment "+file.id+" from URL "+
+                          file.url+" failed: "+repr(exc))
+            print(Fore.RED+"Download of "+file.filename+" failed. Please "\
+                  "check error logs."+Fore.RESET)
+            status = None
+        
+        if status is not None and self.conversions is not None and \
+           file.filename.split(".")[-1] == "mp4":
+            self.conversions.submit(file, folder)
+        
+        metrics.inc("attachments_total", result = status or "failed")
+        
+        with self.condition:
+            if status is None:
+                self.results['failed'].append(file)
+            else:
+                self.results[status] += 1
+            self.pending -= 1
+            self.condition.notify_all()
+    
+    def wait(self):
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+        return self.results
+
+def download_attachments(pool, settings, attachments, folder, known = frozenset(),
+                         conversions = None):
+    """
+    Downloads attachments concurrently, using a pool of download threads
+    shared by all accounts. Downloads start as soon as each attachment is
+    yielded, so given iter_attachments() over the get_timeline() generator
+    the first files download while later pages are still being fetched.
+    MP4 files are queued for conversion as soon as their download finishes.
+    
+    A failed download does not stop the others: errors are logged and the
+    failed attachments are returned.
+    
+    Takes 4 arguments:
+        
+    pool = a ThreadPoolExecutor object, created by process_following_user()
+           with settings["max_downloads"] threads.
+           REQUIRED
+    
+    settings = dictionary of settings, created by ffmpeg_validate()
+               REQUIRED
+    
+    attachments = an iterable of Attachment objects, generated by
+                  iter_attachments()
+                  REQUIRED
+    
+    folder = the folder name where the attachments will be downloaded
+             REQUIRED
+    
+    known = a set of (post_id, attachment_id) tuples already in the download
+            manifest, generated by get_manifest_entries(). These attachments
+            are skipped without checking the disk.
+            Defaults to an empty set
+            OPTIONAL
+    
+    conversions = a ConversionQueue object, to which MP4 files are handed
+                  once downloaded.
+                  Defaults to None (no conversion)
+                  OPTIONAL
+    
+    Returns: a dictionary {'downloaded': (int), 'linked': (int),
+                           'skipped': (int),
+                           'failed': [Attachment objects],
+                           'newest_post': ID of the newest post (str) or None}
+    """
+    batch = DownloadBatch(pool, settings["max_downloads"] * 2, conversions)
+    
+    newest_post = None
+    
+    skipped = 0
+    
+    try:
+        for file in attachments:
+            if newest_post is None or int(file.post_id) > int(newest_post):
+                newest_post = file.post_id
+            if (file.post_id, file.id) in known:
+                skipped += 1
+            else:
+                batch.submit(file, folder, settings)
+    
+    finally:
+        # If fetching the timeline failed, the downloads already submitted
+        # still finish before the error goes up
+        results = batch.wait()
+    results['skipped'] += skipped
+    if skipped:
+        metrics.inc("attachments_total", skipped, result = "known")
+    results['newest_post'] = newest_post
+    
+    return results
+
+def sanitize(string):
+    """
+    Sanitizes a given string to remove potentially problematic characters.
+    Used mainly to sanitize account names so they can be used as part of folder
+    names. 
+    
+    This is admittedly a horrible implementation and might be rewritten in 
+    later releases.
+    
+    Takes 1 argument:
+        
+    string = a string to be sanitized, usually the account name of a followed
+             account to process when saving files to disk.
+             REQUIRED
+             
+    Returns: the input string with the offending characters replaced by an
+             underscore.
+
+    """
+    bad_chars = ['^', '@', '%','$', '?', ':', '<', '>', '\\', '*', '|', '"'," "]
+    sanitized_chars = []
+    
+    for char in string:
+        if char in bad_chars:
+            sanitized_chars.append("_")
+        else:
+            sanitized_chars.append(char)
+            
+    sanitized_string = "".join(sanitized_chars)
+
+    return sanitized_string 
+
+def process_following_user(client, settings, follow_dic, home_attachments = None):
+    """
+    Goes over every account followed by an user, collects all posts with 
+    media attachments, and downloads them to disk in folders according to
+    account name and user ID. Additionally, converts MP4 attachments if
+    ffmpeg is enabled in the settings (from config.ini, passed as argument)
+    
+    Requires get_timeline(), iter_attachments() and download_file() to
+    operate.
+    
+    Takes 4 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             Defaults to client.
+             REQUIRED
+             
+    settings = dictionary of conversion settings, created by ffmpeg_validate().
+               If settings["full_rescan"] is True, the whole timeline of every
+               account is fetched again instead of only the posts newer than
+               the ones recorded by set_sync_state(). If
+               settings["output_root"] is set, account folders are created
+               in it.
+    
+    follow_dic = a dictionary of followed account names and IDs in the format
+                 {account_name (str): {'account':(str),'id':(int)}.
+                  
+                  Obtained from the ['following'] key of the dictionary
+                  returned by get_owner_info(), or alternatively from
+                  search_user().
+    
+    home_attachments = attachments of the accounts collected from the home
+                       timeline, as returned by get_home_attachments(); the
+                       timeline of the accounts in it is not fetched.
+                       Defaults to None
+                       OPTIONAL
+
+    Up to settings["max_crawlers"] accounts are processed at once (see
+    process_account()). Downloads start while timelines are still being
+    fetched and run concurrently (see download_attachments()), up to
+    settings["max_downloads"] at a time and settings["max_downloads_per_host"]
+    per host.
+
+    MP4 conversions run on a separate ConversionQueue while downloads go on,
+    and their results are reported once all accounts are done. The ffmpeg
+    executable must have been looked for already (see ffmpeg_status()).
+
+    A failure (a download, or an account whose timeline could not be
+    fetched) does not stop the run: the account is tried again once every
+    other account is done, see retry_accounts().
+
+    Returns: a tuple (failed attachments, failed accounts): the number of
+             attachments that failed to download or convert, and the number
+             of accounts whose posts could not be fetched, even after the
+             retry (int, int). Saves all media attachments to disk and
+             converts them if conversion is enabled.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    total_number = len(follow_dic.keys())
+    
+    failed_total = 0
+    failed_accounts = 0
+    
+    pool = ThreadPoolExecutor(max_workers = settings["max_downloads"])
+    
+    crawl_pool = ThreadPoolExecutor(max_workers = settings["max_crawlers"])
+    
+    if settings["use_ffmpeg"]:
+        conversions = ConversionQueue(settings)
+    else:
+        conversions = None
+    
+    print("Processing "+str(settings["max_crawlers"])+" accounts at a time...\n")
+    
+    if home_attachments is None:
+        home_attachments = {}
+    
+    # Accounts with failures are queued here and tried again at the end of
+    # the run (see retry_accounts())
+    
+    retries = []
+    
+    accounts = [crawl_pool.submit(process_account, client, settings, pool,
+                                  follow_dic[key], number + 1, total_number,
+                                  conversions,
+                                  home_attachments.get(str(follow_dic[key]['id'])),
+                                  retries)\
+                for number, key in enumerate(follow_dic.keys())]
+    
+    for account in as_completed(accounts):
+        account.result()
+    
+    crawl_pool.shutdown()
+    
+    if retries:
+        failed_total, failed_accounts = retry_accounts(client, settings, pool,
+                                                       retries, conversions)
+    
+    pool.shutdown()
+    
+    print()
+    
+    if conversions is not None:
+        print("Waiting for conversions to finish...")
+        failed_total += conversions.finish()
+        print()
+    
+    return failed_total, failed_accounts
+
+def process_following_home(client, settings, follow_dic):
+    """
+    Syncs every account followed by the logged-in user like
+    process_following_user(), but takes the new posts of the accounts synced
+    before from the home timeline, walked back to the checkpoint of the last
+    complete sync (see get_home_attachments()), instead of fetching each
+    timeline. Accounts never synced are still crawled (initial backfill).
+    
+    Every account is crawled instead if settings["home_timeline_sync"] is
+    False, a full rescan was requested, there is no checkpoint yet or the
+    home timeline does not go back to it.
+    
+    Takes 3 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             REQUIRED
+    
+    settings = dictionary of settings, created by ffmpeg_init() or
+               command_settings()
+               REQUIRED
+    
+    follow_dic = the followed accounts, as returned by load_follow_list()
+                 REQUIRED
+    
+    Returns: a tuple (failed attachments, failed accounts), see
+             process_following_user().
+    """
+    if not settings["home_timeline_sync"] or settings.get("full_rescan"):
+        return process_following_user(client, settings, follow_dic)
+    
+    checkpoint = get_home_checkpoint(client, settings.get("shard"))
+    home_attachments = None
+    
+    if checkpoint is None:
+        # The checkpoint is taken before crawling, so posts published during
+        # the crawl are fetched from the home timeline next time
+        page = get_home_page(client)
+        newest_post = int(page[0]['id']) if page else None
+    
+    else:
+        print("Fetching the home timeline back to the last sync...")
+        home_attachments, newest_post, covered = get_home_attachments(client,
+                                                                      follow_dic,
+                                                                      checkpoint)
+        print()
+        
+        if not covered:
+            print(Fore.YELLOW+"The home timeline does not go back to the last "\
+                  "sync. Fetching the timeline of every account instead."+
+                  Fore.RESET)
+            print()
+            home_attachments = None
+        
+        else:
+            # Accounts never synced completely are crawled
+            home_attachments = {account_id: files for account_id, files\
+                                in home_attachments.items()\
+                                if is_synced(account_id)}
+            metrics.inc("home_timeline_accounts_total", len(home_attachments))
+    
+    failed = process_following_user(client, settings, follow_dic,
+                                    home_attachments)
+    
+    if not any(failed) and newest_post is not None:
+        set_home_checkpoint(client, max(newest_post, checkpoint or 0),
+                            settings.get("shard"))
+    
+    return failed
+
+def process_account(client, settings, pool, account, current_number, total_number,
+                    conversions = None, attachments = None, retries = None):
+    """
+    Fetches the timeline of a followed account, starting from the newest post
+    recorded by set_sync_state() unless a full rescan was requested, and
+    downloads its attachments as the pages come in. Accounts that posted
+    nothing since their last sync are skipped (see account_unchanged()).
+    
+    Submitted to the crawler pool by process_following_user(), so that up to
+    settings["max_crawlers"] accounts are processed at once. All crawlers share
+    the rate-limit budget of api_rate_limiter (through the HTTP session) and
+    the download pool.
+    
+    Takes 9 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             REQUIRED
+    
+    settings = dictionary of settings, created by ffmpeg_validate()
+               REQUIRED
+    
+    pool = the download ThreadPoolExecutor object, see download_attachments()
+           REQUIRED
+    
+    account = a followed account dictionary {'account':(str),'id':(int)}
+              REQUIRED
+    
+    current_number, total_number = position of the account in the list of
+                                   accounts to process (int), for progress
+                                   messages.
+                                   REQUIRED
+    
+    conversions = a ConversionQueue object for MP4 files, see
+                  download_attachments()
+                  Defaults to None (no conversion)
+                  OPTIONAL
+    
+    attachments = attachments of the account found in the home timeline
+                  since the last sync (see get_home_attachments()), processed
+                  instead of fetching the timeline.
+                  Defaults to None (the timeline is fetched)
+                  OPTIONAL
+    
+    retries = a list to which the account is added if its timeline cannot be
+              fetched or some downloads fail, as a tuple (account, failed
+              Attachment objects or None if the timeline failed,
+              last_synced_post, newest_post); see retry_accounts().
+              Defaults to None (failures are only counted)
+              OPTIONAL
+    
+    Returns: a tuple (failed attachments, failed accounts): the number of
+             attachments that failed to download, and 1 if the posts of the
+             account could not be fetched, 0 otherwise (int, int).
+    """
+    account_name = account['account']
+    account_id = account['id']
+    label = "["+account_name+"] "
+    
+    print(label+"Processing user "+str(current_number)+"/"+str(total_number)+
+          " (ID: "+str(account_id)+")")
+    
+    if attachments is None and not settings.get("full_rescan") and \
+       account_unchanged(account):
+        print(label+"No new posts since the last sync. Skipping...")
+        metrics.inc("accounts_skipped_total")
+        return 0
+    
+    if settings.get("full_rescan"):
+        last_synced_post = None
+    else:
+        last_synced_post = get_sync_state(account_id)
+        
+    if last_synced_post is not None and attachments is None:
+        print(label+"Fetching posts newer than "+str(last_synced_post))
+         
+    folder_path = get_account_folder(settings, account_name, account_id)
+          
+    if not os.path.isdir(folder_path):
+        os.makedirs(folder_path)
+    else:
+        pass
+    
+    # Attachments already in the manifest are skipped without touching the
+    # disk, unless a full rescan was requested
+    
+    if settings.get("full_rescan"):
+        known = set()
+    else:
+        known = get_manifest_entries(account_id)
+    
+    if attachments is None:
+        timeline = get_timeline(client, account_id, last_synced_post, account_name)
+        attachments = iter_attachments(timeline)
+    
+    try:
+        results = download_attachments(pool, settings, attachments, folder_path,
+                                       known, conversions)
+    
+    except APIError:
+        metrics.inc("accounts_failed_total")
+        if retries is None:
+            print(Fore.RED+label+"Could not fetch the posts of the account."+
+                  Fore.RESET)
+        else:
+            print(Fore.YELLOW+label+"Could not fetch the posts of the account. "\
+                  "Retrying at the end of the run."+Fore.RESET)
+            retries.append((account, None, last_synced_post, None))
+        return 0, 1
+    
+    print(label+"Downloaded: "+str(results['downloaded'])+
+          "; Linked: "+str(results['linked'])+
+          "; Skipped: "+str(results['skipped'])+
+          "; Failed: "+str(len(results['failed'])))
+    
+    if results['failed']:
+        if retries is None:
+            print(Fore.YELLOW+label+"Some downloads failed. They will be "\
+                  "retried on the next run."+Fore.RESET)
+        else:
+            print(Fore.YELLOW+label+"Some downloads failed. Retrying at the "\
+                  "end of the run."+Fore.RESET)
+            retries.append((account, results['failed'], last_synced_post,
+                            results['newest_post']))
+    
+    else:
+        record_account_sync(account, last_synced_post, results['newest_post'])
+    
+    return len(results['failed']), 0
+
+def record_account_sync(account, last_synced_post, newest_post):
+    """
+    Records that every attachment of an account up to newest_post was
+    processed (see set_sync_state() and set_account_activity()), so the next
+    run can start from there.
+    """
+    if newest_post is not None and \
+       (last_synced_post is None or int(newest_post) > int(last_synced_post)):
+        set_sync_state(account['id'], account['account'], newest_post)
+    set_account_activity(account)
+
+def retry_accounts(client, settings, pool, retries, conversions = None):
+    """
+    Tries the accounts queued by process_account() again at the end of a run,
+    once open circuits (see CircuitBreaker) can be tried again: the failed
+    downloads are downloaded again, and the accounts whose timeline could
+    not be fetched are processed again. Accounts done without failures this
+    time are recorded as synced; the others are retried on the next run.
+    
+    Takes 5 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             REQUIRED
+    
+    settings = dictionary of settings, created by ffmpeg_validate()
+               REQUIRED
+    
+    pool = the download ThreadPoolExecutor object, see download_attachments()
+           REQUIRED
+    
+    retries = the list filled by process_account()
+              REQUIRED
+    
+    conversions = a ConversionQueue object for MP4 files, see
+                  download_attachments()
+                  Defaults to None (no conversion)
+                  OPTIONAL
+    
+    Returns: a tuple (failed attachments, failed accounts) of the ones that
+             still failed, see process_account().
+    """
+    failed_total = 0
+    failed_accounts = 0
+    
+    print()
+    print(Fore.YELLOW+"Retrying "+str(len(retries))+" account(s) with "\
+          "failures..."+Fore.RESET)
+    print()
+    
+    time.sleep(host_breaker.wait_time())
+    
+    for number, (account, files, last_synced_post, newest_post) in enumerate(retries):
+        metrics.inc("accounts_retried_total")
+        
+        if files is None:
+            failed = process_account(client, settings, pool, account,
+                                     number + 1, len(retries), conversions)
+            failed_total += failed[0]
+            failed_accounts += failed[1]
+            continue
+        
+        label = "["+account['account']+"] "
+        folder_path = get_account_folder(settings, account['account'], account['id'])
+        
+        results = download_attachments(pool, settings, files, folder_path,
+                                       conversions = conversions)
+        
+        print(label+"Retried: "+str(len(files))+
+              "; Failed: "+str(len(results['failed'])))
+        
+        if results['failed']:
+            print(Fore.YELLOW+label+"Some downloads failed again. They will be "\
+                  "retried on the next run."+Fore.RESET)
+            failed_total += len(results['failed'])
+        else:
+            record_account_sync(account, last_synced_post, newest_post)
+    
+    return failed_total, failed_accounts
+
+def get_account_folder(settings, account_name, account_id):
+    """
+    Returns the folder where the attachments of an account are saved, named
+    {Account name}_{Account ID}, with a trailing separator. Account folders
+    are created in settings["output_root"] if given (see run_sync()), in the
+    current folder otherwise.
+    """
+    account_folder_name = os.path.join(settings.get("output_root") or "",
+                                       sanitize(account_name)+"_"+str(account_id))
+    
+    if os.name == "posix":
+        return account_folder_name+"/"
+    else:
+        return account_folder_name+"\\"
+
+def search_user(client):
+    """
+    Searches Baraag for an account, defined by the user.
+
+    Takes 1 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             Defaults to client.
+             REQUIRED
+             
+             
+    Returns a dictionary with the info of the user from which media should be
+    downloaded, in the format {account_name (str): {'account':(str),'id':(int)}.         
+    """
+    results = []
+    while not results:
+    
+        try:
+            username = input("Please type in username to search (Ctrl+C to exit): ")
+            results = client.account_search(username)
+            if not results:
+                print(Fore.RED+"User not found!"+Fore.RESET+" Please try again!")
+            
+        except MastodonNetworkError as exc:
+            mastodon_network_error_handler(exc)
+              
+        except MastodonError as exc:
+            mastodon_error_handler(exc)         
+        
+        except KeyboardInterrupt:
+            print()
+            print(Fore.YELLOW+"Interrupted by user. Exiting..."+Fore.RESET)
+            sys.exit()
+
+    if len(results) > 1:
+        print(str(len(results))+" users found: \n")
+        for number, item in enumerate(results):
+            print(str(number+1) +" "+item['display_name']\
+                  +" URL: "+item['url']
+                  +" ID: "+str(item['id'])+"\n")
+              
+        valid_choices = list(range(1, len(results) + 1))
+        selection = ""
+        
+        while selection not in valid_choices:
+            selection = ""
+            while not selection.isdigit():
+                selection = input("Please pick the user to be used from the list: ")
+            else:
+                selection = int(selection)                
+            
+        selection -=1
+        result_dic = {results[selection]['acct']:\
+                      {'account': results[selection]['acct'],\
+                       'id': results[selection]['id']}}
+        
+    else:   
+        result_dic = {results[0]['acct']:\
+                      {'account': results[0]['acct'],\
+                       'id': results[0]['id']}}
+    
+    return result_dic
+
+def download_following(client, settings):
+    """
+    Routine loop that downloads media from all accounts the user follows.
+    Segregated from main() since v0.014. Requires a setting dictionary as
+    an argument as of v0.02.
+    
+    Takes 2 arguments:
+        
+    client = Mastodon client object, generated/initialized by initialize()
+             Defaults to client.
+             REQUIRED
+    settings = dictionary of conversion settings, created by ffmpeg_validate()
+               REQUIRED
+             
+    Returns nothing, saves files to disk, exits program when done.
+
+    """
+    # Get following list (saved by a previous run if recent enough, see
+    # load_follow_list())
+    
+    follow_list, refresh = load_follow_list(client, settings)
+    follow_number = len(follow_list)
+    
+    # Process followed accounts and start downloads
+    print()
+    print(Fore.YELLOW+"Processing all followed accounts ("+str(follow_number)+" users)"+Fore.RESET)
+    print()
+    process_following_home(client, settings, follow_list)
+    process_new_follows(client, settings, follow_list, refresh)
+    print(Fore.GREEN+"All done!"+Fore.RESET)
+
+def select_menu(logged_in):
+    """
+    Basic selection menu.
+    
+    It takes 1 argument, a boolean generated by validate_login() representing
+    whether the user is logged in or not.
+    
+    It returns a selection number (INT).
+    """
+    
+    print("\nChoose an option:\n")
+    if logged_in:
+        print("1. Download media from all followed accounts")
+        print("2. Search for user to download media from")
+        print("3. Exit\n")
+        
+        valid_choices = [1,2,3]
+        selection = ""
+        
+        try:
+            while selection not in valid_choices:
+                selection = ""
+                while not selection.isdigit():
+                    selection = input("Please choose an option: ")
+    
+                else:
+                    selection = int(selection)  
+            
+        except KeyboardInterrupt:
+            print()
+            print(Fore.YELLOW+"Interrupted by user. Exiting..."+Fore.RESET)
+            sys.exit()
+            
+        return selection
+    
+    else:
+        print("1. Search for user to download media from")
+        print("2. Exit\n")
+        
+        valid_choices = [1,2]
+        selection = ""
+        
+        try:
+            while selection not in valid_choices:
+                selection = ""
+                while not selection.isdigit():
+                    selection = input("Please choose an option: ")
+    
+                else:
+                    selection = int(selection)  
+            
+        except KeyboardInterrupt:
+            print()
+            print(Fore.YELLOW+"Interrupted by user. Exiting..."+Fore.RESET)
+            sys.exit()
+            
+        return selection
+
+def write_ini():
+    """
+    Writes a basic ini file for ffmpeg and download settings in case it does
+    not exist or has invalid contents, using the values in default_settings.
+    
+    Defaults to setting "use_ffmpeg" to False.
+
+    It takes no arguments and returns nothing.    
+    """
+    ini_settings = "\n".join([key+" = "+str(value)\
+                              for key, value in default_settings.items()])
+    
+    with open("config.ini", "w") as ini_file:
+        ini_file.writelines(ini_settings)
+
+def read_ini():
+    """
+    Reads a config.ini present in the base folder of the script.
+    
+    Settings missing from the file (e.g. files created by older versions)
+    take their value from default_settings.
+
+    It takes no arguments.
+    
+    Returns a dictionary with the settings.
+    """
+    with open("config.ini", "r") as ini_file:
+        settings = ini_file.readlines()
+    settings = [x.replace(" ", "").strip().split("=") for x in settings\
+                if x.strip()]
+    
+    settings = {x[0]:x[1] for x in settings}
+    
+    for key, default in default_settings.items():
+        if key not in settings:
+            settings[key] = default
+        
+        elif isinstance(default, bool):
+            if settings[key].lower() == "true":
+                settings[key] = True
+            else:
+                settings[key] = False
+            
+        elif isinstance(default, (int, float)):
+            try:
+                settings[key] = type(default)(settings[key])
+                # max_conversions = 0 means one conversion per CPU core,
+                # follow_cache_ttl = 0 that the follow list is never reused
+                # as is, max_retries = 0 that failed requests are not retried
+                if isinstance(default, int) and \
+                   settings[key] < (0 if key in ("max_conversions",
+                                                 "follow_cache_ttl",
+                                                 "max_retries") else 1):
+                    raise ValueError
+            except ValueError:
+                print(Fore.RED+"Invalid "+key+" value!"+Fore.RESET +
+                      " Resetting to defaults...")
+                print()
+                settings[key] = default
+         
+    return settings
+
+def validate_ini(settings):
+    """
+    Runs a quick validation of the settings in the config.ini file.
+    
+    Returns a boolean of the validity of the file.
+    """
+    valid_options = list(default_settings.keys())
+    
+    if sorted(valid_options) == sorted(list(settings.keys())):
+        return True
+    else:
+        return False
+
+def ffmpeg_init():
+    """
+    Runs an initialization loop for ffmpeg to enable it in case the user so
+    requires and/or it is present in the system.
+    
+    In short, it:
+        1- reads the config.ini file if present
+        2- creates the file if not present/and or file is invalid
+    
+    Returns a dictionary with the data from the config.ini file
+    """
+    if os.path.isfile("config.ini"):
+        print(Fore.GREEN+"Ffmpeg settings file found!"+Fore.RESET)
+        print()
+        print("Reading settings file...")
+        print()
+        try:
+            settings = read_ini()
+            if validate_ini(settings):
+                return settings
+            else:
+                print(Fore.RED+"Settings invalid! Reinitializing settings file"\
+                      "..."+Fore.RESET)
+                print()
+                write_ini()
+                settings = read_ini()
+                return settings
+        except:
+            print(Fore.RED+"Settings invalid! Reinitializing settings file..."
+                  +Fore.RESET)
+            print()
+            print("Creating settings file...")
+            print()
+            write_ini()
+            settings = read_ini()
+            return settings
+    else:
+        print(Fore.RED+"Settings file not found!"+Fore.RESET)
+        print()
+        print("Creating settings file...")
+        print()
+        write_ini()
+        settings = read_ini()
+        return settings
+
+def ffmpeg_validate(settings):
+    """
+    Validates the settings of the config.ini file based on OS and settings
+    in the file.
+    
+    Takes the settings from ffmpeg_init() as a required parameter.
+    
+    Returns the settings dictionary as is if settings are valid, or with
+    ffmpeg turned off (settings["use_ffmpeg"] = False) if settings are invalid
+    or ffmpeg is not present.
+    """
+    current_os = sys.platform
+    settings = settings
+    
+    if settings["ffmpeg_path"] == "System":
+        if current_os == "linux":
+            ffmpeg_path = "/usr/bin/"
+            ffmpeg_exe = "ffmpeg"
+            ffmpeg_full_path = ffmpeg_path + ffmpeg_exe
+            settings["ffmpeg_path"] = ffmpeg_full_path
+        
+        elif current_os == "darwin":
+            ffmpeg_path = ""
+            ffmpeg_exe = "./ffmpeg"
+            ffmpeg_full_path = ffmpeg_path + ffmpeg_exe
+            settings["ffmpeg_path"] = ffmpeg_full_path 
+        
+        else:
+            ffmpeg_path = ""
+            ffmpeg_exe = "ffmpeg.exe"
+            ffmpeg_full_path = ffmpeg_path + ffmpeg_exe
+            settings["ffmpeg_path"] = ffmpeg_full_path          
+    else:
+        pass
+    
+    try: 
+        if os.path.isfile(settings["ffmpeg_path"]):
+            print(Fore.GREEN+"Ffmpeg executable found!"+Fore.RESET)
+            print()
+            return settings
+            
+        else:
+            print(Fore.RED+"Ffmpeg executable not found!"+Fore.RESET)
+            print("Disabling Ffmpeg conversion...")
+            print()
+            settings["use_ffmpeg"] = False
+            return settings
+    except:
+        print(Fore.RED+"Ffmpeg executable not found!"+Fore.RESET)
+        print("Disabling Ffmpeg conversion...")
+        print()
+        settings["use_ffmpeg"] = False
+        return settings
+
+def ffmpeg_status(settings):
+    """
+    Prints whether ffmpeg conversion is enabled. If it is, the ffmpeg
+    executable is looked for first (see ffmpeg_validate()), so conversion is
+    only announced as enabled once the executable was found; it is never
+    looked for when conversion is disabled.
+    
+    Takes the settings from ffmpeg_init() or command_settings() as a
+    required parameter.
+    
+    Returns the settings dictionary, see ffmpeg_validate().
+    """
+    if settings["use_ffmpeg"]:
+        settings = ffmpeg_validate(settings)
+    
+    if settings["use_ffmpeg"]:
+        print(Fore.GREEN+"Ffmpeg conversion enabled."+Fore.RESET)
+    else:
+        print(Fore.YELLOW+"Ffmpeg conversion disabled"+Fore.RESET)
+    print()
+    
+    return settings
+
+def video_convert(settings, file, folder):
+    """
+    Converts a given MP4 file to APNG and GIF depending on the contents of the
+    settings dictionary (derived from config.ini)
+    
+    If settings["single_pass"] is True and both formats are needed, they are
+    produced by a single ffmpeg process (see ffmpeg_arguments()).
+    
+    Conversions are cached by the content of the input and the ffmpeg
+    version and arguments used (see reuse_conversion()), and outputs are
+    written atomically.
+    
+    Usually run by ConversionQueue after download_file(), so conversions do
+    not hold up downloads.
+    
+    Keep in mind "file" here does not mean the actual file on disk, but rather
+    its attachment "metadata" (an Attachment object) generated by parse_post()
+    
+    Takes 3 arguments:
+        settings = settings dictionary returned by ffmpeg_validate(); REQUIRED
+        file = an Attachment object (with its id, url and filename),
+               generated by parse_post().
+               REQUIRED
+        folder = the folder name where the attachment will be downloaded, usually 
+                 defined by process_following_user() at runtime.
+                 REQUIRED.
+    
+    Returns: a list of (format, status) tuples, status being "converted",
+             "skipped" (already converted), "failed" or "over_limit".
+             Generates GIF and APNG files in the same folder as the MP4 file.
+    
+    This is admiteddly a very rudimentary implementation, might revamp in future
+    releases.
+    """
+    import subprocess
+    
+    apng = settings["convert_apng"]
+    gif = settings["convert_gif"]
+    ffmpeg = settings["ffmpeg_path"]
+    size_limit = settings["file_size_limit"]
+    
+    filename = file.filename
+    filename_stem = filename.split(".")[0]
+    input_path = folder + filename
+    
+    results = []
+    
+    # This size is in BYTES, so divide by 1048576 for MB
+    file_size = os.path.getsize(input_path)/1048576
+    
+    if file_size > size_limit:
+        print("File "+filename+" over the filesize limit. Skipping...")
+        results.append(("all", "over_limit"))
+        return results
+    
+    # Conversions are cached by content, so the hash of the input is needed
+    
+    input_hash = file.sha256 or hash_file(input_path).hexdigest()
+    
+    enabled_formats = [output_format for output_format, enabled\
+                       in (("APNG", apng), ("GIF", gif)) if enabled]
+    
+    # In single pass mode both formats come out of a single ffmpeg process,
+    # so the video is only decoded once. The outputs are then only valid as
+    # a pair (see conversion_key()), and both are redone if either is not
+    
+    if settings["single_pass"]:
+        groups = [enabled_formats] if enabled_formats else []
+    else:
+        groups = [[output_format] for output_format in enabled_formats]
+    
+    jobs = []
+    
+    for group in groups:
+        job = {}
+        reused = []
+        
+        for output_format in group:
+            output = filename_stem + "." + output_format.lower()
+            output_path = folder + output
+            job[output_format] = output_path
+            if reuse_conversion(ffmpeg, input_hash, output_format, output_path,
+                                group, input_path):
+                reused.append(output)
+        
+        if len(reused) == len(group):
+            for output_format, output in zip(group, reused):
+                print("File "+output+" already converted in folder "+folder[:-1]+". Skipping...")
+                results.append((output_format, "skipped"))
+        else:
+            jobs.append(job)
+    
+    for job in jobs:
+        formats = " and ".join(job.keys())
+        print("Converting "+filename+" to "+formats+"...")
+        
+        # ffmpeg writes to temporary files, renamed once it succeeds, so a
+        # killed conversion never leaves a half-written output behind
+        
+        temp_outputs = {output_format: job[output_format]+".part"\
+                        for output_format in job}
+        arguments = ffmpeg_arguments(ffmpeg, input_path, temp_outputs)
+        start = time.perf_counter()
+        try:
+            process = subprocess.run(arguments, stderr=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, text=True,
+                                     check=True)
+            stdout = process.stdout
+            metrics.observe("ffmpeg_seconds", time.perf_counter() - start,
+                            formats = "+".join(job))
+            for output_format in job:
+                os.replace(temp_outputs[output_format], job[output_format])
+                record_conversion(ffmpeg, input_hash, output_format,
+                                  job[output_format], list(job))
+            print("Conversion of "+filename+" to "+formats+" successful")
+            results.extend([(output_format, "converted") for output_format in job])
+        except subprocess.CalledProcessError as exc:
+            metrics.inc("conversions_failed_total", formats = "+".join(job))
+            logging.exception(str(exc))
+            print(Fore.RED+"Conversion of "+filename+" to "+formats+" failed. "\
+                  "Please check error logs."+Fore.RESET)
+            print("Continue anyway...")
+            for temp_output in temp_outputs.values():
+                if os.path.isfile(temp_output):
+                    os.remove(temp_output)
+            results.extend([(output_format, "failed") for output_format in job])
+    
+    return results
+
+def ffmpeg_version(ffmpeg):
+    """
+    Returns the version line printed by "ffmpeg -version" for a given ffmpeg
+    executable, running it only once per executable.
+    """
+    import subprocess
+    
+    if ffmpeg not in ffmpeg_versions:
+        process = subprocess.run([ffmpeg, "-version"], stderr=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, text=True)
+        ffmpeg_versions[ffmpeg] = process.stdout.split("\n")[0].strip()
+    
+    return ffmpeg_versions[ffmpeg]
+
+def conversion_key(ffmpeg, formats):
+    """
+    Returns a short key identifying how outputs are produced: the ffmpeg
+    version and the ffmpeg arguments of the process producing them (without
+    file paths), which differ between a single format and the combined graph
+    of single pass mode. Changing either (or single_pass) invalidates the
+    cached conversions.
+    
+    Takes 2 arguments:
+        
+    ffmpeg = path of the ffmpeg executable (str)
+             REQUIRED
+    
+    formats = the formats produced by the same ffmpeg process, a list of
+              "APNG" and/or "GIF"
+              REQUIRED
+    
+    Returns: a hex string (str).
+    """
+    import hashlib
+    
+    arguments = ffmpeg_arguments("", "", dict.fromkeys(formats, ""))
+    key = "\n".join([ffmpeg_version(ffmpeg)] + arguments)
+    
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def record_conversion(ffmpeg, input_hash, output_format, output_path, formats):
+    """
+    Records a finished conversion in the conversion cache of baraag_dl.db.
+    
+    Takes 5 arguments:
+        
+    ffmpeg = path of the ffmpeg executable (str)
+             REQUIRED
+    
+    input_hash = SHA-256 hex digest of the MP4 file (str)
+                 REQUIRED
+    
+    output_format = "APNG" or "GIF"
+                    REQUIRED
+    
+    output_path = path of the converted file (str)
+                  REQUIRED
+    
+    formats = the formats produced by the same ffmpeg process, see
+              conversion_key()
+              REQUIRED
+    
+    Returns nothing.
+    """
+    with state_db_lock:
+        db = get_state_db()
+        # The file made by other arguments at the same path was overwritten
+        db.execute("DELETE FROM conversions WHERE output_path = ? AND "
+                   "output_format = ?", (output_path, output_format))
+        db.execute("INSERT OR REPLACE INTO conversions "
+                   "(input_sha256, output_format, settings_key, output_path, "
+                   "output_size, converted_at) VALUES (?, ?, ?, ?, ?, ?)",
+                   (input_hash, output_format,
+                    conversion_key(ffmpeg, formats), output_path,
+                    os.path.getsize(output_path),
+                    datetime.now().isoformat(timespec = "seconds")))
+        db.commit()
+
+def reuse_conversion(ffmpeg, input_hash, output_format, output_path, formats,
+                     input_path):
+    """
+    Checks the conversion cache for a valid output of the same input content
+    converted with the same ffmpeg version and arguments.
+    
+    If such an output exists at output_path, nothing needs to be done. If it
+    exists elsewhere (e.g. a renamed or duplicated MP4), it is linked (or
+    copied) to output_path instead of converting again. Outputs created
+    before the conversion cache existed are only adopted if they are newer
+    than the MP4 and decode without errors (see verify_output()), since they
+    may have been cut short by a killed ffmpeg, or made from another file.
+    
+    Takes 6 arguments:
+        
+    ffmpeg = path of the ffmpeg executable (str)
+             REQUIRED
+    
+    input_hash = SHA-256 hex digest of the MP4 file (str)
+                 REQUIRED
+    
+    output_format = "APNG" or "GIF"
+                    REQUIRED
+    
+    output_path = path where the converted file should be (str)
+                  REQUIRED
+    
+    formats = the formats produced by the same ffmpeg process, see
+              conversion_key()
+              REQUIRED
+    
+    input_path = path of the MP4 file (str)
+                 REQUIRED
+    
+    Returns: True if output_path holds a valid conversion, False if the file
+             needs to be converted.
+    """
+    key = conversion_key(ffmpeg, formats)
+    
+    with state_db_lock:
+        rows = get_state_db().execute("SELECT output_path, output_size, "
+                                      "settings_key FROM conversions "
+                                      "WHERE input_sha256 = ? AND "
+                                      "output_format = ?",
+                                      (input_hash, output_format)).fetchall()
+    
+    for path, size, settings_key in rows:
+        if settings_key != key or not os.path.isfile(path) or \
+           os.path.getsize(path) != size:
+            continue
+        
+        if path == output_path:
+            return True
+        
+        if not link_file(path, output_path):
+            shutil.copyfile(path, output_path+".part")
+            os.replace(output_path+".part", output_path)
+        
+        record_conversion(ffmpeg, input_hash, output_format, output_path,
+                          formats)
+        return True
+    
+    if not rows and os.path.isfile(output_path) and os.path.getsize(output_path) \
+       and os.path.getmtime(output_path) >= os.path.getmtime(input_path) \
+       and verify_output(ffmpeg, output_path):
+        # Converted by a version without the conversion cache
+        record_conversion(ffmpeg, input_hash, output_format, output_path,
+                          formats)
+        return True
+    
+    return False
+
+def verify_output(ffmpeg, output_path):
+    """
+    Decodes a converted file with ffmpeg, without writing anything, to check
+    that it is complete.
+    
+    Returns: True if it decodes without errors, False otherwise.
+    """
+    import subprocess
+    
+    process = subprocess.run([ffmpeg, "-nostdin", "-v", "error", "-xerror",
+                              "-i", output_path, "-f", "null", "-"],
+                             stderr = subprocess.PIPE, stdout = subprocess.PIPE,
+                             text = True)
+    
+    if process.returncode != 0 or process.stderr.strip():
+        logging.warning("Existing conversion "+output_path+" is invalid, "\
+                        "converting again: "+process.stderr.strip())
+        return False
+    
+    return True
+
+
+def ffmpeg_arguments(ffmpeg, input_path, outputs):
+    """
+    Builds the ffmpeg command line converting an MP4 file to APNG and/or GIF.
+    
+    When both formats are requested, a single filter graph splits the decoded
+    video three ways: one copy is written as APNG, the other two feed the
+    palette generation and palette use stages for the GIF. The input is thus
+    decoded only once.
+    
+    Output formats are given explicitly, so outputs can be written to
+    temporary filenames, and existing outputs are overwritten (-y).
+    
+    Takes 3 arguments:
+        
+    ffmpeg = path of the ffmpeg executable (str)
+             REQUIRED
+    
+    input_path = path of the MP4 file (str)
+                 REQUIRED
+    
+    outputs = a dictionary {'APNG': output path (str), 'GIF': output path (str)}
+              with one or both formats.
+              REQUIRED
+    
+    Returns: a list of arguments for subprocess.run().
+    """
+    arguments = [ffmpeg, "-nostdin", "-y", "-i", input_path]
+    
+    if "APNG" in outputs and "GIF" in outputs:
+        arguments += ["-filter_complex",
+                      "[0:v]split=3[apng][a][b];[a]"+gif_filter+"[gif]",
+                      "-map", "[apng]", "-f", "apng", outputs["APNG"],
+                      "-map", "[gif]", "-f", "gif", outputs["GIF"]]
+    
+    elif "APNG" in outputs:
+        arguments += ["-f", "apng", outputs["APNG"]]
+    
+    else:
+        arguments += ["-filter_complex", "[0:v]split[a][b];[a]"+gif_filter,
+                      "-f", "gif", outputs["GIF"]]
+    
+    return arguments
+
+class ConversionQueue:
+    """
+    Runs video_convert() on its own pool of worker threads, separate from the
+    download pool, so downloads keep going while ffmpeg works. Each worker
+    drives one ffmpeg process at a time, so settings["max_conversions"]
+    workers (one per CPU core by default) keep every core busy.
+    
+    Results and errors are collected as conversions finish and summarized by
+    finish() at the end of the run.
+    """
+    def __init__(self, settings):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        workers = settings["max_conversions"] or os.cpu_count() or 1
+        self.settings = settings
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        self.lock = threading.Lock()
+        self.counts = {'converted': 0, 'skipped': 0, 'over_limit': 0}
+        self.failed = []
+    
+    def submit(self, file, folder):
+        future = self.pool.submit(video_convert, self.settings, file, folder)
+        future.add_done_callback(lambda future: self.done(future, file))
+    
+    def done(self, future, file):
+        try:
+            results = future.result()
+        except Exception as exc:
+            logging.exception("Conversion of "+file.filename+" failed: "+
+                              repr(exc))
+            results = [("all", "failed")]
+        
+        with self.lock:
+            for output_format, status in results:
+                if status == "failed":
+                    self.failed.append(file.filename+" ("+output_format+")")
+                else:
+                    self.counts[status] += 1
+    
+    def finish(self):
+        """
+        Waits for all queued conversions, prints a summary of the results.
+        
+        Returns: the number of failed conversions (int).
+        """
+        self.pool.shutdown(wait = True)
+        
+        print("Conversions: "+str(self.counts['converted'])+" converted; "+
+              str(self.counts['skipped'])+" already converted; "+
+              str(self.counts['over_limit'])+" over the filesize limit; "+
+              str(len(self.failed))+" failed")
+        
+        for failure in self.failed:
+            print(Fore.RED+"Conversion failed: "+failure+Fore.RESET)
+        
+        return len(self.failed)
+
+def search_user_unlogged():
+    """
+    Searches Baraag for an account, defined by the user.
+
+    Takes no arguments.
+    
+    This search function foregoes Mastodon.py and queries the API directly.
+    This is made to allow unauthenticated users to search and download.             
+             
+    Returns a dictionary with the info of the user from which media should be
+    downloaded, in the format {account_name (str): {'account':(str),'id':(int)}.         
+    """
+    results = []
+    while not results:
+    
+        try:
+            username = input("Please type in username to search (Ctrl+C to exit): ")
+            base_url = api_base_url+"/api/v2/search"
+            search_params = {'q': username, 'type':'accounts'}
+            
+            results = get_session().get(base_url, params=search_params)
+            results = results.json()['accounts']
+            if not results:
+                print(Fore.RED+"User not found!"+Fore.RESET+" Please try again!")
+            
+        except MastodonNetworkError as exc:
+            mastodon_network_error_handler(exc)
+              
+        except MastodonError as exc:
             mastodon_error_handler(exc)         
         
         except KeyboardInterrupt:
@@ -826,419 +4380,958 @@ def search_user(client):
                       {'account': results[0]['acct'],\
                        'id': results[0]['id']}}
     
-    return result_dic
-
-def download_following(client, settings):
-    """
-    Routine loop that downloads media from all accounts the user follows.
-    Segregated from main() since v0.014. Requires a setting dictionary as
-    an argument as of v0.02.
-    
-    Takes 2 arguments:
-        
-    client = Mastodon client object, generated/initialized by initialize()
-             Defaults to client.
-             REQUIRED
-    settings = dictionary of conversion settings, created by ffmpeg_validate()
-               REQUIRED
-             
-    Returns nothing, saves files to disk, exits program when done.
+    return result_dic
 
+def positive_int(value):
     """
-    # Getting user information
-           
-    owner_info = get_owner_info(client)
-    
-    # Get following list
+    argparse type for the concurrency options: an integer of at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+def non_negative_int(value):
+    """
+    argparse type for --max-conversions: an integer of at least 0.
+    """
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("must be at least 0")
+    return number
+
+def shard_spec(value):
+    """
+    argparse type for --shard: "INDEX/COUNT", with INDEX from 1 to COUNT.
+    Returns a tuple (index, count).
+    """
+    index, separator, count = value.partition("/")
     
-    follow_list = owner_info['following']
-    follow_number = len(follow_list)
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be INDEX/COUNT, e.g. 1/3")
     
-    # Process followed accounts and start downloads
-    print()
-    print(Fore.YELLOW+"Processing all followed accounts ("+str(follow_number)+" users)"+Fore.RESET)
-    print()
-    process_following_user(client, settings, follow_list)
-    print(Fore.GREEN+"All done!"+Fore.RESET)
+    if not separator or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("must be INDEX/COUNT with INDEX "\
+                                         "from 1 to COUNT, e.g. 1/3")
+    return (index, count)
 
-def select_menu(logged_in):
+def read_account_list(path):
     """
-    Basic selection menu.
+    Reads a list of accounts to sync, for "sync accounts".
     
-    It takes 1 argument, a boolean generated by validate_login() representing
-    whether the user is logged in or not.
+    The file has one account per line, either an account name (as in
+    "user" or "user@instance.tld", with or without a leading @) or a numeric
+    account ID. Blank lines and lines starting with # are ignored.
     
-    It returns a selection number (INT).
+    Takes 1 argument:
+        
+    path = path of the list file (str)
+           REQUIRED
+    
+    Returns: a list of account names and IDs (str).
     """
+    with open(path, "r", encoding = "utf-8") as list_file:
+        lines = [line.strip() for line in list_file]
     
-    print("\nChoose an option:\n")
-    if logged_in:
-        print("1. Download media from all followed accounts")
-        print("2. Search for user to download media from")
-        print("3. Exit\n")
-        
-        valid_choices = [1,2,3]
-        selection = ""
-        
-        try:
-            while selection not in valid_choices:
-                selection = ""
-                while not selection.isdigit():
-                    selection = input("Please choose an option: ")
+    return [line.lstrip("@") for line in lines if line and not line.startswith("#")]
+
+def lookup_account(account):
+    """
+    Looks up an account on Baraag by exact name or numeric ID, without
+    prompting. Like search_user_unlogged(), this queries the API directly, so
+    it works with or without a logged-in client.
     
-                else:
-                    selection = int(selection)  
-            
-        except KeyboardInterrupt:
-            print()
-            print(Fore.YELLOW+"Interrupted by user. Exiting..."+Fore.RESET)
-            sys.exit()
-            
-        return selection
+    Takes 1 argument:
+        
+    account = account name or numeric ID (str), see read_account_list()
+              REQUIRED
     
+    Returns: a dictionary in the format of account_entry(), or None if the
+             account does not exist (the error is logged). Raises APIError
+             if Baraag cannot be reached or answers with an error.
+    """
+    if account.isdigit():
+        url = api_base_url+"/api/v1/accounts/"+account
+        params = None
     else:
-        print("1. Search for user to download media from")
-        print("2. Exit\n")
+        url = api_base_url+"/api/v1/accounts/lookup"
+        params = {'acct': account}
+    
+    try:
+        response = get_session().get(url, params = params)
         
-        valid_choices = [1,2]
-        selection = ""
+        if response.status_code == 404:
+            logging.error("Account "+account+" not found")
+            print(Fore.RED+"Account "+account+" not found!"+Fore.RESET+" Skipping...")
+            return None
         
-        try:
-            while selection not in valid_choices:
-                selection = ""
-                while not selection.isdigit():
-                    selection = input("Please choose an option: ")
+        response.raise_for_status()
+        result = response.json()
     
-                else:
-                    selection = int(selection)  
-            
-        except KeyboardInterrupt:
-            print()
-            print(Fore.YELLOW+"Interrupted by user. Exiting..."+Fore.RESET)
-            sys.exit()
-            
-        return selection
+    except (requests.RequestException, ConnectionError, ValueError) as exc:
+        logging.exception(str(exc))
+        print(Fore.RED+"Baraag DL was unable to look up account "+account+
+              ". Please check error logs."+Fore.RESET)
+        raise APIError(str(exc)) from exc
+    
+    return dict(account_entry(result), id = str(result['id']))
 
-def write_ini():
+def headless_client(client_credentials, user_credentials, require_login):
     """
-    Writes a basic ini file for ffmpeg settings in case it does not exist
-    or has invalid contents.
+    Initializes the client for the command line mode from existing
+    credentials files, without ever prompting: if credentials are missing or
+    invalid, the run fails instead of asking to log in. Credentials are
+    created by running Baraag DL interactively once.
     
-    Defaults to setting "use_ffmpeg" to False.
-
-    It takes no arguments and returns nothing.    
+    Takes 3 arguments:
+        
+    client_credentials = path of the client credentials file (str)
+                         REQUIRED
+    
+    user_credentials = path of the user credentials file (str)
+                       REQUIRED
+    
+    require_login = whether a logged-in user is needed (bool), e.g. to get
+                    the list of followed accounts
+                    REQUIRED
+    
+    Returns: a Mastodon object client, or None if it could not be
+             initialized, e.g. if Baraag cannot be reached (the reason is
+             printed).
     """
-    ini_settings =  "use_ffmpeg = False\n"\
-                    "ffmpeg_path = System\n"\
-                    "convert_gif = True\n"\
-                    "convert_apng = True\n"\
-                    "file_size_limit = 50.0"
+    if not os.path.isfile(client_credentials):
+        client_credentials = None
     
-    with open("config.ini", "w") as ini_file:
-        ini_file.writelines(ini_settings)
+    if not os.path.isfile(user_credentials):
+        user_credentials = None
+    
+    if (user_credentials is None or client_credentials is None) and require_login:
+        print(Fore.RED+"Credentials not found! Please run Baraag DL "\
+              "interactively once to log in."+Fore.RESET)
+        return None
+    
+    try:
+        if user_credentials is None or client_credentials is None:
+            print(Fore.YELLOW+"Proceeding as unregistered user..."+Fore.RESET)
+            return init_client(client_credentials)
+        
+        client = init_client(client_credentials, user_credentials)
+        valid = validate_login(client)
+    
+    except (MastodonError, requests.RequestException, ConnectionError) as exc:
+        logging.exception(str(exc))
+        print(Fore.RED+"Baraag DL was unable to connect to the API. Please "\
+              "check error logs."+Fore.RESET)
+        return None
+    
+    if not valid:
+        print(Fore.RED+"Credentials invalid! Please run Baraag DL "\
+              "interactively to log in again."+Fore.RESET)
+        return None
+    
+    print(Fore.GREEN+"Authentication successful!"+Fore.RESET)
+    return client
 
-def read_ini():
+def command_settings(args):
     """
-    Reads a config.ini present in the base folder of the script.
-
-    It takes no arguments and returns nothing.
+    Reads the settings for the sync and plan commands from config.ini, and
+    applies the command line options that override them.
+    
+    Takes 1 argument:
+        
+    args = parsed command line arguments (argparse.Namespace), see main()
+           REQUIRED
+    
+    Returns: a dictionary with the settings, including the runtime-only
+             "full_rescan", "output_root", "shard" and "rate_budget" keys.
     """
-    with open("config.ini", "r") as ini_file:
-        settings = ini_file.readlines()
-    settings = [x.replace(" ", "").strip().split("=")for x in settings]
+    settings = ffmpeg_init()
     
-    settings = {x[0]:x[1] for x in settings}
+    # Command line options override config.ini; options a command does not
+    # have are left alone
     
-    if settings["use_ffmpeg"].lower() == "true":
-        settings["use_ffmpeg"] = True
-    else:
-        settings["use_ffmpeg"] = False
-        
-    if settings["convert_gif"].lower() == "true":
-        settings["convert_gif"] = True
-    else:
-        settings["convert_gif"] = False
-        
-    if settings["convert_apng"].lower() == "true":
-        settings["convert_apng"] = True
+    overrides = {"use_ffmpeg": "use_ffmpeg",
+                 "ffmpeg_path": "ffmpeg_path",
+                 "convert_gif": "convert_gif",
+                 "convert_apng": "convert_apng",
+                 "max_downloads": "max_downloads",
+                 "max_downloads_per_host": "max_downloads_per_host",
+                 "max_crawlers": "max_crawlers",
+                 "max_conversions": "max_conversions",
+                 "home_timeline_sync": "home_timeline_sync"}
+    
+    for option, key in overrides.items():
+        value = getattr(args, option, None)
+        if value is not None:
+            settings[key] = value
+    
+    settings["full_rescan"] = args.full_rescan
+    settings["output_root"] = args.output
+    settings["shard"] = args.shard
+    
+    # The shards running on this host share a rate-limit budget unless told
+    # otherwise
+    
+    if args.rate_budget is None and args.shard is not None:
+        settings["rate_budget"] = rate_budget_file
     else:
-        settings["convert_apng"] = False
+        settings["rate_budget"] = args.rate_budget
     
-    try:
-        settings["file_size_limit"] = float(settings["file_size_limit"])
-    except ValueError:
-        print(Fore.RED+"Invalid filesize limit value!"+Fore.RESET +
-              " Resetting to defaults...")
-        print()
-        settings["file_size_limit"] = 50.0
-         
     return settings
 
-def validate_ini(settings):
+def get_command_accounts(client, settings, args):
     """
-    Runs a quick validation of the settings in the config.ini file.
+    Returns the accounts targeted by the sync and plan commands: every
+    account followed by the logged-in user ("following"), or the accounts in
+    a list file ("accounts FILE"), looked up with lookup_account().
     
-    Returns a boolean of the validity of the file.
+    Takes 3 arguments:
+        
+    client = Mastodon client object, generated by headless_client()
+             REQUIRED
+    
+    settings = dictionary of settings, created by command_settings()
+               REQUIRED
+    
+    args = parsed command line arguments (argparse.Namespace), see main()
+           REQUIRED
+    
+    The follow list is loaded with load_follow_list(), so it may be
+    refreshed in the background. For a sharded sync (--shard), only the
+    accounts of the shard are returned, see shard_accounts().
+    
+    Returns: a tuple (follow_dic, failed_accounts, refresh): a dictionary of
+             accounts in the format of get_owner_info()['following'], the
+             number of listed accounts that were not found (int) and the
+             background refresh of load_follow_list() (or None).
     """
-    valid_options = ["use_ffmpeg", "ffmpeg_path", "convert_gif", "convert_apng",
-                     "file_size_limit"]
+    failed_accounts = 0
+    refresh = None
     
-    if sorted(valid_options) == sorted(list(settings.keys())):
-        return True
+    if args.target == "following":
+        follow_dic, refresh = load_follow_list(client, settings)
     else:
-        return False
+        follow_dic = {}
+        for account in read_account_list(args.list_file):
+            result = lookup_account(account)
+            if result is None:
+                failed_accounts += 1
+            else:
+                follow_dic[result['account']] = result
+        
+        follow_dic = shard_accounts(follow_dic, settings["shard"])
+    
+    print_shard(settings, follow_dic)
+    
+    return follow_dic, failed_accounts, refresh
 
-def ffmpeg_init():
+def print_shard(settings, follow_dic):
     """
-    Runs an initialization loop for ffmpeg to enable it in case the user so
-    requires and/or it is present in the system.
+    Tells which shard of a sharded sync this node runs, and how many of the
+    accounts it got. Prints nothing otherwise.
+    """
+    if settings["shard"] is None:
+        return
     
-    In short, it:
-        1- reads the config.ini file if present
-        2- creates the file if not present/and or file is invalid
+    print(Fore.YELLOW+"Shard "+str(settings["shard"][0])+"/"+
+          str(settings["shard"][1])+": "+str(len(follow_dic))+" account(s)."+
+          Fore.RESET)
+    print()
+
+def run_plan(args):
+    """
+    Runs the "plan" command of the command line mode: goes through the
+    timelines of the targeted accounts like "sync" would, without
+    downloading anything, and prints how many files would be downloaded, an
+    estimate of their size and of the time it would take (see
+    plan_account()).
     
-    Returns a dictionary with the data from the config.ini file
+    With --json, the plan is printed as JSON and progress messages go to
+    stderr, so the output can be parsed.
+    
+    Takes 1 argument:
+        
+    args = parsed command line arguments (argparse.Namespace), see main()
+           REQUIRED
+    
+    An account whose timeline cannot be fetched is reported as failed, and
+    left out of the totals, instead of stopping the plan.
+    
+    Returns: the exit code (int): exit_ok, exit_partial if some listed
+             accounts were not found or could not be planned, exit_fatal if
+             the plan could not run.
     """
-    if os.path.isfile("config.ini"):
-        print(Fore.GREEN+"Ffmpeg settings file found!"+Fore.RESET)
-        print()
-        print("Reading settings file...")
-        print()
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def plan_one(account):
         try:
-            settings = read_ini()
-            if validate_ini(settings):
-                return settings
-            else:
-                print(Fore.RED+"Settings invalid! Reinitializing settings file"\
-                      "..."+Fore.RESET)
-                print()
-                write_ini()
-                settings = read_ini()
-                return settings
-        except:
-            print(Fore.RED+"Settings invalid! Reinitializing settings file..."
-                  +Fore.RESET)
-            print()
-            print("Creating settings file...")
-            print()
-            write_ini()
-            settings = read_ini()
-            return settings
+            return plan_account(client, settings, account, args.estimate,
+                                average_sizes)
+        except APIError:
+            metrics.inc("accounts_failed_total")
+            print(Fore.RED+"["+account['account']+"] Could not fetch the "\
+                  "posts of the account."+Fore.RESET)
+            return None
+    
+    if args.json:
+        progress = sys.stderr
     else:
-        print(Fore.RED+"Settings file not found!"+Fore.RESET)
-        print()
-        print("Creating settings file...")
-        print()
-        write_ini()
-        settings = read_ini()
-        return settings
+        progress = sys.stdout
+    
+    with contextlib.redirect_stdout(progress):
+        settings = command_settings(args)
+        
+        init_session(settings)
+        
+        client = headless_client(args.client_credentials, args.user_credentials,
+                                 args.target == "following")
+        if client is None:
+            return exit_fatal
+        
+        follow_dic, failed_accounts, refresh = get_command_accounts(client,
+                                                                     settings,
+                                                                     args)
+        
+        # The plan covers the refreshed follow list
+        
+        if refresh is not None:
+            follow_dic = refresh.result()['following']
+        
+        average_sizes = get_average_sizes()
+        
+        with ThreadPoolExecutor(max_workers = settings["max_crawlers"]) as crawl_pool:
+            results = list(crawl_pool.map(plan_one, follow_dic.values()))
+    
+    accounts = [result for result in results if result is not None]
+    failed_plans = [account['account'] for account, result\
+                    in zip(follow_dic.values(), results) if result is None]
+    
+    bandwidth = args.bandwidth * 1048576
+    
+    for account in accounts:
+        account['estimated_seconds'] = account['bytes'] / bandwidth
+    
+    totals = {key: sum(account[key] for account in accounts)\
+              for key in ('attachments', 'existing', 'linked', 'new', 'bytes',
+                          'unknown_sizes', 'estimated_seconds')}
+    
+    plan = {'estimate': args.estimate,
+            'bandwidth_mb_per_second': args.bandwidth,
+            'accounts_not_found': failed_accounts,
+            'accounts_failed': failed_plans,
+            'accounts': accounts,
+            'totals': totals}
+    
+    if args.json:
+        print(json.dumps(plan, indent = 2))
+    else:
+        print_plan(plan)
+    
+    if failed_accounts or failed_plans:
+        return exit_partial
+    
+    return exit_ok
 
-def ffmpeg_validate(settings):
+def plan_account(client, settings, account, estimate, average_sizes):
     """
-    Validates the settings of the config.ini file based on OS and settings
-    in the file.
+    Plans the sync of one account: fetches its timeline (only the posts
+    newer than the last sync, unless settings["full_rescan"] is True, and
+    nothing if the account is unchanged, see account_unchanged()) and
+    its attachments with get_attachment_data(), leaves out the ones already
+    in the manifest or on disk, and estimates the size of the rest.
     
-    Takes the settings from ffmpeg_init() as a required parameter.
+    Sizes are estimated from the attachment metadata (duration and bitrate
+    of videos, see parse_post()) or, for estimate = "head", with
+    concurrent HEAD requests. Attachments without a size are counted at the
+    average size of files with the same extension already downloaded.
     
-    Returns the settings dictionary as is if settings are valid, or with
-    ffmpeg turned off (settings["use_ffmpeg"] = False) if settings are invalid
-    or ffmpeg is not present.
+    Takes 5 arguments:
+        
+    client = Mastodon client object, generated by headless_client()
+             REQUIRED
+    
+    settings = dictionary of settings, created by command_settings()
+               REQUIRED
+    
+    account = a followed account dictionary {'account':(str),'id':(int)}
+              REQUIRED
+    
+    estimate = "meta" or "head" (str)
+               REQUIRED
+    
+    average_sizes = average file size per extension, generated by
+                    get_average_sizes()
+                    REQUIRED
+    
+    Returns: a dictionary {'account': (str), 'id': (str),
+                           'attachments': attachments found (int),
+                           'existing': already downloaded (int),
+                           'linked': would be linked to a known copy (int),
+                           'new': would be downloaded (int),
+                           'bytes': estimated size of the new files (int),
+                           'unknown_sizes': new files whose size could not
+                                            be estimated (int)}
     """
-    current_os = sys.platform
-    settings = settings
+    from concurrent.futures import ThreadPoolExecutor
     
-    if settings["ffmpeg_path"] == "System":
-        if current_os == "linux":
-            ffmpeg_path = "/usr/bin/"
-            ffmpeg_exe = "ffmpeg"
-            ffmpeg_full_path = ffmpeg_path + ffmpeg_exe
-            settings["ffmpeg_path"] = ffmpeg_full_path
-        
-        elif current_os == "darwin":
-            ffmpeg_path = ""
-            ffmpeg_exe = "./ffmpeg"
-            ffmpeg_full_path = ffmpeg_path + ffmpeg_exe
-            settings["ffmpeg_path"] = ffmpeg_full_path 
-        
+    account_name = account['account']
+    account_id = account['id']
+    folder_path = get_account_folder(settings, account_name, account_id)
+    
+    if not settings.get("full_rescan") and account_unchanged(account):
+        return {'account': account_name, 'id': str(account_id),
+                'attachments': 0, 'existing': 0, 'linked': 0, 'new': 0,
+                'bytes': 0, 'unknown_sizes': 0}
+    
+    if settings.get("full_rescan"):
+        last_synced_post = None
+        known = set()
+    else:
+        last_synced_post = get_sync_state(account_id)
+        known = get_manifest_entries(account_id)
+    
+    timeline = get_timeline(client, account_id, last_synced_post, account_name)
+    attachment_dic = get_attachment_data(timeline, settings["max_downloads"])
+    
+    files = [file for post in attachment_dic.values()\
+             for file in post.attachments]
+    
+    new_files = []
+    linked = 0
+    
+    for file in files:
+        if (file.post_id, file.id) in known or \
+           os.path.isfile(folder_path+file.filename):
+            continue
+        elif settings["deduplicate"] and is_known_url(file.url):
+            linked += 1
         else:
-            ffmpeg_path = ""
-            ffmpeg_exe = "ffmpeg.exe"
-            ffmpeg_full_path = ffmpeg_path + ffmpeg_exe
-            settings["ffmpeg_path"] = ffmpeg_full_path          
+            new_files.append(file)
+    
+    if estimate == "head":
+        limit = settings["max_downloads_per_host"]
+        with ThreadPoolExecutor(max_workers = settings["max_downloads"]) as pool:
+            futures = [host_scheduler.submit(pool, file.url, limit, head_size,
+                                             file.url) for file in new_files]
+            sizes = [future.result() for future in futures]
     else:
-        pass
+        sizes = [None] * len(new_files)
     
-    try: 
-        if os.path.isfile(settings["ffmpeg_path"]):
-            print(Fore.GREEN+"Ffmpeg executable found!"+Fore.RESET)
-            print()
-            return settings
-            
+    total_size = 0
+    unknown_sizes = 0
+    
+    for file, size in zip(new_files, sizes):
+        if size is None:
+            size = file.size_hint
+        if size is None:
+            size = average_sizes.get(os.path.splitext(file.filename)[1])
+        if size is None:
+            unknown_sizes += 1
         else:
-            print(Fore.RED+"Ffmpeg executable not found!"+Fore.RESET)
-            print("Disabling Ffmpeg conversion...")
-            print()
-            settings["use_ffmpeg"] = False
-            return settings
-    except:
-        print(Fore.RED+"Ffmpeg executable not found!"+Fore.RESET)
-        print("Disabling Ffmpeg conversion...")
-        print()
-        settings["use_ffmpeg"] = False
-        return settings
+            total_size += size
+    
+    return {'account': account_name,
+            'id': str(account_id),
+            'attachments': len(files),
+            'existing': len(files) - len(new_files) - linked,
+            'linked': linked,
+            'new': len(new_files),
+            'bytes': total_size,
+            'unknown_sizes': unknown_sizes}
 
-def video_convert(settings, file, folder):
+def head_size(url):
     """
-    Converts a given MP4 file to APNG and GIF depending on the contents of the
-    settings dictionary (derived from config.ini)
+    Returns the size of a file from the Content-Length of a HEAD request, or
+    None if the request failed or the server did not send it. Submitted
+    within the per-host download limit (see HostScheduler).
+    """
+    try:
+        response = get_session().head(url, allow_redirects = True)
+        response.raise_for_status()
+        return int(response.headers["Content-Length"])
+    except Exception as exc:
+        logging.warning("Could not get the size of "+url+": "+repr(exc))
+        return None
+
+def print_plan(plan):
+    """
+    Prints a plan generated by run_plan() as a table, one account per line.
+    """
+    def format_time(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return str(hours)+"h "+str(minutes).zfill(2)+"m "+str(seconds).zfill(2)+"s"
     
-    Usually run after download_file() to do on-the-fly conversion as needed.
+    print()
+    print("Account".ljust(32)+"Found".rjust(8)+"Have".rjust(8)+"Linked".rjust(8)+
+          "New".rjust(8)+"Est. MB".rjust(11)+"Est. time".rjust(14))
     
-    Keep in mind "file" here does not mean the actual file on disk, but rather
-    its attachment "metadata" dictionary generated by get_attachment_data()
+    for account in plan['accounts'] + [dict(plan['totals'], account = "Total")]:
+        print(account['account'][:31].ljust(32)+
+              str(account['attachments']).rjust(8)+
+              str(account['existing']).rjust(8)+
+              str(account['linked']).rjust(8)+
+              str(account['new']).rjust(8)+
+              str(round(account['bytes']/1048576, 1)).rjust(11)+
+              format_time(account['estimated_seconds']).rjust(14))
     
-    Takes 3 arguments:
-        settings = settings dictionary returned by ffmpeg_validate(); REQUIRED
-        file = an attachment in dictionary form {attachment_id: { 'id': (int), 
-                                                                  'url': (str), 
-                                                                  'filename':(str)
-                                                                  }} ,
-                existing in the larger dictionary generated by 
-                get_attachment_data().
-                REQUIRED
-        folder = the folder name where the attachment will be downloaded, usually 
-                 defined by process_following_user() at runtime.
-                 REQUIRED.
+    print()
+    print("Estimated from "+("HEAD requests" if plan['estimate'] == "head" else
+                             "attachment metadata")+
+          " at "+str(plan['bandwidth_mb_per_second'])+" MB/s.")
     
-    Returns nothing, generates GIF and APNG files in the same folder as the MP4
-    file.
+    if plan['totals']['unknown_sizes']:
+        print(Fore.YELLOW+str(plan['totals']['unknown_sizes'])+" file(s) of "\
+              "unknown size are not included."+Fore.RESET)
     
-    This is admiteddly a very rudimentary implementation, might revamp in future
-    releases.
+    if plan['accounts_not_found']:
+        print(Fore.YELLOW+str(plan['accounts_not_found'])+" account(s) not "\
+              "found."+Fore.RESET)
+    
+    if plan['accounts_failed']:
+        print(Fore.YELLOW+str(len(plan['accounts_failed']))+" account(s) "\
+              "could not be planned: "+", ".join(plan['accounts_failed'])+
+              Fore.RESET)
+
+def run_sync(args):
     """
-    apng = settings["convert_apng"]
-    gif = settings["convert_gif"]
-    ffmpeg = settings["ffmpeg_path"]
-    size_limit = settings["file_size_limit"]
+    Runs the "sync" command of the command line mode, for scheduled runs
+    (cron, systemd timers...): downloads every followed account ("sync
+    following") or the accounts in a list file ("sync accounts FILE"),
+    without any prompt.
     
-    filename = file['filename']
-    filename_stem = filename.split(".")[0]
-    input_path = folder + filename
+    Settings are read from config.ini, then overridden by the command line
+    options.
     
-    # This size is in BYTES, so divide by 1048576 for MB
-    file_size = os.path.getsize(input_path)/1048576
+    Takes 1 argument:
+        
+    args = parsed command line arguments (argparse.Namespace), see main()
+           REQUIRED
     
-    if file_size <= size_limit:
-        if apng:
-            output = filename_stem + ".apng"
-            input_path = folder + filename
-            output_path = folder + output
-            if os.path.isfile(output_path):
-                print("File "+output+" already exists in folder "+folder[:-1]+". Skipping...")
-            else:
-                print("Converting to APNG...")
-                arguments = [ffmpeg, "-i", input_path, output_path]
-                try:
-                    process = subprocess.run(arguments, stderr=subprocess.PIPE,
-                                         stdout=subprocess.PIPE, text=True,
-                                         check=True)
-                    stdout = process.stdout
-                    print("Conversion to APNG successful")
-                except subprocess.CalledProcessError as exc:
-                    logging.exception(str(exc))
-                    print(Fore.RED+"Conversion to APNG failed. Please check error logs."+Fore.RESET)
-                    print("Continue anyway...")
-
-        if gif:
-            output = filename_stem + ".gif"
-            input_path = folder + filename
-            output_path = folder + output
-            if os.path.isfile(output_path):
-                print("File "+output+" already exists in folder "+folder[:-1]+". Skipping...")
-            else:
-                print("Converting to GIF...")
-                arguments = [ffmpeg, "-i", input_path, "-filter_complex",
-                             '[0:v]split[a][b];[a]palettegen=stats_mode=diff[p];'\
-                                 '[b][p]paletteuse=dither=bayer:bayer_scale=5:'\
-                                     'diff_mode=rectangle', output_path]
-                try:
-                    process = subprocess.run(arguments, stderr=subprocess.PIPE,
-                                             stdout=subprocess.PIPE, text=True,
-                                             check=True)
-                    stdout = process.stdout
-                    print("Conversion to GIF successful")
-                except subprocess.CalledProcessError as exc:
-                    logging.exception(str(exc))
-                    print(Fore.RED+"Conversion to GIF failed. Please check error logs."+Fore.RESET)
-                    print("Continue anyway...")
-
+    Returns: the exit code (int): exit_ok if everything was downloaded (and
+             converted), exit_partial if some attachments or accounts failed,
+             exit_fatal if the sync could not run.
+    """
+    settings = command_settings(args)
+    
+    settings = ffmpeg_status(settings)
+    
+    if args.output and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    
+    init_session(settings)
+    
+    client = headless_client(args.client_credentials, args.user_credentials,
+                             args.target == "following")
+    if client is None:
+        return exit_fatal
+    
+    follow_dic, failed_accounts, refresh = get_command_accounts(client, settings,
+                                                                 args)
+    
+    print()
+    print(Fore.YELLOW+"Processing "+str(len(follow_dic))+" accounts"+Fore.RESET)
+    print()
+    
+    if args.target == "following":
+        failed, unreachable = process_following_home(client, settings, follow_dic)
     else:
-        print("File over the filesize limit. Skipping...")
+        failed, unreachable = process_following_user(client, settings, follow_dic)
+    
+    new_failed, new_unreachable = process_new_follows(client, settings,
+                                                      follow_dic, refresh)
+    failed += new_failed
+    unreachable += new_unreachable
+    
+    if failed or unreachable or failed_accounts:
+        print(Fore.YELLOW+"Done, with "+str(failed)+" failed attachment(s), "+
+              str(unreachable)+" account(s) whose posts could not be fetched "\
+              "and "+str(failed_accounts)+" account(s) not found."+Fore.RESET)
+        return exit_partial
+    
+    print(Fore.GREEN+"All done!"+Fore.RESET)
+    return exit_ok
 
-def search_user_unlogged():
+class Watcher:
     """
-    Searches Baraag for an account, defined by the user.
-
-    Takes no arguments.
+    Watch mode (see run_watch()): downloads the attachments of new posts from
+    followed accounts as they are published, instead of crawling every
+    timeline again.
     
-    This search function foregoes Mastodon.py and queries the API directly.
-    This is made to allow unauthenticated users to search and download.             
-             
-    Returns a dictionary with the info of the user from which media should be
-    downloaded, in the format {account_name (str): {'account':(str),'id':(int)}.         
+    New posts come from the user stream of the streaming API (the home
+    timeline as it happens). Whenever the stream is down, the home timeline
+    is polled for posts newer than the newest one seen (catch_up()), so
+    nothing posted in the meantime is missed. Reconnections wait
+    exponentially longer (up to max_backoff seconds) while the stream keeps
+    failing, and after max_stream_failures failures in a row the home
+    timeline is polled instead, every poll_interval seconds.
+    
+    Posts are handed to download_attachments() on a pool of
+    settings["max_crawlers"] workers, so the stream is read while files
+    download. The sync state is left alone: posts downloaded here are in the
+    manifest, so the next sync skips them. Failed downloads are tried again
+    after retry_interval seconds (twice as long the second time, and so on),
+    up to max_download_attempts times in all.
     """
-    results = []
-    while not results:
+    max_backoff = 300.0
+    max_stream_failures = 3
+    retry_interval = 60.0
+    max_download_attempts = 3
+    
+    def __init__(self, client, settings, follow_dic):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.client = client
+        self.settings = settings
+        self.follows = {}
+        self.follows_refreshed = 0
+        self.since_id = None
+        self.failed = 0
+        self.retries = {}
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers = settings["max_downloads"])
+        self.crawl_pool = ThreadPoolExecutor(max_workers = settings["max_crawlers"])
+        
+        if settings["use_ffmpeg"]:
+            self.conversions = ConversionQueue(settings)
+        else:
+            self.conversions = None
+        
+        self.set_follows(follow_dic)
     
+    def set_follows(self, follow_dic):
+        """
+        Replaces the followed accounts whose posts are downloaded, keyed by
+        account ID. Only the accounts of the shard in settings["shard"] are
+        kept (see shard_accounts()).
+        """
+        follow_dic = shard_accounts(follow_dic, self.settings.get("shard"))
+        self.follows = {str(account['id']): account for account in follow_dic.values()}
+        self.follows_refreshed = time.time()
+    
+    def refresh_follows(self):
+        """
+        Gets the follow list again with get_owner_info() once it is older than
+        settings["follow_cache_ttl"] minutes, so posts from newly followed
+        accounts are picked up (unchanged pages cost a 304, see
+        get_following()).
+        """
+        if time.time() - self.follows_refreshed < self.settings["follow_cache_ttl"] * 60:
+            return
+        
         try:
-            username = input("Please type in username to search (Ctrl+C to exit): ")
-            base_url = "https://baraag.net/api/v2/search"
-            search_params = {'q': username, 'type':'accounts'}
+            self.set_follows(get_owner_info(self.client)['following'])
+        except Exception as exc:
+            logging.exception(str(exc))
+    
+    def start(self):
+        """
+        Remembers the newest post of the home timeline, so posts published
+        from now on are downloaded. Call before the initial sync, so posts
+        published during it are caught up afterwards.
+        
+        If the home timeline cannot be fetched, tries again, waiting
+        exponentially longer (up to max_backoff seconds) each time.
+        """
+        backoff = 1.0
+        
+        while True:
+            try:
+                page = self.client.timeline_home(limit = 1)
+                break
+            except Exception as exc:
+                logging.exception(str(exc))
+                print(Fore.YELLOW+"Could not fetch the home timeline. Trying "\
+                      "again in "+str(backoff)+" seconds..."+Fore.RESET)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        
+        if page:
+            self.since_id = int(page[0]['id'])
+    
+    def handle(self, status):
+        """
+        Takes a status from the stream or from catch_up() and submits it for
+        download if it is a post of a followed account with attachments (see
+        followed_media_post()).
+        """
+        with self.lock:
+            if self.since_id is None or int(status['id']) > self.since_id:
+                self.since_id = int(status['id'])
+        
+        account = followed_media_post(status, self.follows)
+        
+        if account is None:
+            return
+        
+        metrics.inc("watch_posts_total")
+        self.crawl_pool.submit(self.download, account, status)
+    
+    def download(self, account, status, files = None, attempt = 1):
+        """
+        Downloads the attachments of a single post (only the given Attachment
+        objects when retrying), see handle(). Failed downloads are retried
+        later, see retry().
+        """
+        label = "["+account['account']+"] "
+        
+        try:
+            folder_path = get_account_folder(self.settings, account['account'],
+                                             account['id'])
             
-            results = requests.get(base_url, params=search_params)
-            results = results.json()['accounts']
-            if not results:
-                print(Fore.RED+"User not found!"+Fore.RESET+" Please try again!")
+            if not os.path.isdir(folder_path):
+                os.makedirs(folder_path)
             
-        except MastodonNetworkError as exc:
-            mastodon_network_error_handler(exc)
-              
-        except MastodonError as exc:
-            mastodon_error_handler(exc)         
+            if files is None:
+                files = list(iter_attachments([[parse_post(status)]]))
+            
+            results = download_attachments(self.pool, self.settings, files,
+                                           folder_path,
+                                           conversions = self.conversions)
         
-        except KeyboardInterrupt:
-            print()
-            print(Fore.YELLOW+"Interrupted by user. Exiting..."+Fore.RESET)
-            sys.exit()
-
-    if len(results) > 1:
-        print(str(len(results))+" users found: \n")
-        for number, item in enumerate(results):
-            print(str(number+1) +" "+item['display_name']\
-                  +" URL: "+item['url']
-                  +" ID: "+str(item['id'])+"\n")
-              
-        valid_choices = list(range(1, len(results) + 1))
-        selection = ""
+        except Exception as exc:
+            logging.exception(str(exc))
+            print(Fore.RED+label+"Post "+str(status['id'])+" could not be "\
+                  "processed. Please check error logs."+Fore.RESET)
+            with self.lock:
+                self.failed += len(files or status['media_attachments'])
+            return
         
-        while selection not in valid_choices:
-            selection = ""
-            while not selection.isdigit():
-                selection = input("Please pick the user to be used from the list: ")
+        print(label+"New post "+str(status['id'])+
+              ": Downloaded: "+str(results['downloaded'])+
+              "; Linked: "+str(results['linked'])+
+              "; Skipped: "+str(results['skipped'])+
+              "; Failed: "+str(len(results['failed'])))
+        
+        if results['failed']:
+            self.retry(account, status, results['failed'], attempt)
+    
+    def retry(self, account, status, files, attempt):
+        """
+        Schedules the download of the failed attachments of a post again,
+        after retry_interval * attempt seconds, unless they failed
+        max_download_attempts times already (they then count as failed).
+        """
+        label = "["+account['account']+"] "
+        
+        with self.lock:
+            if attempt >= self.max_download_attempts or self.stopping:
+                self.failed += len(files)
+                return
+            
+            delay = self.retry_interval * attempt
+            
+            def resubmit():
+                with self.lock:
+                    if self.retries.pop(timer, None) is None:
+                        return
+                    self.crawl_pool.submit(self.download, account, status,
+                                           files, attempt + 1)
+            
+            timer = threading.Timer(delay, resubmit)
+            timer.daemon = True
+            self.retries[timer] = len(files)
+            timer.start()
+        
+        print(Fore.YELLOW+label+"Retrying "+str(len(files))+" failed "\
+              "download(s) in "+str(int(delay))+" seconds."+Fore.RESET)
+    
+    def catch_up(self):
+        """
+        Fetches the home timeline from the newest post seen, oldest first, and
+        passes every post to handle(). Errors are logged, and the posts are
+        fetched again on the next call.
+        """
+        self.refresh_follows()
+        
+        try:
+            while True:
+                page = self.client.timeline_home(min_id = self.since_id, limit = 40)
+                
+                if not page:
+                    break
+                
+                for status in sorted(page, key = lambda status: int(status['id'])):
+                    self.handle(status)
+                
+                if len(page) < 40:
+                    break
+        
+        except Exception as exc:
+            logging.exception(str(exc))
+            print(Fore.RED+"Could not fetch the home timeline. Please check "\
+                  "error logs."+Fore.RESET)
+    
+    def stream(self):
+        """
+        Reads the user stream until the connection is lost, passing every new
+        post to handle().
+        """
+        import copy
+        from mastodon import StreamListener
+        
+        watcher = self
+        
+        class Listener(StreamListener):
+            def on_update(self, status):
+                watcher.handle(status)
+        
+        # Mastodon.py combines request_timeout with its own read timeout for
+        # streams, so it has to be a single (connect) timeout here
+        
+        stream_client = copy.copy(self.client)
+        stream_client.request_timeout = self.settings["connect_timeout"]
+        stream_client.stream_user(Listener())
+    
+    def run(self, poll = False, poll_interval = 60.0):
+        """
+        Watches for new posts until interrupted (KeyboardInterrupt).
+        
+        Takes 2 arguments:
+        
+        poll = whether to poll the home timeline instead of using the
+               streaming API (bool)
+               Defaults to False
+               OPTIONAL
+        
+        poll_interval = seconds between polls (float)
+                        Defaults to 60
+                        OPTIONAL
+        
+        Returns nothing.
+        """
+        backoff = 1.0
+        stream_failures = 0
+        
+        while True:
+            self.catch_up()
+            
+            if poll:
+                time.sleep(poll_interval)
+                continue
+            
+            print(Fore.GREEN+"Listening for new posts..."+Fore.RESET)
+            connected = time.time()
+            
+            try:
+                self.stream()
+            except Exception as exc:
+                logging.error("Streaming connection lost: "+str(exc))
+            
+            metrics.inc("stream_reconnects_total")
+            
+            # A connection that lasted a while was not a failure to connect
+            
+            if time.time() - connected > 60:
+                backoff = 1.0
+                stream_failures = 0
             else:
-                selection = int(selection)                
+                stream_failures += 1
             
-        selection -=1
-        result_dic = {results[selection]['acct']:\
-                      {'account': results[selection]['acct'],\
-                       'id': results[selection]['id']}}
+            if stream_failures >= self.max_stream_failures:
+                print(Fore.YELLOW+"The streaming API is not available. Polling "\
+                      "for new posts every "+str(poll_interval)+" seconds "\
+                      "instead."+Fore.RESET)
+                poll = True
+                continue
+            
+            print(Fore.YELLOW+"Streaming connection lost. Reconnecting in "+
+                  str(backoff)+" seconds..."+Fore.RESET)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+    
+    def finish(self):
+        """
+        Waits for the downloads and conversions in progress. Downloads still
+        waiting to be retried count as failed.
         
-    else:   
-        result_dic = {results[0]['acct']:\
-                      {'account': results[0]['acct'],\
-                       'id': results[0]['id']}}
+        Returns: the number of attachments that failed to download or convert
+                 (int).
+        """
+        with self.lock:
+            self.stopping = True
+            for timer, count in self.retries.items():
+                timer.cancel()
+                self.failed += count
+            self.retries.clear()
+        
+        self.crawl_pool.shutdown()
+        self.pool.shutdown()
+        
+        if self.conversions is not None:
+            print("Waiting for conversions to finish...")
+            self.failed += self.conversions.finish()
+        
+        return self.failed
+
+def run_watch(args):
+    """
+    Runs the "watch" command of the command line mode: syncs every followed
+    account once (unless --no-initial-sync is given), then keeps running and
+    downloads new posts as they are published, see Watcher.
     
-    return result_dic
+    Takes 1 argument:
+        
+    args = parsed command line arguments (argparse.Namespace), see main()
+           REQUIRED
+    
+    Returns: the exit code (int) once interrupted: exit_ok if everything was
+             downloaded (and converted), exit_partial if some attachments
+             or accounts failed, exit_fatal if watch mode could not start.
+    """
+    settings = command_settings(args)
+    
+    settings = ffmpeg_status(settings)
+    
+    if args.output and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    
+    init_session(settings)
+    
+    client = headless_client(args.client_credentials, args.user_credentials, True)
+    if client is None:
+        return exit_fatal
+    
+    follow_dic, refresh = load_follow_list(client, settings)
+    if refresh is not None:
+        follow_dic = refresh.result()['following']
+    
+    print_shard(settings, follow_dic)
+    
+    watcher = Watcher(client, settings, follow_dic)
+    
+    failed = 0
+    unreachable = 0
+    
+    try:
+        watcher.start()
+        
+        if not args.no_initial_sync:
+            print()
+            print(Fore.YELLOW+"Processing "+str(len(follow_dic))+" accounts"+Fore.RESET)
+            print()
+            failed, unreachable = process_following_home(client, settings,
+                                                         follow_dic)
+        
+        watcher.run(args.poll, args.poll_interval)
+    
+    except KeyboardInterrupt:
+        print()
+        print(Fore.YELLOW+"Stopping..."+Fore.RESET)
+    
+    failed += watcher.finish()
+    
+    if failed or unreachable:
+        print(Fore.YELLOW+"Done, with "+str(failed)+" failed attachment(s) and "+
+              str(unreachable)+" account(s) whose posts could not be fetched."+
+              Fore.RESET)
+        return exit_partial
+    
+    print(Fore.GREEN+"All done!"+Fore.RESET)
+    return exit_ok
 
 def validate_login(client):
     """
@@ -1257,6 +5350,193 @@ def validate_login(client):
 #%%
 def main():
     try:
+        # Command line arguments
+        
+        parser = argparse.ArgumentParser(description = "Baraag DL - A simple "\
+                                         "Baraag media downloader")
+        parser.add_argument("--version", action = "version",
+                            version = "Baraag DL "+baraag_dl_version)
+        parser.add_argument("--full-rescan", action = "store_true",
+                            help = "fetch the whole timeline of every account "\
+                                "instead of only posts newer than the last run")
+        parser.add_argument("--stats", action = "store_true",
+                            help = "show files and bytes downloaded per account "\
+                                "and per day, then exit")
+        parser.add_argument("--metrics-json", metavar = "FILE",
+                            help = "write a JSON summary of the run metrics "\
+                                "to FILE")
+        parser.add_argument("--metrics-prom", metavar = "FILE",
+                            help = "write the run metrics to FILE in the "\
+                                "Prometheus text format (e.g. for the "\
+                                "node_exporter textfile collector)")
+        
+        # Command line mode: without a command, the interactive menu is shown
+        
+        commands = parser.add_subparsers(dest = "command", metavar = "command")
+        status_parser = commands.add_parser("status", help = "show the sync "\
+                                            "state of every account, then exit")
+        status_parser.add_argument("--json", action = "store_true",
+                                   help = "print the status as JSON")
+        sync_parser = commands.add_parser("sync", help = "download without "\
+                                          "any prompt (for scheduled runs)",
+                                          description = "Download without any "\
+                                          "prompt. Exit codes: 0 = success, "\
+                                          "1 = some attachments or accounts "\
+                                          "failed, 2 = the sync could not run.")
+        plan_parser = commands.add_parser("plan", help = "show what sync would "\
+                                          "download, without downloading "\
+                                          "anything",
+                                          description = "Show how many files "\
+                                          "sync would download, their "\
+                                          "estimated size and download time, "\
+                                          "without downloading anything.")
+        
+        watch_parser = commands.add_parser("watch", help = "sync, then keep "\
+                                           "downloading new posts as they "\
+                                           "are published",
+                                           description = "Sync every followed "\
+                                           "account, then keep running and "\
+                                           "download new posts from the "\
+                                           "streaming API (or by polling) "\
+                                           "until interrupted with Ctrl+C.")
+        
+        # Every target of sync and plan, and watch itself, take the options
+        # below
+        
+        option_parsers = [(watch_parser, watch_parser)]
+        
+        for command_parser, verb in ((sync_parser, "sync"), (plan_parser, "plan")):
+            targets = command_parser.add_subparsers(dest = "target",
+                                                    metavar = "target",
+                                                    required = True)
+            targets.add_parser("following", help = verb+" every account "\
+                               "followed by the logged-in user")
+            accounts_parser = targets.add_parser("accounts", help = verb+" the "\
+                                                 "accounts listed in a file")
+            accounts_parser.add_argument("list_file", metavar = "FILE",
+                                         help = "file with one account name "\
+                                             "or ID per line (# starts a "\
+                                             "comment)")
+            
+            option_parsers.extend((command_parser, target_parser)\
+                                  for target_parser in targets.choices.values())
+        
+        for command_parser, target_parser in option_parsers:
+            target_parser.add_argument("--output", metavar = "DIR",
+                                       default = "",
+                                       help = "folder in which account "\
+                                           "folders are created (default: "\
+                                           "current folder)")
+            target_parser.add_argument("--client-credentials",
+                                       metavar = "FILE",
+                                       default = "client_credentials",
+                                       help = "client credentials file "\
+                                           "(default: client_credentials)")
+            target_parser.add_argument("--user-credentials", metavar = "FILE",
+                                       default = "user_credentials",
+                                       help = "user credentials file "\
+                                           "(default: user_credentials)")
+            target_parser.add_argument("--shard", metavar = "INDEX/COUNT",
+                                       type = shard_spec,
+                                       help = "only process the accounts of "\
+                                           "shard INDEX out of COUNT, to "\
+                                           "split the accounts between "\
+                                           "several processes or machines")
+            target_parser.add_argument("--rate-budget", metavar = "FILE",
+                                       help = "file holding the rate-limit "\
+                                           "budget shared with the other "\
+                                           "processes using it (default "\
+                                           "with --shard: "+
+                                           rate_budget_file+")")
+            target_parser.add_argument("--full-rescan", action = "store_true",
+                                       default = argparse.SUPPRESS,
+                                       help = "fetch the whole timeline "\
+                                           "of every account")
+            for option in ("max-downloads", "max-downloads-per-host",
+                           "max-crawlers"):
+                target_parser.add_argument("--"+option, metavar = "N",
+                                           type = positive_int,
+                                           help = "override "+
+                                               option.replace("-", "_")+
+                                               " from config.ini")
+            
+            if command_parser is plan_parser:
+                target_parser.add_argument("--estimate",
+                                           choices = ("meta", "head"),
+                                           default = "meta",
+                                           help = "estimate sizes from "\
+                                               "attachment metadata "\
+                                               "(default) or with a HEAD "\
+                                               "request per file")
+                target_parser.add_argument("--bandwidth", metavar = "MB/s",
+                                           type = float, default = 10.0,
+                                           help = "download speed used to "\
+                                               "estimate the time "\
+                                               "(default: 10)")
+                target_parser.add_argument("--json", action = "store_true",
+                                           help = "print the plan as JSON")
+                continue
+            
+            target_parser.add_argument("--max-conversions", metavar = "N",
+                                       type = non_negative_int,
+                                       help = "override max_conversions "\
+                                           "from config.ini (0: one per "\
+                                           "CPU core)")
+            target_parser.add_argument("--ffmpeg-path", metavar = "PATH",
+                                       help = "override ffmpeg_path from "\
+                                           "config.ini")
+            for option, key in (("ffmpeg", "use_ffmpeg"),
+                                ("gif", "convert_gif"),
+                                ("apng", "convert_apng"),
+                                ("home-timeline", "home_timeline_sync")):
+                target_parser.add_argument("--"+option, dest = key,
+                                           action = "store_true",
+                                           default = None,
+                                           help = "override "+key+" from "\
+                                               "config.ini")
+                target_parser.add_argument("--no-"+option, dest = key,
+                                           action = "store_false")
+        
+        watch_parser.add_argument("--poll", action = "store_true",
+                                  help = "poll the home timeline instead of "\
+                                      "using the streaming API")
+        watch_parser.add_argument("--poll-interval", metavar = "SECONDS",
+                                  type = float, default = 60.0,
+                                  help = "seconds between polls, when polling "\
+                                      "(default: 60)")
+        watch_parser.add_argument("--no-initial-sync", action = "store_true",
+                                  help = "only download posts published from "\
+                                      "now on")
+        
+        args = parser.parse_args()
+        
+        if args.stats:
+            print_stats()
+            sys.exit()
+        
+        if args.command == "status":
+            print_status(args.json)
+            sys.exit()
+        
+        if args.command == "plan":
+            exit_code = run_plan(args)
+            export_metrics(args)
+            sys.exit(exit_code)
+        
+        if args.command == "sync":
+            print("Baraag DL version "+str(baraag_dl_version))
+            print()
+            exit_code = run_sync(args)
+            export_metrics(args)
+            sys.exit(exit_code)
+        
+        if args.command == "watch":
+            print("Baraag DL version "+str(baraag_dl_version))
+            print()
+            exit_code = run_watch(args)
+            export_metrics(args)
+            sys.exit(exit_code)
+        
         print("------------------------------------------------------")
         print(Fore.LIGHTCYAN_EX+"Baraag DL version "+str(baraag_dl_version))
         print("by rizelbr"+Fore.RESET)
@@ -1269,15 +5549,19 @@ def main():
         
         settings = ffmpeg_init()
 
-        # Initialize Ffmpeg
-        settings = ffmpeg_validate(settings)
-    
-        if settings["use_ffmpeg"]:
-            print(Fore.GREEN+"Ffmpeg conversion enabled."+Fore.RESET)
-            print()
-        else:
-            print(Fore.YELLOW+"Ffmpeg conversion disabled"+Fore.RESET)
+        # The ffmpeg executable is only looked for if conversion is enabled
+        
+        settings = ffmpeg_status(settings)
+        
+        settings["full_rescan"] = args.full_rescan
+        
+        if settings["full_rescan"]:
+            print(Fore.YELLOW+"Full rescan requested. Fetching all posts."+Fore.RESET)
             print()
+        
+        # Shared HTTP session for the client and all downloads
+        
+        init_session(settings)
 
         # Client initialization
         
@@ -1311,6 +5595,8 @@ def main():
             print(Fore.YELLOW+"Exiting..."+Fore.RESET)
             sys.exit()
         
+        export_metrics(args)
+        
         if os.path.isfile(logfile):
             print(Fore.YELLOW+"There were errors during the execution "\
                   "of Baraag DL. Please check logs for details."+Fore.RESET)
@@ -1320,7 +5606,31 @@ def main():
     except KeyboardInterrupt:
         print()
         print(Fore.YELLOW+"Interrupted by user. Exiting..."+Fore.RESET)
-        sys.exit()
+        sys.exit(exit_fatal)
+    
+    except APIError:
+        print("Exiting...")
+        sys.exit(exit_fatal)
+    
+    # Anything else means the run could not complete either; exit_partial
+    # is only for runs that went through
+    
+    except Exception as exc:
+        logging.exception(str(exc))
+        print(Fore.RED+"Unexpected error: "+repr(exc)+". Please check error "\
+              "logs. Exiting..."+Fore.RESET)
+        sys.exit(exit_fatal)
+
+def export_metrics(args):
+    """
+    Writes the run metrics to the files given with --metrics-json and
+    --metrics-prom, if any.
+    """
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
 
 if __name__ == "__main__": 
     main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Baraag DL conversion benchmark - compares the single pass APNG + GIF
+conversion against running ffmpeg once per format.
+
+Usage:
+    python3 benchmarks/bench_conversion.py --ffmpeg /usr/bin/ffmpeg video.mp4 [...]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import baraag_dl
+
+
+def time_conversion(ffmpeg, input_path, jobs):
+    """
+    Runs one ffmpeg process per job (a dictionary of output formats and
+    paths, see baraag_dl.ffmpeg_arguments()) and returns the wall time taken.
+    """
+    start = time.perf_counter()
+    for job in jobs:
+        subprocess.run(baraag_dl.ffmpeg_arguments(ffmpeg, input_path, job),
+                       stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                       check = True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare single pass and "\
+                                     "separate APNG/GIF conversions")
+    parser.add_argument("files", nargs = "+", help = "MP4 files to convert")
+    parser.add_argument("--ffmpeg", default = "ffmpeg",
+                        help = "path of the ffmpeg executable")
+    parser.add_argument("--repeat", type = int, default = 3,
+                        help = "runs per file and mode (best one is kept)")
+    args = parser.parse_args()
+
+    totals = {"separate": 0.0, "single": 0.0}
+
+    print("File".ljust(40)+"Separate (s)".rjust(14)+"Single (s)".rjust(14)+
+          "Speedup".rjust(10))
+
+    with tempfile.TemporaryDirectory() as folder:
+        for input_path in args.files:
+            outputs = {"APNG": os.path.join(folder, "out.apng"),
+                       "GIF": os.path.join(folder, "out.gif")}
+            modes = {"separate": [{"APNG": outputs["APNG"]},
+                                  {"GIF": outputs["GIF"]}],
+                     "single": [outputs]}
+            best = {}
+
+            for mode, jobs in modes.items():
+                runs = []
+                for _ in range(args.repeat):
+                    for path in outputs.values():
+                        if os.path.isfile(path):
+                            os.remove(path)
+                    runs.append(time_conversion(args.ffmpeg, input_path, jobs))
+                best[mode] = min(runs)
+                totals[mode] += best[mode]
+
+            print(os.path.basename(input_path)[:39].ljust(40)+
+                  ("%.2f" % best["separate"]).rjust(14)+
+                  ("%.2f" % best["single"]).rjust(14)+
+                  ("%.2fx" % (best["separate"] / best["single"])).rjust(10))
+
+    print("Total".ljust(40)+("%.2f" % totals["separate"]).rjust(14)+
+          ("%.2f" % totals["single"]).rjust(14)+
+          ("%.2fx" % (totals["separate"] / totals["single"])).rjust(10))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Baraag DL sync benchmark - measures timeline fetching, attachment probing
+and full downloads against the local mock server of mock_mastodon.py, so
+performance changes can be checked without hitting baraag.net.
+
+Three stages are run, each with an empty output folder and database:
+    timeline    - get_timeline() over every followed account (pages/s)
+    attachments - get_attachment_data() over the same timelines (files/s)
+    sync        - process_following_user() downloading everything
+                  (files/s, MB/s)
+
+Peak RSS is the peak of the whole benchmark process so far (the mock server
+runs in the same process), as reported by the operating system.
+
+Usage:
+    python3 benchmarks/bench_sync.py --accounts 10 --posts 200 --latency 0.02
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import baraag_dl
+import mock_mastodon
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process in MB, or None if it
+    cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def reset_state(folder):
+    """
+    Points baraag_dl at a fresh database in folder and forgets the rate-limit
+    budget of the previous stage.
+    """
+    with baraag_dl.state_db_lock:
+        if baraag_dl.state_db is not None:
+            baraag_dl.state_db.close()
+        baraag_dl.state_db = None
+        baraag_dl.state_db_file = os.path.join(folder, "baraag_dl.db")
+    baraag_dl.api_rate_limiter = baraag_dl.RateLimiter()
+
+
+def run_stage(name, function, counters):
+    """
+    Runs function() (returning a dictionary of counts) and returns its
+    counts with the elapsed time, the server counters and the peak RSS.
+    """
+    before = dict(counters)
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    result.update({"stage": name, "seconds": elapsed,
+                   "api_requests": counters["api"] - before["api"],
+                   "media_requests": counters["media"] - before["media"],
+                   "megabytes": (counters["bytes"] - before["bytes"]) / 1024 / 1024,
+                   "peak_rss_mb": peak_rss()})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark Baraag DL "\
+                                     "against a local mock Mastodon server")
+    parser.add_argument("--accounts", type = int, default = 5,
+                        help = "followed accounts")
+    parser.add_argument("--posts", type = int, default = 200,
+                        help = "media posts per account")
+    parser.add_argument("--attachments", type = int, default = 2,
+                        help = "attachments per post")
+    parser.add_argument("--media-size", type = int, default = 65536,
+                        help = "size of every media file, in bytes")
+    parser.add_argument("--remote-share", type = float, default = 0.1,
+                        help = "share of proxied remote attachments")
+    parser.add_argument("--redirect-share", type = float, default = 0.02,
+                        help = "share of attachments behind redirect URLs")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "delay added to every request, in seconds")
+    parser.add_argument("--ratelimit", type = int, default = 0,
+                        help = "API requests allowed per window (0: no limit)")
+    parser.add_argument("--window", type = float, default = 300.0,
+                        help = "rate limit window, in seconds")
+    parser.add_argument("--stages", default = "timeline,attachments,sync",
+                        help = "comma-separated stages to run")
+    parser.add_argument("--json", action = "store_true",
+                        help = "print the results as JSON")
+    args = parser.parse_args()
+
+    data = mock_mastodon.MockData(args.accounts, args.posts, args.attachments,
+                                  args.media_size, args.remote_share,
+                                  args.redirect_share)
+    ratelimit = mock_mastodon.RateLimit(args.ratelimit, args.window)\
+        if args.ratelimit else None
+    server = mock_mastodon.serve(data, latency = args.latency,
+                                 ratelimit = ratelimit)
+    counters = server.RequestHandlerClass.counters
+
+    baraag_dl.api_base_url = "http://%s:%d" % server.server_address
+    settings = dict(baraag_dl.default_settings)
+    baraag_dl.init_session(settings)
+    client = baraag_dl.Mastodon(access_token = "benchmark",
+                                api_base_url = baraag_dl.api_base_url,
+                                version_check_mode = "none",
+                                ratelimit_method = "wait",
+                                session = baraag_dl.get_session())
+    follow_dic = {account["acct"]: {"account": account["acct"],
+                                    "id": account["id"]}
+                  for account in data.accounts}
+
+    def timelines():
+        return (baraag_dl.get_timeline(client, account["id"])
+                for account in data.accounts)
+
+    def timeline_stage():
+        pages = 0
+        posts = 0
+        for timeline in timelines():
+            for page in timeline:
+                pages += 1
+                posts += len(page)
+        return {"pages": pages, "posts": posts}
+
+    def attachments_stage():
+        files = 0
+        for timeline in timelines():
+            attachment_dic = baraag_dl.get_attachment_data(timeline)
+            files += sum(len(post.attachments) for post in attachment_dic.values())
+        return {"files": files}
+
+    def sync_stage():
+        failed, failed_accounts = baraag_dl.process_following_user(client, settings,
+                                                                   follow_dic)
+        with baraag_dl.state_db_lock:
+            files = baraag_dl.get_state_db().execute(
+                "SELECT COUNT(*) FROM manifest").fetchone()[0]
+        return {"files": files, "failed": failed,
+                "failed_accounts": failed_accounts}
+
+    stages = {"timeline": timeline_stage, "attachments": attachments_stage,
+              "sync": sync_stage}
+    results = []
+    cwd = os.getcwd()
+
+    for name in args.stages.split(","):
+        with tempfile.TemporaryDirectory() as folder:
+            reset_state(folder)
+            downloads = os.path.join(folder, "downloads")
+            os.mkdir(downloads)
+            os.chdir(downloads)
+            try:
+                results.append(run_stage(name, stages[name], counters))
+            finally:
+                os.chdir(cwd)
+                reset_state(cwd)
+
+    if args.json:
+        print(json.dumps(results, indent = 2))
+        return
+
+    print("Stage".ljust(12)+"Time (s)".rjust(10)+"Pages/s".rjust(10)+
+          "Files/s".rjust(10)+"MB/s".rjust(10)+"API reqs".rjust(10)+
+          "Peak RSS (MB)".rjust(15))
+    for result in results:
+        seconds = result["seconds"]
+        rss = result["peak_rss_mb"]
+        print(result["stage"].ljust(12)+("%.2f" % seconds).rjust(10)+
+              ("%.1f" % (result.get("pages", 0) / seconds)).rjust(10)+
+              ("%.1f" % (result.get("files", 0) / seconds)).rjust(10)+
+              ("%.2f" % (result["megabytes"] / seconds)).rjust(10)+
+              str(result["api_requests"]).rjust(10)+
+              ("n/a" if rss is None else "%.1f" % rss).rjust(15))
+
+
+if __name__ == "__main__":
+    main()
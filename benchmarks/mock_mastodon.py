@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mock Mastodon server used to benchmark Baraag DL without hitting baraag.net.
+
+Serves the parts of the Mastodon API Baraag DL uses (account statuses and
+following lists with Link pagination, account lookup, v2 search, home
+timeline, credentials, instance info and a server-sent events stand-in for
+the user stream) and media files, including proxied remote media
+(/media_proxy/ with a remote_url) and redirect-style URLs without an
+extension. Latency, media sizes and a fixed-window rate limit with
+X-RateLimit-* headers are configurable. JSON responses carry a weak ETag
+and are answered with 304 Not Modified when If-None-Match matches it.
+
+Usage:
+    python3 benchmarks/mock_mastodon.py --port 8765 --latency 0.05
+    python3 benchmarks/mock_mastodon.py --port 8765 --post-every 10
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class MockData:
+    """
+    Deterministic fake instance: a logged-in owner following a number of
+    accounts, each with a number of media posts.
+    """
+    def __init__(self, accounts = 5, posts = 100, attachments = 2,
+                 media_size = 65536, remote_share = 0.1, redirect_share = 0.02,
+                 seed = 0):
+        rng = random.Random(seed)
+        self.media_size = media_size
+        self.owner = {"id": "1", "acct": "owner", "username": "owner",
+                      "display_name": "Owner", "url": "http://mock/@owner"}
+        self.accounts = []
+        self.statuses = {}
+        self.media = {}
+        start = datetime(2024, 1, 1, tzinfo = timezone.utc)
+        status_id = 100000
+        attachment_id = 500000
+        for number in range(accounts):
+            account = {"id": str(1000 + number), "acct": "artist"+str(number),
+                       "username": "artist"+str(number),
+                       "display_name": "Artist "+str(number),
+                       "url": "http://mock/@artist"+str(number),
+                       "statuses_count": posts,
+                       "last_status_at": None}
+            self.accounts.append(account)
+            self.statuses[account["id"]] = []
+        # Interleave posts from all accounts so IDs grow with time
+        for post_number in range(posts):
+            for account in self.accounts:
+                status_id += 1
+                created = start + timedelta(minutes = status_id - 100000)
+                media = []
+                for _ in range(attachments):
+                    attachment_id += 1
+                    kind = rng.random()
+                    name = str(attachment_id)
+                    extension = ".mp4" if rng.random() < 0.1 else ".png"
+                    self.media[name] = extension
+                    local_url = "{base}/media/"+name+extension
+                    if kind < remote_share:
+                        entry = {"url": "{base}/media_proxy/"+name,
+                                 "remote_url": "{base}/remote/"+name+extension+"?sig=1"}
+                    elif kind < remote_share + redirect_share:
+                        entry = {"url": "{base}/redirect/"+name,
+                                 "remote_url": None}
+                    else:
+                        entry = {"url": local_url, "remote_url": None}
+                    original = {"width": 640, "height": 480}
+                    if extension == ".mp4":
+                        # Matches the size of the file served
+                        original.update({"duration": 2.0,
+                                         "bitrate": media_size * 8 // 2})
+                    entry.update({"id": str(attachment_id),
+                                  "type": "video" if extension == ".mp4" else "image",
+                                  "meta": {"original": original}})
+                    media.append(entry)
+                status = {"id": str(status_id),
+                          "created_at": created.isoformat().replace("+00:00", ".000Z"),
+                          "account": account,
+                          "content": "<p>post "+str(status_id)+"</p>",
+                          "media_attachments": media,
+                          "reblog": None,
+                          "in_reply_to_id": None,
+                          "emojis": [], "tags": [], "mentions": [],
+                          "visibility": "public"}
+                self.statuses[account["id"]].insert(0, status)
+                account["last_status_at"] = created.date().isoformat()
+        self.home = sorted((s for statuses in self.statuses.values()
+                            for s in statuses),
+                           key = lambda s: int(s["id"]), reverse = True)
+        # Posts added by add_post(), sent to the user stream
+        self.events = []
+        self.new_post = threading.Condition()
+
+    def add_post(self, account_index = 0):
+        """
+        Appends a new media post to an account, returning it. Clients
+        connected to the user stream receive it as an update event.
+        """
+        with self.new_post:
+            account = self.accounts[account_index]
+            newest = max(int(s["id"]) for s in self.home) + 1
+            name = str(900000 + newest)
+            self.media[name] = ".png"
+            status = dict(self.statuses[account["id"]][0])
+            status["id"] = str(newest)
+            status["created_at"] = datetime.now(timezone.utc).isoformat(
+                timespec = "milliseconds").replace("+00:00", "Z")
+            status["media_attachments"] = [{"id": name, "type": "image",
+                                            "url": "{base}/media/"+name+".png",
+                                            "remote_url": None, "meta": {}}]
+            self.statuses[account["id"]].insert(0, status)
+            self.home.insert(0, status)
+            account["statuses_count"] += 1
+            account["last_status_at"] = datetime.now(timezone.utc).date().isoformat()
+            self.events.append(status)
+            self.new_post.notify_all()
+        return status
+
+
+class RateLimit:
+    """
+    Fixed-window rate limit emulating Mastodon's X-RateLimit-* headers.
+    """
+    def __init__(self, limit = 300, window = 300.0):
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset_at = time.time() + window
+        self.remaining = limit
+
+    def hit(self):
+        with self.lock:
+            now = time.time()
+            if now >= self.reset_at:
+                self.reset_at = now + self.window
+                self.remaining = self.limit
+            allowed = self.remaining > 0
+            if allowed:
+                self.remaining -= 1
+            reset = datetime.fromtimestamp(self.reset_at, timezone.utc)
+            headers = {"X-RateLimit-Limit": str(self.limit),
+                       "X-RateLimit-Remaining": str(self.remaining),
+                       "X-RateLimit-Reset": reset.isoformat(timespec = "milliseconds")\
+                           .replace("+00:00", "Z")}
+            return allowed, headers
+
+
+def make_handler(data, latency = 0.0, ratelimit = None, page_size = 40,
+                 heartbeat = 15.0, stream_lifetime = None):
+    """
+    Returns a request handler class serving a MockData instance. Every
+    request is delayed by latency seconds, API requests are limited by
+    ratelimit (a RateLimit, or None) and pages hold at most page_size items.
+    The user stream sends a heartbeat every heartbeat seconds and is closed
+    after stream_lifetime seconds (None: never). The handler counts API
+    requests, media requests and media bytes sent in its counters attribute.
+    """
+    counters_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        counters = {"api": 0, "media": 0, "bytes": 0, "not_modified": 0}
+
+        def count(self, key, value = 1):
+            with counters_lock:
+                self.counters[key] += value
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately; avoid Nagle delays
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, format, *args):
+            pass
+
+        def base(self):
+            return "http://" + self.headers.get("Host", "127.0.0.1")
+
+        def send_json(self, payload, links = None, extra = None):
+            body = json.dumps(payload).replace("{base}", self.base()).encode()
+            etag = 'W/"'+hashlib.md5(body).hexdigest()+'"'
+            if self.headers.get("If-None-Match") == etag:
+                self.count("not_modified")
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                for key, value in (extra or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            for key, value in (extra or {}).items():
+                self.send_header(key, value)
+            if links:
+                self.send_header("Link", ", ".join('<'+url+'>; rel="'+rel+'"'
+                                                   for rel, url in links.items()))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_status(self, code, extra = None):
+            body = json.dumps({"error": "error "+str(code)}).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (extra or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def paginate(self, items, query, path):
+            limit = min(int(query.get("limit", [page_size])[0]), page_size)
+            max_id = query.get("max_id", [None])[0]
+            since_id = query.get("since_id", [None])[0]
+            min_id = query.get("min_id", [None])[0]
+            selected = items
+            if max_id:
+                selected = [i for i in selected if int(i["id"]) < int(max_id)]
+            if since_id:
+                selected = [i for i in selected if int(i["id"]) > int(since_id)]
+            if min_id:
+                selected = [i for i in selected if int(i["id"]) > int(min_id)]
+                selected = selected[-limit:]
+            else:
+                selected = selected[:limit]
+            links = {}
+            if selected:
+                links["next"] = self.base()+path+"?limit="+str(limit)+\
+                    "&max_id="+selected[-1]["id"]
+                links["prev"] = self.base()+path+"?limit="+str(limit)+\
+                    "&min_id="+selected[0]["id"]
+            return selected, links
+
+        def do_HEAD(self):
+            self.do_GET(head = True)
+
+        def do_GET(self, head = False):
+            if latency:
+                time.sleep(latency)
+            parsed = urlparse(self.path)
+            path = parsed.path
+            query = parse_qs(parsed.query)
+            if path.startswith("/api/"):
+                self.count("api")
+                extra = {}
+                if ratelimit is not None:
+                    allowed, extra = ratelimit.hit()
+                    if not allowed:
+                        return self.send_error_status(429, extra)
+                return self.api(path, query, extra)
+            return self.media(path, head)
+
+        def api(self, path, query, extra):
+            parts = path.strip("/").split("/")
+            if path.rstrip("/") in ("/api/v1/instance", "/api/v2/instance"):
+                return self.send_json({"uri": "mock", "version": "4.2.0",
+                                       "urls": {"streaming_api": self.base().replace("http", "ws")}},
+                                      extra = extra)
+            if path == "/api/v1/streaming/user":
+                return self.stream_user(extra)
+            if path == "/api/v1/accounts/verify_credentials":
+                return self.send_json(data.owner, extra = extra)
+            if path == "/api/v2/search":
+                term = query.get("q", [""])[0]
+                found = [a for a in data.accounts if term in a["acct"]]
+                return self.send_json({"accounts": found, "statuses": [],
+                                       "hashtags": []}, extra = extra)
+            if path == "/api/v1/accounts/lookup":
+                acct = query.get("acct", [""])[0]
+                found = [a for a in data.accounts if a["acct"] == acct]
+                if not found:
+                    return self.send_error_status(404, extra)
+                return self.send_json(found[0], extra = extra)
+            if len(parts) == 4 and parts[2] == "accounts":
+                found = [a for a in data.accounts if a["id"] == parts[3]]
+                if not found:
+                    return self.send_error_status(404, extra)
+                return self.send_json(found[0], extra = extra)
+            if path == "/api/v1/timelines/home":
+                page, links = self.paginate(data.home, query, path)
+                return self.send_json(page, links, extra)
+            if len(parts) == 5 and parts[2] == "accounts":
+                account_id = parts[3]
+                if parts[4] == "following":
+                    page, links = self.paginate(
+                        [dict(a, id = a["id"]) for a in sorted(data.accounts,
+                         key = lambda a: int(a["id"]), reverse = True)],
+                        query, path)
+                    return self.send_json(page, links, extra)
+                if parts[4] == "statuses":
+                    statuses = data.statuses.get(account_id)
+                    if statuses is None:
+                        return self.send_error_status(404, extra)
+                    page, links = self.paginate(statuses, query, path)
+                    return self.send_json(page, links, extra)
+            return self.send_error_status(404, extra)
+
+        def stream_user(self, extra):
+            """
+            Server-sent events stand-in for the user stream: posts added with
+            MockData.add_post() while connected are sent as update events.
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            for key, value in extra.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.close_connection = True
+            with data.new_post:
+                cursor = len(data.events)
+            started = time.time()
+            try:
+                while stream_lifetime is None or \
+                      time.time() - started < stream_lifetime:
+                    with data.new_post:
+                        data.new_post.wait_for(lambda: len(data.events) > cursor,
+                                               heartbeat)
+                        events = data.events[cursor:]
+                    cursor += len(events)
+                    for status in events:
+                        payload = json.dumps(status).replace("{base}", self.base())
+                        self.wfile.write(("event: update\ndata: "+payload+
+                                          "\n\n").encode())
+                    if not events:
+                        self.wfile.write(b":thump\n")
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def media(self, path, head):
+            parts = path.strip("/").split("/")
+            if len(parts) != 2 or parts[0] not in ("media", "remote", "redirect", "media_proxy"):
+                return self.send_error_status(404)
+            name = parts[1].split(".")[0]
+            if name not in data.media:
+                return self.send_error_status(404)
+            extension = data.media[name]
+            size = data.media_size
+            start, end = 0, size - 1
+            status = 200
+            byte_range = self.headers.get("Range")
+            if byte_range and byte_range.startswith("bytes="):
+                first, _, last = byte_range[6:].partition("-")
+                start = int(first or 0)
+                end = min(int(last), size - 1) if last else size - 1
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */"+str(size))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+            self.send_response(status)
+            content_type = "video/mp4" if extension == ".mp4" else "image/png"
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            if status == 206:
+                self.send_header("Content-Range", "bytes "+str(start)+"-"+
+                                 str(end)+"/"+str(size))
+            if parts[0] == "redirect":
+                self.send_header("Content-Disposition",
+                                 'inline; filename="'+name+extension+'"')
+            self.end_headers()
+            if head:
+                return
+            self.count("media")
+            magic = b"\x00\x00\x00\x18ftypmp42" if extension == ".mp4" \
+                else b"\x89PNG\r\n\x1a\n"
+            seed = (magic + name.encode() * (size // len(name) + 1))[:size]
+            body = seed[start:end + 1]
+            self.count("bytes", len(body))
+            self.wfile.write(body)
+
+    return Handler
+
+
+def serve(data, host = "127.0.0.1", port = 0, **kwargs):
+    """
+    Starts the mock server on a background thread, returning the server.
+    Keyword arguments are passed to make_handler(); the handler counters are
+    available as server.RequestHandlerClass.counters.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(data, **kwargs))
+    server.daemon_threads = True
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Mock Mastodon server "\
+                                     "for Baraag DL benchmarks")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--accounts", type = int, default = 5,
+                        help = "followed accounts")
+    parser.add_argument("--posts", type = int, default = 100,
+                        help = "media posts per account")
+    parser.add_argument("--attachments", type = int, default = 2,
+                        help = "attachments per post")
+    parser.add_argument("--media-size", type = int, default = 65536,
+                        help = "size of every media file, in bytes")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "delay added to every request, in seconds")
+    parser.add_argument("--ratelimit", type = int, default = 0,
+                        help = "API requests allowed per window (0: no limit)")
+    parser.add_argument("--window", type = float, default = 300.0,
+                        help = "rate limit window, in seconds")
+    parser.add_argument("--post-every", type = float, default = 0.0,
+                        help = "add a post to a random account every N "\
+                            "seconds (0: never), e.g. to try watch mode")
+    parser.add_argument("--stream-lifetime", type = float, default = None,
+                        help = "close user stream connections after N seconds")
+    args = parser.parse_args()
+
+    data = MockData(args.accounts, args.posts, args.attachments,
+                    args.media_size)
+    ratelimit = RateLimit(args.ratelimit, args.window) if args.ratelimit else None
+    server = serve(data, port = args.port, latency = args.latency,
+                   ratelimit = ratelimit, stream_lifetime = args.stream_lifetime)
+    print("Listening on http://%s:%d" % server.server_address)
+    if not args.post_every:
+        threading.Event().wait()
+    rng = random.Random()
+    while True:
+        time.sleep(args.post_every)
+        status = data.add_post(rng.randrange(len(data.accounts)))
+        print("Added post", status["id"], "by", status["account"]["acct"])
+
+
+if __name__ == "__main__":
+    main()